@@ -0,0 +1,185 @@
+"""
+Array based tools to post-process predicted MBIS charges and volumes.
+"""
+
+from typing import Optional, Sequence
+
+import numpy as np
+from rdkit import Chem
+
+
+def apply_bond_charge_corrections(
+    charges: np.ndarray, atom_indices: np.ndarray, corrections: np.ndarray
+) -> np.ndarray:
+    """
+    Apply a set of bond charge corrections to the atomic charges.
+
+    Args:
+        charges: The charge of each atom.
+        atom_indices: An array of shape (n_bccs, 2) with the index of the atom which gains the correction and the
+            index of the atom which loses it.
+        corrections: The charge correction of each bcc in e.
+
+    Returns:
+        A new array of corrected charges.
+    """
+    charges = np.array(charges, dtype=np.float64).reshape(-1)
+    atom_indices = np.asarray(atom_indices, dtype=np.int64).reshape(-1, 2)
+    corrections = np.asarray(corrections, dtype=np.float64).reshape(-1)
+    np.add.at(charges, atom_indices[:, 0], corrections)
+    np.subtract.at(charges, atom_indices[:, 1], corrections)
+    return charges
+
+
+def get_symmetry_classes(molecule: Chem.Mol) -> np.ndarray:
+    """
+    Get the symmetry class of each atom in the molecule, symmetry equivalent atoms share the same class.
+    """
+    return np.array(Chem.CanonicalRankAtoms(molecule, breakTies=False), dtype=np.int64)
+
+
+def get_canonical_order(molecule: Chem.Mol) -> tuple[str, np.ndarray]:
+    """
+    Get the canonical identity of the molecule and the canonical rank of each atom.
+
+    The ranks can be used to move per atom parameters between different atom orderings of the same molecule.
+
+    Returns:
+        The canonical isomeric smiles with explicit hydrogens and the canonical rank of each atom.
+    """
+    return Chem.MolToSmiles(molecule), np.array(
+        Chem.CanonicalRankAtoms(molecule, breakTies=True), dtype=np.int64
+    )
+
+
+def symmetrise(values: np.ndarray, symmetry_classes: np.ndarray) -> np.ndarray:
+    """
+    Average the values over each set of symmetry equivalent atoms.
+
+    Args:
+        values: The per atom property to symmetrise.
+        symmetry_classes: The symmetry class of each atom, see `get_symmetry_classes`.
+
+    Returns:
+        A new array of symmetrised values.
+    """
+    values = np.asarray(values, dtype=np.float64).reshape(-1)
+    symmetry_classes = np.asarray(symmetry_classes, dtype=np.int64)
+    totals = np.bincount(symmetry_classes, weights=values)
+    counts = np.bincount(symmetry_classes)
+    return totals[symmetry_classes] / counts[symmetry_classes]
+
+
+def get_molecule_offsets(n_atoms: Sequence[int]) -> np.ndarray:
+    """
+    Build the offset array of a flat batch of molecules, the atoms of molecule `i` are
+    `offsets[i]:offsets[i + 1]`.
+    """
+    offsets = np.zeros(len(n_atoms) + 1, dtype=np.int64)
+    np.cumsum(n_atoms, out=offsets[1:])
+    return offsets
+
+
+def get_formal_charges(molecules: Sequence[Chem.Mol]) -> np.ndarray:
+    """Get the total formal charge of each molecule."""
+    return np.array(
+        [Chem.GetFormalCharge(molecule) for molecule in molecules], dtype=np.float64
+    )
+
+
+def fix_net_charges(
+    charges: np.ndarray,
+    molecule_offsets: np.ndarray,
+    total_charges: np.ndarray,
+    weights: Optional[np.ndarray] = None,
+) -> np.ndarray:
+    """
+    Make the charges of each molecule in a flat batch sum exactly to its total charge.
+
+    The difference between the total charge and the sum of the charges of each molecule is spread over its atoms
+    either equally or in proportion to the weights.
+
+    Args:
+        charges: The flat array of charges for all molecules.
+        molecule_offsets: The offsets of each molecule into the flat arrays, see `get_molecule_offsets`.
+        total_charges: The target total charge of each molecule, see `get_formal_charges`.
+        weights: Optional non-negative per atom weights used to split the residual of each molecule.
+
+    Returns:
+        A new flat array of corrected charges.
+    """
+    charges = np.array(charges, dtype=np.float64).reshape(-1)
+    molecule_offsets = np.asarray(molecule_offsets, dtype=np.int64)
+    n_atoms = np.diff(molecule_offsets)
+    n_molecules = len(n_atoms)
+    molecule_index = np.repeat(np.arange(n_molecules), n_atoms)
+
+    residuals = np.asarray(total_charges, dtype=np.float64) - np.bincount(
+        molecule_index, weights=charges, minlength=n_molecules
+    )
+    if weights is None:
+        atom_fractions = 1.0 / n_atoms[molecule_index]
+    else:
+        weights = np.asarray(weights, dtype=np.float64).reshape(-1)
+        weight_totals = np.bincount(
+            molecule_index, weights=weights, minlength=n_molecules
+        )
+        if np.any(weight_totals[n_atoms > 0] <= 0):
+            raise ValueError(
+                "The weights of each molecule must sum to a positive value."
+            )
+        atom_fractions = weights / weight_totals[molecule_index]
+
+    charges += residuals[molecule_index] * atom_fractions
+    return charges
+
+
+def fix_net_charge(charges: np.ndarray, total_charge: float) -> np.ndarray:
+    """
+    Round the charges to 6 decimal places and add any remaining difference to the total charge onto the last atom.
+
+    This mirrors `qubekit.molecules.Ligand.fix_net_charge`.
+    """
+    charges = np.round(np.asarray(charges, dtype=np.float64).reshape(-1), 6)
+    last_atom = np.zeros_like(charges)
+    last_atom[-1] = 1
+    return fix_net_charges(
+        charges,
+        molecule_offsets=get_molecule_offsets([len(charges)]),
+        total_charges=[total_charge],
+        weights=last_atom,
+    )
+
+
+def equilibrate_charges(
+    electronegativity: np.ndarray,
+    hardness: np.ndarray,
+    molecule_offsets: np.ndarray,
+    total_charges: np.ndarray,
+) -> np.ndarray:
+    """
+    Compute the charges of each molecule in a flat batch from the per atom electronegativity and hardness by charge
+    equilibration, this matches the `charges` postprocess layer of nagl.
+
+    Args:
+        electronegativity: The flat array of atom electronegativities.
+        hardness: The flat array of atom hardnesses.
+        molecule_offsets: The offsets of each molecule into the flat arrays, see `get_molecule_offsets`.
+        total_charges: The total charge of each molecule, see `get_formal_charges`.
+
+    Returns:
+        The flat array of charges.
+    """
+    electronegativity = np.asarray(electronegativity, dtype=np.float64).reshape(-1)
+    inverse_hardness = 1.0 / np.asarray(hardness, dtype=np.float64).reshape(-1)
+    n_atoms = np.diff(np.asarray(molecule_offsets, dtype=np.int64))
+    molecule_index = np.repeat(np.arange(len(n_atoms)), n_atoms)
+
+    e_over_s = electronegativity * inverse_hardness
+    numerator = np.bincount(
+        molecule_index, weights=e_over_s, minlength=len(n_atoms)
+    ) + np.asarray(total_charges, dtype=np.float64)
+    denominator = np.bincount(
+        molecule_index, weights=inverse_hardness, minlength=len(n_atoms)
+    )
+    return inverse_hardness * (numerator / denominator)[molecule_index] - e_over_s
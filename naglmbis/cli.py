@@ -0,0 +1,319 @@
+"""
+Command line tools for naglmbis.
+"""
+
+import click
+
+
+@click.group()
+def cli():
+    """Tools to build and use NAGL-MBIS models and datasets."""
+
+
+def _rfree_model(value: str):
+    """Rfree models are keyed by integers or strings."""
+    return int(value) if value.isdigit() else value
+
+
+@cli.command("build-library")
+@click.option(
+    "--molecules",
+    "molecules_file",
+    type=click.Path(exists=True, dir_okay=False),
+    required=True,
+    help="An SDF or SMILES file of the molecules to parameterise.",
+)
+@click.option(
+    "--output",
+    type=click.Path(dir_okay=False),
+    required=True,
+    help="The numpy archive the parameter library should be written to.",
+)
+@click.option(
+    "--offxml",
+    type=click.Path(dir_okay=False),
+    default=None,
+    help="An optional offxml file to write the library charges to.",
+)
+@click.option("--charge-model", default="nagl-v1-mbis", show_default=True)
+@click.option(
+    "--volume-model",
+    default=None,
+    help="The registered volume model used to derive the LJ parameters.",
+)
+@click.option("--rfree-model", default="1", show_default=True)
+@click.option("--bcc-model", default=None)
+def build_library(
+    molecules_file: str,
+    output: str,
+    offxml: str,
+    charge_model: str,
+    volume_model: str,
+    rfree_model: str,
+    bcc_model: str,
+):
+    """Run the full NAGLMBIS pipeline once over a set of molecules and save the parameters as a library."""
+    from openff.toolkit.topology import Molecule
+    from openff.toolkit.typing.engines.smirnoff import ForceField
+
+    from naglmbis.plugins.library import build_parameter_library
+
+    molecules = Molecule.from_file(molecules_file, allow_undefined_stereo=True)
+    if isinstance(molecules, Molecule):
+        molecules = [molecules]
+
+    # make the handler through a force field so it gets the section version like `modify_force_field`
+    handler = ForceField(load_plugins=True).get_parameter_handler(
+        "NAGLMBIS",
+        {
+            "charge_model": charge_model,
+            "volume_model": volume_model,
+            "rfree_model": _rfree_model(rfree_model),
+            "bcc_model": bcc_model,
+        },
+    )
+    library = build_parameter_library(molecules=molecules, handler=handler)
+    library.to_file(output)
+    if offxml is not None:
+        library.to_offxml(offxml)
+    click.echo(f"Wrote the parameters of {len(library)} molecules to {output}")
+
+
+@cli.command("build-dataset")
+@click.option(
+    "--keys",
+    "key_file",
+    type=click.Path(exists=True, dir_okay=False),
+    required=True,
+    help="A key list file with the HDF5 group name of each molecule in the dataset.",
+)
+@click.option(
+    "--reference",
+    "reference_files",
+    type=click.Path(exists=True, dir_okay=False),
+    multiple=True,
+    required=True,
+    help="A reference HDF5 file which holds the molecules, can be given more than once.",
+)
+@click.option(
+    "--output",
+    type=click.Path(dir_okay=False),
+    required=True,
+    help="The parquet file the dataset should be written to.",
+)
+@click.option("--row-group-size", default=10000, show_default=True)
+@click.option(
+    "--n-workers",
+    default=1,
+    show_default=True,
+    help="The number of processes used to read the reference files.",
+)
+@click.option(
+    "--grouped",
+    is_flag=True,
+    help="Write one row per molecule with list columns of its conformations.",
+)
+def build_dataset(
+    key_file: str,
+    reference_files: tuple[str],
+    output: str,
+    row_group_size: int,
+    n_workers: int,
+    grouped: bool,
+):
+    """Stream the reference data of a dataset split into a parquet file with one row per conformation."""
+    from naglmbis.datasets.builder import build_parquet_dataset, read_key_list
+
+    n_records = build_parquet_dataset(
+        parquet_name=output,
+        keys=read_key_list(key_file),
+        reference_files=list(reference_files),
+        row_group_size=row_group_size,
+        n_workers=n_workers,
+        grouped=grouped,
+    )
+    click.echo(f"Wrote {n_records} conformations to {output}")
+
+
+@cli.command("split-dataset")
+@click.option(
+    "--reference",
+    "reference_files",
+    type=click.Path(exists=True, dir_okay=False),
+    multiple=True,
+    required=True,
+    help="A reference HDF5 file with molecules to split, can be given more than once.",
+)
+@click.option(
+    "--output-dir",
+    type=click.Path(file_okay=False),
+    required=True,
+    help="The directory the train, valid and test key lists should be written to.",
+)
+@click.option(
+    "--fractions",
+    type=(float, float, float),
+    default=(0.8, 0.1, 0.1),
+    show_default=True,
+    help="The fraction of molecules in the train, valid and test sets.",
+)
+@click.option(
+    "--method",
+    type=click.Choice(["maxmin", "scaffold", "butina"]),
+    default="maxmin",
+    show_default=True,
+    help="Pick diverse molecules, keep scaffolds together or keep similarity clusters together.",
+)
+@click.option(
+    "--similarity-threshold",
+    default=0.6,
+    show_default=True,
+    help="The Tanimoto similarity cutoff of the butina clusters.",
+)
+@click.option("--seed", default=42, show_default=True)
+@click.option(
+    "--fingerprint-cache",
+    type=click.Path(dir_okay=False),
+    default=None,
+    help="A parquet file the fingerprints are cached in between splits.",
+)
+@click.option(
+    "--n-workers",
+    default=1,
+    show_default=True,
+    help="The number of processes used to compute fingerprints and scaffolds.",
+)
+def split_dataset(
+    reference_files: tuple[str],
+    output_dir: str,
+    fractions: tuple[float, float, float],
+    method: str,
+    similarity_threshold: float,
+    seed: int,
+    fingerprint_cache: str,
+    n_workers: int,
+):
+    """Split the reference molecules into train, valid and test sets and write a key list for each."""
+    from naglmbis.datasets.splitting import (
+        butina_split,
+        compute_scaffolds,
+        load_fingerprints,
+        maxmin_split,
+        read_reference_smiles,
+        scaffold_split,
+        write_split_key_lists,
+    )
+
+    reference_smiles = read_reference_smiles(list(reference_files))
+    if method == "scaffold":
+        scaffolds = compute_scaffolds(
+            list(reference_smiles.values()), n_workers=n_workers
+        )
+        splits = scaffold_split(scaffolds, fractions=fractions)
+    else:
+        fingerprints = load_fingerprints(
+            reference_smiles, cache_file=fingerprint_cache, n_workers=n_workers
+        )
+        if method == "maxmin":
+            splits = maxmin_split(fingerprints, fractions=fractions, seed=seed)
+        else:
+            splits = butina_split(
+                fingerprints,
+                fractions=fractions,
+                threshold=similarity_threshold,
+                seed=seed,
+            )
+    key_files = write_split_key_lists(output_dir, list(reference_smiles), splits)
+    for (name, key_file), split in zip(key_files.items(), splits):
+        click.echo(f"Wrote {len(split)} {name} molecules to {key_file}")
+
+
+@cli.command("dataset-report")
+@click.argument(
+    "datasets", nargs=-1, required=True, type=click.Path(exists=True, dir_okay=False)
+)
+@click.option(
+    "--output-json",
+    type=click.Path(dir_okay=False),
+    default=None,
+    help="The json file the report should be written to.",
+)
+@click.option(
+    "--output-markdown",
+    type=click.Path(dir_okay=False),
+    default=None,
+    help="The markdown file the report should be written to, by default it is printed.",
+)
+@click.option(
+    "--descriptor-cache",
+    type=click.Path(dir_okay=False),
+    default=None,
+    help="A parquet file the molecule descriptors are cached in between reports.",
+)
+@click.option("--charge-column", default="mbis-charges", show_default=True)
+@click.option(
+    "--n-workers",
+    default=1,
+    show_default=True,
+    help="The number of processes used to compute descriptors.",
+)
+def dataset_report(
+    datasets: tuple[str],
+    output_json: str,
+    output_markdown: str,
+    descriptor_cache: str,
+    charge_column: str,
+    n_workers: int,
+):
+    """Summarise the molecules, elements, total charges and element charge ranges of parquet datasets."""
+    from naglmbis.datasets.report import (
+        build_report,
+        report_to_markdown,
+        write_report_json,
+    )
+
+    report = build_report(
+        list(datasets),
+        descriptor_cache=descriptor_cache,
+        charge_column=charge_column,
+        n_workers=n_workers,
+    )
+    if output_json is not None:
+        write_report_json(report, output_json)
+    markdown = report_to_markdown(report)
+    if output_markdown is not None:
+        with open(output_markdown, "w") as output:
+            output.write(markdown)
+    else:
+        click.echo(markdown)
+
+
+@cli.command("clean-feature-cache")
+@click.option(
+    "--cache-dir",
+    type=click.Path(exists=True, file_okay=False),
+    required=True,
+    help="The feature cache directory used for training.",
+)
+@click.option(
+    "--max-age-days",
+    type=float,
+    default=None,
+    help="Also remove entries which have not been used for this many days.",
+)
+@click.option(
+    "--dry-run", is_flag=True, help="List the stale entries without removing them."
+)
+def clean_feature_cache(cache_dir: str, max_age_days: float, dry_run: bool):
+    """Remove feature cache entries whose datasets have changed or been deleted."""
+    from naglmbis.training.cache import FeatureCache
+
+    stale = FeatureCache(cache_dir).collect_garbage(
+        max_age_days=max_age_days, dry_run=dry_run
+    )
+    for entry_dir in stale:
+        click.echo(f"{'Stale' if dry_run else 'Removed'} {entry_dir}")
+
+
+if __name__ == "__main__":
+    cli()
@@ -0,0 +1,25 @@
+from naglmbis.datasets.builder import (
+    DATASET_SCHEMA,
+    GROUPED_DATASET_SCHEMA,
+    ParquetDatasetWriter,
+    build_parquet_dataset,
+    read_key_list,
+    write_key_list,
+)
+from naglmbis.datasets.data_module import (
+    GroupedDataModule,
+    GroupedMBISGraphModel,
+    GroupedMoleculeDataset,
+)
+
+__all__ = [
+    DATASET_SCHEMA,
+    GROUPED_DATASET_SCHEMA,
+    ParquetDatasetWriter,
+    build_parquet_dataset,
+    read_key_list,
+    write_key_list,
+    GroupedDataModule,
+    GroupedMBISGraphModel,
+    GroupedMoleculeDataset,
+]
@@ -0,0 +1,335 @@
+"""
+Build parquet training datasets from the reference HDF5 files while only holding one row group in memory.
+"""
+
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterable, Iterator, Optional
+
+import h5py
+import numpy as np
+import pyarrow
+import pyarrow.parquet
+from rdkit import Chem
+
+# the reference conformations are stored in angstrom and the datasets in bohr
+ANGSTROM_TO_BOHR = 1.8897261246257702
+
+DATASET_SCHEMA = pyarrow.schema(
+    [
+        ("smiles", pyarrow.string()),
+        ("conformation", pyarrow.list_(pyarrow.float32())),
+        ("dipole", pyarrow.list_(pyarrow.float32(), 3)),
+        ("mbis-charges", pyarrow.list_(pyarrow.float32())),
+        ("mbis-volumes", pyarrow.list_(pyarrow.float32())),
+    ]
+)
+
+# one row per molecule where each column holds the values of every conformation of the molecule
+GROUPED_DATASET_SCHEMA = pyarrow.schema(
+    [("smiles", pyarrow.string())]
+    + [
+        (name, pyarrow.list_(DATASET_SCHEMA.field(name).type))
+        for name in DATASET_SCHEMA.names[1:]
+    ]
+)
+
+
+def read_key_list(file_name: str) -> list[str]:
+    """Read a key list file with one HDF5 group name per line."""
+    with open(file_name) as key_file:
+        return [line.strip() for line in key_file if line.strip()]
+
+
+def write_key_list(file_name: str, keys: Iterable[str]):
+    """Write a key list file with one HDF5 group name per line."""
+    with open(file_name, "w") as key_file:
+        key_file.writelines(f"{key}\n" for key in keys)
+
+
+def molecule_from_smiles(smiles: str) -> Chem.Mol:
+    """Build a molecule from an explicit hydrogen smiles, mapped smiles are put into map index order."""
+    params = Chem.SmilesParserParams()
+    params.removeHs = False
+    molecule = Chem.MolFromSmiles(smiles, params)
+    map_indices = [atom.GetAtomMapNum() for atom in molecule.GetAtoms()]
+    if all(map_index > 0 for map_index in map_indices):
+        order = sorted(range(len(map_indices)), key=lambda i: map_indices[i])
+        molecule = Chem.RenumberAtoms(molecule, order)
+        for atom in molecule.GetAtoms():
+            atom.SetAtomMapNum(0)
+    return molecule
+
+
+def read_molecule_group(group: h5py.Group) -> dict[str, np.ndarray]:
+    """
+    Read the reference data of every conformation of one molecule.
+
+    Returns:
+        The smiles and the per conformation arrays of the molecule, with the conformations flattened and in bohr.
+    """
+    charges = group["mbis-charges"][()]
+    n_conformations = charges.shape[0]
+    return {
+        "smiles": group["smiles"].asstr()[0],
+        "conformation": (group["conformations"][()] * ANGSTROM_TO_BOHR).reshape(
+            n_conformations, -1
+        ),
+        "dipole": group["dipole"][()].reshape(n_conformations, 3),
+        "mbis-charges": charges.reshape(n_conformations, -1),
+        "mbis-volumes": group["mbis-volumes"][()].reshape(n_conformations, -1),
+    }
+
+
+def _to_list_array(values: list[np.ndarray], list_size: Optional[int] = None):
+    """Build a float32 list array from the rows of a list of 2D arrays without going through python objects."""
+    flat_values = pyarrow.array(
+        np.concatenate([rows.reshape(-1) for rows in values]).astype(np.float32)
+    )
+    if list_size is not None:
+        return pyarrow.FixedSizeListArray.from_arrays(flat_values, list_size)
+    row_lengths = np.concatenate(
+        [np.full(len(rows), rows.shape[1], dtype=np.int32) for rows in values]
+    )
+    offsets = np.zeros(len(row_lengths) + 1, dtype=np.int32)
+    np.cumsum(row_lengths, out=offsets[1:])
+    return pyarrow.ListArray.from_arrays(pyarrow.array(offsets), flat_values)
+
+
+class ParquetDatasetWriter:
+    """
+    Stream molecules into a parquet file with one row per conformation, or one row per molecule in the grouped
+    layout, rows are buffered until a row group is full and then written so the peak memory only depends on the
+    row group size.
+    """
+
+    def __init__(
+        self, file_name: str, row_group_size: int = 10000, grouped: bool = False
+    ):
+        """
+        Args:
+            file_name: The parquet file to write.
+            row_group_size: The number of conformations written in each row group.
+            grouped: If the dataset should have one row per molecule with list columns of its conformations.
+        """
+        self.row_group_size = row_group_size
+        self.grouped = grouped
+        self.schema = GROUPED_DATASET_SCHEMA if grouped else DATASET_SCHEMA
+        self.n_records = 0
+        self._writer = pyarrow.parquet.ParquetWriter(file_name, self.schema)
+        self._buffer: list[dict[str, np.ndarray]] = []
+        self._n_buffered = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def add_molecule(self, molecule_data: dict[str, np.ndarray]):
+        """Add every conformation of a molecule made by `read_molecule_group`."""
+        self._buffer.append(molecule_data)
+        self._n_buffered += len(molecule_data["mbis-charges"])
+        if self._n_buffered >= self.row_group_size:
+            self.flush()
+
+    def flush(self):
+        """Write the buffered conformations as a row group."""
+        if not self._buffer:
+            return
+        n_conformations = [
+            len(molecule_data["mbis-charges"]) for molecule_data in self._buffer
+        ]
+        smiles = [molecule_data["smiles"] for molecule_data in self._buffer]
+        if not self.grouped:
+            smiles = np.repeat(smiles, n_conformations).tolist()
+        columns = [pyarrow.array(smiles, type=pyarrow.string())]
+        conformation_offsets = np.zeros(len(n_conformations) + 1, dtype=np.int32)
+        np.cumsum(n_conformations, out=conformation_offsets[1:])
+        for name in DATASET_SCHEMA.names[1:]:
+            column = _to_list_array(
+                [molecule_data[name] for molecule_data in self._buffer],
+                list_size=3 if name == "dipole" else None,
+            )
+            if self.grouped:
+                column = pyarrow.ListArray.from_arrays(
+                    pyarrow.array(conformation_offsets), column
+                )
+            columns.append(column)
+        self._writer.write_batch(
+            pyarrow.RecordBatch.from_arrays(columns, schema=self.schema)
+        )
+        self.n_records += self._n_buffered
+        self._buffer, self._n_buffered = [], 0
+
+    def close(self):
+        self.flush()
+        self._writer.close()
+
+
+def build_key_index(reference_files: list[str]) -> dict[str, tuple[int, int]]:
+    """
+    Scan the top level groups of each reference file once.
+
+    Returns:
+        The index of the file and the on-disk address of the group of every key, when a key is in more than one
+        file the first file is used.
+    """
+    key_index = {}
+    for file_index, file_name in enumerate(reference_files):
+        with h5py.File(file_name, "r") as dataset:
+            for key in dataset.keys():
+                if key not in key_index:
+                    address = h5py.h5o.get_info(dataset.id, key.encode()).addr
+                    key_index[key] = (file_index, address)
+    return key_index
+
+
+def get_read_plan(
+    keys: Iterable[str], key_index: dict[str, tuple[int, int]], chunk_size: int
+) -> list[tuple[int, list[str]]]:
+    """
+    Order the keys by file and on-disk address so each file is read sequentially and split them into chunks.
+
+    Returns:
+        The file index and keys of each chunk of reads.
+
+    Raises:
+        KeyError: If a key is not in any of the reference files.
+    """
+    file_keys = {}
+    for key in keys:
+        if key not in key_index:
+            raise KeyError(f"The key {key} is not in any of the reference files.")
+        file_index, address = key_index[key]
+        file_keys.setdefault(file_index, []).append((address, key))
+
+    read_plan = []
+    for file_index in sorted(file_keys):
+        sorted_keys = [key for _, key in sorted(file_keys[file_index])]
+        for start in range(0, len(sorted_keys), chunk_size):
+            read_plan.append((file_index, sorted_keys[start : start + chunk_size]))
+    return read_plan
+
+
+def _read_molecule_groups(
+    file_name: str, keys: list[str]
+) -> list[dict[str, np.ndarray]]:
+    """Read a chunk of molecules from one reference file."""
+    with h5py.File(file_name, "r") as dataset:
+        return [read_molecule_group(dataset[key]) for key in keys]
+
+
+def iter_molecule_groups(
+    keys: Iterable[str],
+    reference_files: list[str],
+    n_workers: int = 1,
+    chunk_size: int = 1000,
+) -> Iterator[dict[str, np.ndarray]]:
+    """
+    Read the molecules of the keys from the reference HDF5 files, the molecules are read in file and on-disk order
+    rather than key order.
+
+    Args:
+        keys: The HDF5 group names of the molecules to read.
+        reference_files: The reference HDF5 files which hold the molecules.
+        n_workers: The number of reader processes, only a few chunks per worker are held in memory at once.
+        chunk_size: The number of molecules read by a worker at a time.
+
+    Raises:
+        KeyError: If a key is not in any of the reference files.
+    """
+    read_plan = get_read_plan(keys, build_key_index(reference_files), chunk_size)
+    if n_workers <= 1:
+        for file_index, chunk_keys in read_plan:
+            yield from _read_molecule_groups(reference_files[file_index], chunk_keys)
+        return
+
+    with ProcessPoolExecutor(max_workers=n_workers) as pool:
+        pending = deque()
+        for file_index, chunk_keys in read_plan:
+            pending.append(
+                pool.submit(
+                    _read_molecule_groups, reference_files[file_index], chunk_keys
+                )
+            )
+            if len(pending) >= 2 * n_workers:
+                yield from pending.popleft().result()
+        while pending:
+            yield from pending.popleft().result()
+
+
+def build_parquet_dataset(
+    parquet_name: str,
+    keys: Iterable[str],
+    reference_files: list[str],
+    row_group_size: int = 10000,
+    n_workers: int = 1,
+    grouped: bool = False,
+) -> int:
+    """
+    Build a parquet dataset with one row per conformation of the molecules in the key list, the rows are written
+    in the on-disk order of the reference files.
+
+    Args:
+        parquet_name: The parquet file to write.
+        keys: The HDF5 group names of the molecules in the dataset.
+        reference_files: The reference HDF5 files which hold the molecules.
+        row_group_size: The number of conformations held in memory and written in each row group.
+        n_workers: The number of processes used to read the reference files.
+        grouped: If the dataset should have one row per molecule with list columns of its conformations, see
+            `GROUPED_DATASET_SCHEMA`.
+
+    Returns:
+        The number of conformations written.
+    """
+    with ParquetDatasetWriter(
+        parquet_name, row_group_size=row_group_size, grouped=grouped
+    ) as writer:
+        for molecule_data in iter_molecule_groups(
+            keys, reference_files, n_workers=n_workers
+        ):
+            writer.add_molecule(molecule_data)
+    return writer.n_records
+
+
+def _split_grouped_column(column: pyarrow.ListArray) -> list[np.ndarray]:
+    """Split a grouped list column into an (n_conformations, n_values) array for each molecule."""
+    molecule_offsets = column.offsets.to_numpy()
+    molecule_offsets = molecule_offsets - molecule_offsets[0]
+    conformations = column.flatten()
+    if pyarrow.types.is_fixed_size_list(conformations.type):
+        value_offsets = np.arange(len(conformations) + 1) * conformations.type.list_size
+    else:
+        value_offsets = conformations.offsets.to_numpy()
+        value_offsets = value_offsets - value_offsets[0]
+    values = conformations.flatten().to_numpy()
+    return [
+        values[value_offsets[start] : value_offsets[end]].reshape(end - start, -1)
+        for start, end in zip(molecule_offsets[:-1], molecule_offsets[1:])
+    ]
+
+
+def iter_grouped_molecules(
+    paths: list[str], columns: list[str]
+) -> Iterator[tuple[str, dict[str, np.ndarray]]]:
+    """
+    Read the molecules of grouped datasets one row group at a time.
+
+    Args:
+        paths: The grouped parquet datasets to read.
+        columns: The label columns to read.
+
+    Returns:
+        The smiles and the (n_conformations, n_values) array of each label column of each molecule.
+    """
+    for path in paths:
+        parquet_file = pyarrow.parquet.ParquetFile(path)
+        for batch in parquet_file.iter_batches(columns=["smiles", *columns]):
+            column_values = {
+                name: _split_grouped_column(batch.column(name)) for name in columns
+            }
+            for i, smiles in enumerate(batch.column("smiles").to_pylist()):
+                yield smiles, {
+                    name: values[i] for name, values in column_values.items()
+                }
@@ -0,0 +1,358 @@
+"""
+Train on grouped datasets where each molecule is featurized once and its losses are taken over all conformations.
+"""
+
+import functools
+import pathlib
+from typing import Optional, Union
+
+import numpy as np
+import pytorch_lightning as pl
+import torch
+from nagl.config import Config
+from nagl.config.data import Dataset, DipoleTarget
+from nagl.molecules import DGLMolecule, DGLMoleculeBatch
+from torch.utils.data import DataLoader
+
+from naglmbis.datasets.builder import iter_grouped_molecules, molecule_from_smiles
+from naglmbis.models.base_model import MBISGraphModel
+from naglmbis.models.featurize import expand_packed_features, molecule_to_dgl
+
+# the extra labels of a batch which map each conformation atom row to its atom and conformation in the batch
+ATOM_INDEX = "atom-index"
+CONFORMATION_INDEX = "conformation-index"
+
+_METRICS = {
+    "rmse": lambda predicted, reference: torch.sqrt(
+        torch.mean((predicted - reference) ** 2)
+    ),
+    "mse": lambda predicted, reference: torch.mean((predicted - reference) ** 2),
+    "mae": lambda predicted, reference: torch.mean(torch.abs(predicted - reference)),
+}
+
+
+def get_target_columns(targets: list) -> tuple[list[str], list[str]]:
+    """
+    Get the label columns needed by the targets.
+
+    Returns:
+        The columns with values for every atom and the columns with values for each conformation.
+    """
+    atom_columns, conformation_columns = [], []
+    for target in targets:
+        if isinstance(target, DipoleTarget):
+            atom_columns.append(target.conformation_column)
+            conformation_columns.append(target.dipole_column)
+        else:
+            atom_columns.append(target.column)
+    return list(dict.fromkeys(atom_columns)), list(dict.fromkeys(conformation_columns))
+
+
+class GroupedMoleculeDataset(torch.utils.data.Dataset):
+    """
+    A dataset with one entry per molecule holding its featurized graph and the labels of all of its conformations,
+    the per atom labels have shape (n_conformations, n_atoms, n_values) and the others (n_conformations, n_values).
+    """
+
+    def __init__(self, entries: list[tuple[DGLMolecule, dict[str, torch.Tensor]]]):
+        self.entries = entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __getitem__(self, index: int) -> tuple[DGLMolecule, dict[str, torch.Tensor]]:
+        return self.entries[index]
+
+    def get_molecule_sizes(self) -> tuple[np.ndarray, np.ndarray]:
+        """Get the number of atoms and graph edges, two per bond, of every molecule."""
+        n_atoms = [molecule.graph.num_nodes() for molecule, _ in self.entries]
+        n_edges = [
+            molecule.graph.num_edges("forward") + molecule.graph.num_edges("reverse")
+            for molecule, _ in self.entries
+        ]
+        return np.array(n_atoms, dtype=np.int64), np.array(n_edges, dtype=np.int64)
+
+    @classmethod
+    def from_grouped(
+        cls,
+        paths: list[str],
+        targets: list,
+        atom_features: list,
+        bond_features: list,
+    ) -> "GroupedMoleculeDataset":
+        """Featurize each molecule of grouped parquet datasets once."""
+        atom_columns, conformation_columns = get_target_columns(targets)
+        entries = []
+        for smiles, values in iter_grouped_molecules(
+            paths, atom_columns + conformation_columns
+        ):
+            molecule = molecule_from_smiles(smiles)
+            n_atoms = molecule.GetNumAtoms()
+            labels = {
+                name: torch.from_numpy(values[name]).reshape(
+                    len(values[name]), n_atoms, -1
+                )
+                for name in atom_columns
+            }
+            labels.update(
+                {name: torch.from_numpy(values[name]) for name in conformation_columns}
+            )
+            entries.append(
+                (molecule_to_dgl(molecule, atom_features, bond_features), labels)
+            )
+        return cls(entries)
+
+
+def collate_grouped(
+    entries: list[tuple[DGLMolecule, dict[str, torch.Tensor]]],
+) -> tuple[DGLMoleculeBatch, dict[str, torch.Tensor]]:
+    """
+    Batch the molecules of a grouped dataset, the per atom labels are flattened to one row per atom of each
+    conformation and indexed back to the batch atoms and conformations with the `ATOM_INDEX` and
+    `CONFORMATION_INDEX` labels.
+    """
+    molecules, molecule_labels = zip(*entries)
+    atom_index, conformation_index = [], []
+    n_batch_atoms, n_batch_conformations = 0, 0
+    for molecule, labels in entries:
+        n_atoms = molecule.graph.num_nodes()
+        n_conformations = len(next(iter(labels.values())))
+        atom_index.append(
+            torch.arange(n_batch_atoms, n_batch_atoms + n_atoms).repeat(n_conformations)
+        )
+        conformation_index.append(
+            torch.arange(
+                n_batch_conformations, n_batch_conformations + n_conformations
+            ).repeat_interleave(n_atoms)
+        )
+        n_batch_atoms += n_atoms
+        n_batch_conformations += n_conformations
+
+    batch_labels = {
+        name: torch.cat(
+            [
+                labels[name].reshape(-1, labels[name].shape[-1])
+                for labels in molecule_labels
+            ]
+        )
+        for name in molecule_labels[0]
+    }
+    batch_labels[ATOM_INDEX] = torch.cat(atom_index)
+    batch_labels[CONFORMATION_INDEX] = torch.cat(conformation_index)
+    return DGLMoleculeBatch(*molecules), batch_labels
+
+
+def evaluate_grouped_targets(
+    targets: list,
+    predictions: dict[str, torch.Tensor],
+    labels: dict[str, torch.Tensor],
+) -> dict[str, torch.Tensor]:
+    """
+    Evaluate the loss of each target over every conformation in a batch made by `collate_grouped`.
+
+    The dipole of each conformation is predicted from the single set of predicted charges of its molecule, so
+    every conformation of a molecule contributes to the loss without the molecule being featurized again.
+
+    Returns:
+        The weighted loss of each target keyed by the target column.
+    """
+    atom_index, conformation_index = labels[ATOM_INDEX], labels[CONFORMATION_INDEX]
+    losses = {}
+    for target in targets:
+        if isinstance(target, DipoleTarget):
+            charges = predictions[target.charge_label].reshape(-1)[atom_index]
+            reference = labels[target.dipole_column]
+            predicted = torch.zeros_like(reference).index_add_(
+                0,
+                conformation_index,
+                labels[target.conformation_column] * charges[:, None],
+            )
+            name = target.dipole_column
+        else:
+            reference = labels[target.column]
+            predicted = predictions[target.readout].reshape(-1, reference.shape[-1])[
+                atom_index
+            ]
+            name = target.column
+        loss = _METRICS[target.metric](predicted, reference)
+        losses[name] = loss * getattr(target, "weight", 1.0) / target.denominator
+    return losses
+
+
+class GroupedMBISGraphModel(MBISGraphModel):
+    """An MBIS model which trains on batches of grouped datasets made by `GroupedDataModule`."""
+
+    @functools.cached_property
+    def binary_columns(self) -> torch.Tensor:
+        """The mask of the atom feature columns which are packed as bits in a feature store."""
+        from naglmbis.training.feature_store import get_binary_columns
+
+        atom_features = self.config.model.atom_features
+        return torch.from_numpy(
+            get_binary_columns(
+                atom_features, [len(feature) for feature in atom_features]
+            )
+        )
+
+    def _grouped_step(
+        self,
+        batch: tuple[DGLMoleculeBatch, dict[str, torch.Tensor]],
+        step_type: str,
+    ) -> torch.Tensor:
+        molecules, labels = batch
+        # batches from a feature store are expanded to floats here, just before the first layer
+        expand_packed_features(molecules, self.binary_columns)
+        dataset_config = {
+            "train": self.config.data.training,
+            "val": self.config.data.validation,
+            "test": self.config.data.test,
+        }[step_type]
+        losses = evaluate_grouped_targets(
+            dataset_config.targets, self.forward(molecules), labels
+        )
+        loss = torch.stack(list(losses.values())).sum()
+        # the number of conformations in the batch
+        batch_size = int(labels[CONFORMATION_INDEX][-1]) + 1
+        for name, value in losses.items():
+            self.log(f"{step_type}/{name}", value, batch_size=batch_size)
+        self.log(f"{step_type}/loss", loss, batch_size=batch_size)
+        return loss
+
+    def training_step(self, train_batch, batch_idx):
+        return self._grouped_step(train_batch, "train")
+
+    def validation_step(self, val_batch, batch_idx):
+        return self._grouped_step(val_batch, "val")
+
+    def test_step(self, test_batch, batch_idx):
+        return self._grouped_step(test_batch, "test")
+
+
+class GroupedDataModule(pl.LightningDataModule):
+    """
+    A data module for grouped datasets, made with `build_parquet_dataset(..., grouped=True)`, which featurizes
+    each molecule once however many conformations it has.
+    """
+
+    def __init__(
+        self,
+        config: Config,
+        cache_dir: Optional[Union[str, pathlib.Path]] = None,
+        n_workers: int = 0,
+        max_atoms: Optional[int] = None,
+        max_edges: Optional[int] = None,
+        bucket_size: Optional[int] = None,
+    ):
+        """
+        Args:
+            config: The model and data config, the sources of each dataset must be grouped parquet files.
+            cache_dir: The feature cache directory the featurized datasets are stored in as memory-mapped
+                feature stores, keyed by the atom features and the dataset contents so they are shared by any
+                config with the same features. The stores only hold atom features so models with bond features
+                are featurized in memory.
+            n_workers: The number of data loader workers.
+            max_atoms: Batch molecules of similar size with at most this many atoms in a batch, in place of the
+                fixed batch sizes of the dataset configs, see `SizeBucketBatchSampler`. The sampler shares the
+                batches between processes itself so distributed trainers need `use_distributed_sampler=False`.
+            max_edges: The most graph edges in a batch when batching by size.
+            bucket_size: The number of molecules sorted by size together when batching by size, by default the
+                whole dataset. Setting it lets the number of batches change between epochs.
+        """
+        super().__init__()
+        self.config = config
+        self.cache_dir = None if cache_dir is None else pathlib.Path(cache_dir)
+        self.n_workers = n_workers
+        self.max_atoms = max_atoms
+        self.max_edges = max_edges
+        self.bucket_size = bucket_size
+        self._datasets: dict[str, torch.utils.data.Dataset] = {}
+
+    def _get_dataset_configs(self) -> dict[str, Dataset]:
+        dataset_configs = {
+            "train": self.config.data.training,
+            "val": self.config.data.validation,
+            "test": self.config.data.test,
+        }
+        return {
+            stage: dataset_config
+            for stage, dataset_config in dataset_configs.items()
+            if dataset_config is not None
+        }
+
+    def _featurize(self, dataset_config: Dataset) -> GroupedMoleculeDataset:
+        return GroupedMoleculeDataset.from_grouped(
+            paths=dataset_config.sources,
+            targets=dataset_config.targets,
+            atom_features=self.config.model.atom_features,
+            bond_features=self.config.model.bond_features,
+        )
+
+    @property
+    def _use_feature_store(self) -> bool:
+        return self.cache_dir is not None and len(self.config.model.bond_features) == 0
+
+    def _get_store(self, dataset_config: Dataset):
+        # the training package imports the dataset builder so is imported here to avoid a circular import
+        from naglmbis.training.cache import FeatureCache
+
+        atom_columns, conformation_columns = get_target_columns(dataset_config.targets)
+        return FeatureCache(self.cache_dir).get_store(
+            paths=dataset_config.sources,
+            atom_columns=atom_columns,
+            conformation_columns=conformation_columns,
+            atom_features=self.config.model.atom_features,
+        )
+
+    def prepare_data(self):
+        if not self._use_feature_store:
+            return
+        for dataset_config in self._get_dataset_configs().values():
+            self._get_store(dataset_config)
+
+    def setup(self, stage: Optional[str] = None):
+        from naglmbis.training import FeatureStoreDataset
+
+        for name, dataset_config in self._get_dataset_configs().items():
+            if not self._use_feature_store:
+                self._datasets[name] = self._featurize(dataset_config)
+            else:
+                # the molecules are sliced from memory-mapped arrays rather than loaded into memory
+                self._datasets[name] = FeatureStoreDataset(
+                    self._get_store(dataset_config)
+                )
+
+    def _dataloader(self, name: str, shuffle: bool) -> DataLoader:
+        dataset = self._datasets[name]
+        if self.max_atoms is not None:
+            from naglmbis.training import SizeBucketBatchSampler
+
+            batch_sampler = SizeBucketBatchSampler(
+                *dataset.get_molecule_sizes(),
+                max_atoms=self.max_atoms,
+                max_edges=self.max_edges,
+                bucket_size=self.bucket_size,
+                shuffle=shuffle,
+            )
+            return DataLoader(
+                dataset,
+                batch_sampler=batch_sampler,
+                num_workers=self.n_workers,
+                collate_fn=collate_grouped,
+            )
+        batch_size = self._get_dataset_configs()[name].batch_size
+        return DataLoader(
+            dataset,
+            batch_size=len(dataset) if batch_size is None else batch_size,
+            shuffle=shuffle,
+            num_workers=self.n_workers,
+            collate_fn=collate_grouped,
+        )
+
+    def train_dataloader(self) -> DataLoader:
+        return self._dataloader("train", shuffle=True)
+
+    def val_dataloader(self) -> DataLoader:
+        return self._dataloader("val", shuffle=False)
+
+    def test_dataloader(self) -> DataLoader:
+        return self._dataloader("test", shuffle=False)
@@ -0,0 +1,293 @@
+"""
+Summarise parquet training datasets with vectorised arrow and numpy operations.
+"""
+
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional
+
+import numpy as np
+import pyarrow
+import pyarrow.compute
+import pyarrow.parquet
+from rdkit import Chem
+from rdkit.Chem import Descriptors
+
+from naglmbis.datasets.builder import molecule_from_smiles
+
+DESCRIPTOR_SCHEMA = pyarrow.schema(
+    [
+        ("smiles", pyarrow.string()),
+        ("atomic-numbers", pyarrow.list_(pyarrow.uint8())),
+        ("total-charge", pyarrow.int32()),
+        ("molecular-weight", pyarrow.float64()),
+        ("heavy-atom-count", pyarrow.int32()),
+    ]
+)
+
+
+def _compute_descriptors(smiles: list[str]) -> list[tuple]:
+    """Compute the descriptors of a chunk of molecules in the order of `DESCRIPTOR_SCHEMA`."""
+    descriptors = []
+    for molecule_smiles in smiles:
+        molecule = molecule_from_smiles(molecule_smiles)
+        descriptors.append(
+            (
+                molecule_smiles,
+                [atom.GetAtomicNum() for atom in molecule.GetAtoms()],
+                Chem.GetFormalCharge(molecule),
+                Descriptors.MolWt(molecule),
+                Descriptors.HeavyAtomCount(molecule),
+            )
+        )
+    return descriptors
+
+
+def load_descriptors(
+    smiles: list[str],
+    cache_file: Optional[str] = None,
+    n_workers: int = 1,
+    chunk_size: int = 10000,
+) -> pyarrow.Table:
+    """
+    Get the descriptors of each unique molecule as a table with the columns of `DESCRIPTOR_SCHEMA`, molecules
+    missing from the cache are computed in parallel and added to it.
+
+    Args:
+        smiles: The smiles of the molecules.
+        cache_file: The parquet file the descriptors are cached in.
+        n_workers: The number of processes used to compute the descriptors.
+        chunk_size: The number of molecules sent to a worker at a time.
+    """
+    cached = DESCRIPTOR_SCHEMA.empty_table()
+    if cache_file is not None and os.path.exists(cache_file):
+        cached = pyarrow.parquet.read_table(cache_file, schema=DESCRIPTOR_SCHEMA)
+
+    unique_smiles = pyarrow.compute.unique(pyarrow.array(smiles, pyarrow.string()))
+    missing = pyarrow.compute.filter(
+        unique_smiles,
+        pyarrow.compute.invert(
+            pyarrow.compute.is_in(unique_smiles, value_set=cached.column("smiles"))
+        ),
+    ).to_pylist()
+    if not missing:
+        return cached
+
+    chunks = [
+        missing[start : start + chunk_size]
+        for start in range(0, len(missing), chunk_size)
+    ]
+    if n_workers > 1:
+        with ProcessPoolExecutor(max_workers=n_workers) as pool:
+            descriptors = list(pool.map(_compute_descriptors, chunks))
+    else:
+        descriptors = [_compute_descriptors(chunk) for chunk in chunks]
+    rows = [row for chunk in descriptors for row in chunk]
+    new_descriptors = pyarrow.table(
+        [
+            pyarrow.array([row[i] for row in rows], type=field.type)
+            for i, field in enumerate(DESCRIPTOR_SCHEMA)
+        ],
+        schema=DESCRIPTOR_SCHEMA,
+    )
+    descriptors = pyarrow.concat_tables([cached, new_descriptors])
+    if cache_file is not None:
+        pyarrow.parquet.write_table(descriptors, cache_file)
+    return descriptors
+
+
+def _summarise(values: np.ndarray) -> dict[str, float]:
+    if len(values) == 0:
+        return {}
+    return {
+        "mean": float(np.mean(values)),
+        "std": float(np.std(values)),
+        "min": float(np.min(values)),
+        "max": float(np.max(values)),
+    }
+
+
+def summarise_dataset(
+    file_name: str, descriptors: pyarrow.Table, charge_column: str = "mbis-charges"
+) -> dict:
+    """
+    Summarise a per conformation or grouped parquet dataset.
+
+    Args:
+        file_name: The parquet dataset.
+        descriptors: The descriptors of every molecule in the dataset, see `load_descriptors`.
+        charge_column: The per atom charge column used for the per element charge ranges.
+
+    Returns:
+        The number of molecules and conformations, the element counts, total charge counts, molecular weight and
+        heavy atom statistics of the unique molecules and the charge statistics of each element.
+    """
+    table = pyarrow.parquet.read_table(file_name, columns=["smiles", charge_column])
+    smiles = table.column("smiles").combine_chunks()
+    conformation_charges = table.column(charge_column).combine_chunks()
+    if pyarrow.types.is_list(conformation_charges.type.value_type):
+        # grouped datasets hold a list of conformations in each row
+        n_row_conformations = pyarrow.compute.list_value_length(
+            conformation_charges
+        ).to_numpy()
+        conformation_charges = conformation_charges.flatten()
+    else:
+        n_row_conformations = np.ones(len(smiles), dtype=np.int64)
+    charges = conformation_charges.flatten().to_numpy(zero_copy_only=False)
+
+    descriptor_smiles = descriptors.column("smiles").combine_chunks()
+    molecules = descriptors.take(
+        pyarrow.compute.index_in(
+            pyarrow.compute.unique(smiles), value_set=descriptor_smiles
+        )
+    )
+    atomic_numbers = (
+        molecules.column("atomic-numbers").combine_chunks().flatten().to_numpy()
+    )
+    element_counts = np.bincount(atomic_numbers)
+    total_charges, charge_counts = np.unique(
+        molecules.column("total-charge").to_numpy(), return_counts=True
+    )
+
+    # line up the atomic numbers of each row with the charges of each of its conformations
+    row_atomic_numbers = (
+        descriptors.column("atomic-numbers")
+        .combine_chunks()
+        .take(pyarrow.compute.index_in(smiles, value_set=descriptor_smiles))
+    )
+    n_row_atoms = pyarrow.compute.list_value_length(row_atomic_numbers).to_numpy()
+    n_conformation_atoms = np.repeat(n_row_atoms, n_row_conformations)
+    if not np.array_equal(
+        n_conformation_atoms,
+        pyarrow.compute.list_value_length(conformation_charges).to_numpy(),
+    ):
+        raise ValueError(
+            f"The number of {charge_column} values does not match the number of atoms of each molecule in "
+            f"{file_name}."
+        )
+    row_offsets = np.zeros(len(n_row_atoms), dtype=np.int64)
+    np.cumsum(n_row_atoms[:-1], out=row_offsets[1:])
+    conformation_starts = np.repeat(row_offsets, n_row_conformations)
+    conformation_offsets = np.cumsum(n_conformation_atoms) - n_conformation_atoms
+    atom_index = np.arange(len(charges)) + np.repeat(
+        conformation_starts - conformation_offsets, n_conformation_atoms
+    )
+    flat_atomic_numbers = row_atomic_numbers.flatten().to_numpy()
+    charge_table = pyarrow.table(
+        {"atomic-number": flat_atomic_numbers[atom_index], "charge": charges}
+    )
+    charge_statistics = charge_table.group_by("atomic-number").aggregate(
+        [
+            ("charge", "min"),
+            ("charge", "max"),
+            ("charge", "mean"),
+            ("charge", "stddev"),
+        ]
+    )
+
+    periodic_table = Chem.GetPeriodicTable()
+    charges_by_element = {}
+    for row in sorted(
+        charge_statistics.to_pylist(), key=lambda row: row["atomic-number"]
+    ):
+        charges_by_element[periodic_table.GetElementSymbol(row["atomic-number"])] = {
+            "mean": row["charge_mean"],
+            "std": row["charge_stddev"],
+            "min": row["charge_min"],
+            "max": row["charge_max"],
+        }
+
+    return {
+        "n_molecules": molecules.num_rows,
+        "n_conformations": int(n_row_conformations.sum()),
+        "elements": {
+            periodic_table.GetElementSymbol(int(atomic_number)): int(count)
+            for atomic_number, count in enumerate(element_counts)
+            if count > 0
+        },
+        "total_charges": {
+            int(charge): int(count)
+            for charge, count in zip(total_charges, charge_counts)
+        },
+        "molecular_weight": _summarise(molecules.column("molecular-weight").to_numpy()),
+        "heavy_atom_count": _summarise(molecules.column("heavy-atom-count").to_numpy()),
+        "charges_by_element": charges_by_element,
+    }
+
+
+def build_report(
+    file_names: list[str],
+    descriptor_cache: Optional[str] = None,
+    charge_column: str = "mbis-charges",
+    n_workers: int = 1,
+) -> dict[str, dict]:
+    """
+    Summarise each dataset, the descriptors of the molecules of all datasets are computed together once.
+
+    Returns:
+        The summary of each dataset keyed by the file name, see `summarise_dataset`.
+    """
+    smiles = []
+    for file_name in file_names:
+        smiles.extend(
+            pyarrow.parquet.read_table(file_name, columns=["smiles"])
+            .column("smiles")
+            .to_pylist()
+        )
+    descriptors = load_descriptors(
+        smiles, cache_file=descriptor_cache, n_workers=n_workers
+    )
+    return {
+        file_name: summarise_dataset(file_name, descriptors, charge_column)
+        for file_name in file_names
+    }
+
+
+def write_report_json(report: dict[str, dict], file_name: str):
+    with open(file_name, "w") as output:
+        json.dump(report, output, indent=2)
+
+
+def report_to_markdown(report: dict[str, dict]) -> str:
+    """Format a report made with `build_report` as markdown tables."""
+    lines = ["# Dataset report", ""]
+    for file_name, summary in report.items():
+        lines.extend(
+            [
+                f"## {file_name}",
+                "",
+                f"- Molecules: {summary['n_molecules']}",
+                f"- Conformations: {summary['n_conformations']}",
+            ]
+        )
+        for name in ["molecular_weight", "heavy_atom_count"]:
+            statistics = summary[name]
+            if statistics:
+                lines.append(
+                    f"- {name.replace('_', ' ').capitalize()}: {statistics['mean']:.2f} +/- "
+                    f"{statistics['std']:.2f} ({statistics['min']:.2f} to {statistics['max']:.2f})"
+                )
+        lines.extend(["", "| Total charge | Molecules |", "| --- | --- |"])
+        lines.extend(
+            f"| {charge} | {count} |"
+            for charge, count in summary["total_charges"].items()
+        )
+        lines.extend(
+            [
+                "",
+                "| Element | Atoms | Mean charge | Std | Min | Max |",
+                "| --- | --- | --- | --- | --- | --- |",
+            ]
+        )
+        for element, count in summary["elements"].items():
+            charges = summary["charges_by_element"].get(element)
+            if charges is None:
+                lines.append(f"| {element} | {count} | | | | |")
+                continue
+            lines.append(
+                f"| {element} | {count} | {charges['mean']:.4f} | {charges['std']:.4f} | "
+                f"{charges['min']:.4f} | {charges['max']:.4f} |"
+            )
+        lines.append("")
+    return "\n".join(lines)
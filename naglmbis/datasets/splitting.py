@@ -0,0 +1,458 @@
+"""
+Split the reference molecules into diverse training, validation and test sets written as key lists.
+"""
+
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional
+
+import h5py
+import numpy as np
+import pyarrow
+import pyarrow.parquet
+from rdkit import Chem, DataStructs
+from rdkit.Chem import rdFingerprintGenerator
+from rdkit.Chem.Scaffolds import MurckoScaffold
+from rdkit.SimDivFilters import rdSimDivPickers
+
+from naglmbis.datasets.builder import write_key_list
+
+SPLIT_NAMES = ("train", "valid", "test")
+
+
+def read_reference_smiles(reference_files: list[str]) -> dict[str, str]:
+    """Get the smiles of every molecule in the reference HDF5 files keyed by the group name."""
+    reference_smiles = {}
+    for file_name in reference_files:
+        with h5py.File(file_name, "r") as dataset:
+            for key, group in dataset.items():
+                reference_smiles.setdefault(key, group["smiles"].asstr()[0])
+    return reference_smiles
+
+
+def _compute_fingerprints(smiles: list[str], radius: int, n_bits: int) -> list[bytes]:
+    """Compute the binary heavy atom Morgan fingerprints of a chunk of molecules."""
+    generator = rdFingerprintGenerator.GetMorganGenerator(radius=radius, fpSize=n_bits)
+    # explicit hydrogens are removed when parsing
+    return [
+        generator.GetFingerprint(Chem.MolFromSmiles(molecule)).ToBinary()
+        for molecule in smiles
+    ]
+
+
+def compute_fingerprints(
+    smiles: list[str],
+    radius: int = 2,
+    n_bits: int = 1024,
+    n_workers: int = 1,
+    chunk_size: int = 10000,
+) -> list[DataStructs.ExplicitBitVect]:
+    """
+    Compute the heavy atom Morgan fingerprints of the molecules in parallel, the defaults match the fingerprints
+    of the DeepChem `MaxMinSplitter` so the splits can be compared.
+
+    Args:
+        smiles: The smiles of each molecule.
+        radius: The radius of the fingerprint.
+        n_bits: The length of the fingerprint.
+        n_workers: The number of processes used to compute the fingerprints.
+        chunk_size: The number of molecules sent to a worker at a time.
+    """
+    chunks = [
+        smiles[start : start + chunk_size]
+        for start in range(0, len(smiles), chunk_size)
+    ]
+    if n_workers > 1:
+        with ProcessPoolExecutor(max_workers=n_workers) as pool:
+            binaries = pool.map(
+                _compute_fingerprints,
+                chunks,
+                [radius] * len(chunks),
+                [n_bits] * len(chunks),
+            )
+            binaries = list(binaries)
+    else:
+        binaries = [_compute_fingerprints(chunk, radius, n_bits) for chunk in chunks]
+    return [
+        DataStructs.ExplicitBitVect(binary) for chunk in binaries for binary in chunk
+    ]
+
+
+def load_fingerprints(
+    reference_smiles: dict[str, str],
+    cache_file: Optional[str] = None,
+    radius: int = 2,
+    n_bits: int = 1024,
+    n_workers: int = 1,
+) -> list[DataStructs.ExplicitBitVect]:
+    """
+    Get the fingerprints of the molecules using an on-disk cache, only molecules missing from the cache or whose
+    smiles has changed are computed and the cache is rewritten when any are added.
+
+    Args:
+        reference_smiles: The smiles of each molecule keyed by the group name.
+        cache_file: The parquet file the fingerprints are cached in.
+        radius: The radius of the fingerprint.
+        n_bits: The length of the fingerprint.
+        n_workers: The number of processes used to compute the fingerprints.
+
+    Returns:
+        The fingerprint of each molecule in the order of `reference_smiles`.
+    """
+    metadata = {
+        b"radius": str(radius).encode(),
+        b"n_bits": str(n_bits).encode(),
+        b"atoms": b"heavy",
+    }
+    # the smiles and binary fingerprint of each cached molecule keyed by the group name
+    cached = {}
+    if cache_file is not None and os.path.exists(cache_file):
+        table = pyarrow.parquet.read_table(cache_file)
+        cache_metadata = table.schema.metadata or {}
+        if all(cache_metadata.get(key) == value for key, value in metadata.items()):
+            cached = {
+                key: (smiles, fingerprint)
+                for key, smiles, fingerprint in zip(
+                    table.column("key").to_pylist(),
+                    table.column("smiles").to_pylist(),
+                    table.column("fingerprint").to_pylist(),
+                )
+            }
+
+    # a key reused for a different molecule, for example by an updated reference file, is recomputed
+    missing = [
+        key
+        for key, smiles in reference_smiles.items()
+        if key not in cached or cached[key][0] != smiles
+    ]
+    if missing:
+        new_fingerprints = compute_fingerprints(
+            [reference_smiles[key] for key in missing],
+            radius=radius,
+            n_bits=n_bits,
+            n_workers=n_workers,
+        )
+        cached.update(
+            {
+                key: (reference_smiles[key], fingerprint.ToBinary())
+                for key, fingerprint in zip(missing, new_fingerprints)
+            }
+        )
+        if cache_file is not None:
+            smiles, fingerprints = zip(*cached.values())
+            table = pyarrow.table(
+                {
+                    "key": pyarrow.array(list(cached), type=pyarrow.string()),
+                    "smiles": pyarrow.array(smiles, type=pyarrow.string()),
+                    "fingerprint": pyarrow.array(fingerprints, type=pyarrow.binary()),
+                }
+            )
+            pyarrow.parquet.write_table(
+                table.replace_schema_metadata(metadata), cache_file
+            )
+
+    return [DataStructs.ExplicitBitVect(cached[key][1]) for key in reference_smiles]
+
+
+def get_split_sizes(
+    n_molecules: int, fractions: tuple[float, float, float]
+) -> tuple[int, int, int]:
+    """
+    Get the number of molecules in each split, the training set takes any rounding remainder.
+
+    Raises:
+        ValueError: If the fractions do not sum to one.
+    """
+    if not np.isclose(sum(fractions), 1.0):
+        raise ValueError(f"The split fractions {fractions} must sum to 1.")
+    n_valid = int(fractions[1] * n_molecules)
+    n_test = int(fractions[2] * n_molecules)
+    return n_molecules - n_valid - n_test, n_valid, n_test
+
+
+def maxmin_split(
+    fingerprints: list[DataStructs.ExplicitBitVect],
+    fractions: tuple[float, float, float] = (0.8, 0.1, 0.1),
+    seed: int = 42,
+) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Split the molecules by MaxMin diversity picking with the RDKit lazy picker, the test set is picked first and
+    the validation set continues the picking from it so both are spread across the chemical space and the
+    remaining molecules form the training set.
+
+    Returns:
+        The sorted indices of the training, validation and test molecules.
+    """
+    _, n_valid, n_test = get_split_sizes(len(fingerprints), fractions)
+    picks = []
+    if n_valid + n_test > 0:
+        picks = list(
+            rdSimDivPickers.MaxMinPicker().LazyBitVectorPick(
+                fingerprints, len(fingerprints), n_valid + n_test, seed=seed
+            )
+        )
+    test = np.sort(np.array(picks[:n_test], dtype=np.int64))
+    valid = np.sort(np.array(picks[n_test:], dtype=np.int64))
+    train = np.setdiff1d(np.arange(len(fingerprints)), picks)
+    return train, valid, test
+
+
+def _compute_scaffolds(smiles: list[str]) -> list[str]:
+    """Compute the Bemis-Murcko scaffold smiles of a chunk of molecules."""
+    params = Chem.SmilesParserParams()
+    params.removeHs = False
+    return [
+        MurckoScaffold.MurckoScaffoldSmiles(
+            mol=Chem.RemoveHs(Chem.MolFromSmiles(molecule, params)),
+            includeChirality=False,
+        )
+        for molecule in smiles
+    ]
+
+
+def compute_scaffolds(
+    smiles: list[str], n_workers: int = 1, chunk_size: int = 10000
+) -> list[str]:
+    """Compute the Bemis-Murcko scaffold of each molecule in parallel, acyclic molecules have an empty scaffold."""
+    chunks = [
+        smiles[start : start + chunk_size]
+        for start in range(0, len(smiles), chunk_size)
+    ]
+    if n_workers > 1:
+        with ProcessPoolExecutor(max_workers=n_workers) as pool:
+            scaffolds = list(pool.map(_compute_scaffolds, chunks))
+    else:
+        scaffolds = [_compute_scaffolds(chunk) for chunk in chunks]
+    return [scaffold for chunk in scaffolds for scaffold in chunk]
+
+
+def split_groups(
+    groups: list[np.ndarray],
+    fractions: tuple[float, float, float] = (0.8, 0.1, 0.1),
+) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Split groups of molecules, such as scaffolds or clusters, so each group is kept in a single set, the largest
+    groups fill the training set first and the smallest groups end up in the test set.
+
+    Returns:
+        The sorted indices of the training, validation and test molecules.
+    """
+    n_molecules = sum(len(group) for group in groups)
+    n_train, n_valid, _ = get_split_sizes(n_molecules, fractions)
+    splits = ([], [], [])
+    n_assigned = [0, 0]
+    for group in sorted(groups, key=len, reverse=True):
+        # a group larger than the training set still goes into it rather than the test set
+        if n_assigned[0] == 0 or n_assigned[0] + len(group) <= n_train:
+            split = 0
+        elif n_assigned[1] + len(group) <= n_valid:
+            split = 1
+        else:
+            split = 2
+        splits[split].append(group)
+        if split < 2:
+            n_assigned[split] += len(group)
+    return tuple(
+        np.sort(np.concatenate(split)) if split else np.zeros(0, dtype=np.int64)
+        for split in splits
+    )
+
+
+def scaffold_split(
+    scaffolds: list[str], fractions: tuple[float, float, float] = (0.8, 0.1, 0.1)
+) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Split the molecules so all molecules with the same scaffold are in the same set, see `split_groups`.
+
+    Returns:
+        The sorted indices of the training, validation and test molecules.
+    """
+    groups = {}
+    for index, scaffold in enumerate(scaffolds):
+        groups.setdefault(scaffold, []).append(index)
+    return split_groups(
+        [np.array(group, dtype=np.int64) for group in groups.values()], fractions
+    )
+
+
+def compute_minhash_signatures(
+    fingerprints: list[DataStructs.ExplicitBitVect], n_hashes: int, seed: int = 0
+) -> np.ndarray:
+    """
+    Compute the MinHash signature of the set bits of each fingerprint, the fraction of matching signature values
+    of two molecules is an estimate of their Tanimoto similarity.
+
+    Returns:
+        The (n_molecules, n_hashes) signatures, fingerprints with no set bits get the fingerprint length.
+    """
+    n_bits = fingerprints[0].GetNumBits()
+    on_bits = [
+        np.array(fingerprint.GetOnBits(), dtype=np.int64)
+        for fingerprint in fingerprints
+    ]
+    offsets = np.zeros(len(on_bits) + 1, dtype=np.int64)
+    np.cumsum([len(bits) for bits in on_bits], out=offsets[1:])
+    flat_bits = np.concatenate(on_bits)
+    empty = offsets[:-1] == offsets[1:]
+    # reduceat needs starts inside the array, empty fingerprints are overwritten afterwards
+    starts = np.minimum(offsets[:-1], max(len(flat_bits) - 1, 0))
+
+    random = np.random.default_rng(seed)
+    signatures = np.full((len(fingerprints), n_hashes), n_bits, dtype=np.uint32)
+    if len(flat_bits) == 0:
+        return signatures
+    for i in range(n_hashes):
+        ranks = random.permutation(n_bits).astype(np.uint32)
+        signatures[:, i] = np.minimum.reduceat(ranks[flat_bits], starts)
+    signatures[empty] = n_bits
+    return signatures
+
+
+def find_similar_molecules(
+    fingerprints: list[DataStructs.ExplicitBitVect],
+    threshold: float,
+    approximate: bool = True,
+    n_bands: int = 16,
+    rows_per_band: int = 4,
+    chunk_size: int = 10000,
+    seed: int = 0,
+) -> list[np.ndarray]:
+    """
+    Find the molecules with a Tanimoto similarity of at least `threshold` to each molecule.
+
+    In the approximate mode the MinHash signatures are split into bands and only molecules which share a bucket in
+    any band are compared, which avoids all pairwise comparisons, more bands with fewer rows find more of the
+    similar pairs at the cost of more comparisons. The exact similarities of the candidates are computed in
+    chunks so memory stays bounded by the chunk size.
+
+    Args:
+        fingerprints: The fingerprint of each molecule.
+        threshold: The smallest Tanimoto similarity of a neighbour.
+        approximate: If only locality sensitive hashing candidates should be compared rather than every pair.
+        n_bands: The number of hash bands.
+        rows_per_band: The number of signature values in each band.
+        chunk_size: The number of fingerprints compared at a time.
+        seed: The seed of the MinHash permutations.
+
+    Returns:
+        The sorted indices of the similar molecules of each molecule, not including itself.
+    """
+    n_molecules = len(fingerprints)
+    band_buckets = []
+    if approximate:
+        signatures = compute_minhash_signatures(
+            fingerprints, n_bands * rows_per_band, seed=seed
+        )
+        for band in range(n_bands):
+            band_values = np.ascontiguousarray(
+                signatures[:, band * rows_per_band : (band + 1) * rows_per_band]
+            )
+            _, bucket_ids = np.unique(
+                band_values.view(f"V{band_values.itemsize * rows_per_band}").ravel(),
+                return_inverse=True,
+            )
+            order = np.argsort(bucket_ids, kind="stable")
+            bucket_offsets = np.searchsorted(
+                bucket_ids[order], np.arange(bucket_ids.max() + 2)
+            )
+            band_buckets.append((bucket_ids, order, bucket_offsets))
+
+    neighbours = []
+    for index in range(n_molecules):
+        if approximate:
+            candidates = np.unique(
+                np.concatenate(
+                    [
+                        order[
+                            bucket_offsets[bucket_ids[index]] : bucket_offsets[
+                                bucket_ids[index] + 1
+                            ]
+                        ]
+                        for bucket_ids, order, bucket_offsets in band_buckets
+                    ]
+                )
+            )
+        else:
+            candidates = np.arange(n_molecules)
+        candidates = candidates[candidates != index]
+        similar = []
+        for start in range(0, len(candidates), chunk_size):
+            chunk = candidates[start : start + chunk_size]
+            similarities = np.array(
+                DataStructs.BulkTanimotoSimilarity(
+                    fingerprints[index], [fingerprints[i] for i in chunk]
+                )
+            )
+            similar.append(chunk[similarities >= threshold])
+        neighbours.append(
+            np.concatenate(similar) if similar else np.zeros(0, dtype=np.int64)
+        )
+    return neighbours
+
+
+def butina_clusters(neighbours: list[np.ndarray]) -> list[np.ndarray]:
+    """
+    Cluster the molecules with the Butina algorithm, the molecule with the most unassigned neighbours is made a
+    cluster centroid and takes all of its unassigned neighbours until every molecule is assigned.
+
+    Args:
+        neighbours: The similar molecules of each molecule, see `find_similar_molecules`.
+
+    Returns:
+        The sorted indices of the molecules in each cluster, with the largest clusters first.
+    """
+    order = sorted(range(len(neighbours)), key=lambda i: -len(neighbours[i]))
+    assigned = np.zeros(len(neighbours), dtype=bool)
+    clusters = []
+    for centroid in order:
+        if assigned[centroid]:
+            continue
+        members = neighbours[centroid][~assigned[neighbours[centroid]]]
+        cluster = np.sort(np.append(members, centroid)).astype(np.int64)
+        assigned[cluster] = True
+        clusters.append(cluster)
+    return clusters
+
+
+def butina_split(
+    fingerprints: list[DataStructs.ExplicitBitVect],
+    fractions: tuple[float, float, float] = (0.8, 0.1, 0.1),
+    threshold: float = 0.6,
+    approximate: bool = True,
+    seed: int = 0,
+) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Split the molecules so all molecules in the same Butina cluster are in the same set, see `split_groups`.
+
+    Args:
+        fingerprints: The fingerprint of each molecule.
+        fractions: The fraction of molecules in the training, validation and test sets.
+        threshold: The Tanimoto similarity cutoff of the clusters.
+        approximate: If the neighbours of each molecule should be found with locality sensitive hashing, see
+            `find_similar_molecules`.
+        seed: The seed of the MinHash permutations.
+
+    Returns:
+        The sorted indices of the training, validation and test molecules.
+    """
+    neighbours = find_similar_molecules(
+        fingerprints, threshold, approximate=approximate, seed=seed
+    )
+    return split_groups(butina_clusters(neighbours), fractions)
+
+
+def write_split_key_lists(
+    output_dir: str, keys: list[str], splits: tuple[np.ndarray, ...]
+) -> dict[str, str]:
+    """
+    Write a key list file for each split.
+
+    Returns:
+        The key list file of each split keyed by the split name.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    key_files = {}
+    for name, indices in zip(SPLIT_NAMES, splits):
+        key_files[name] = os.path.join(output_dir, f"{name}.txt")
+        write_key_list(key_files[name], [keys[i] for i in indices])
+    return key_files
@@ -0,0 +1,304 @@
+"""
+A native implementation of the QUBEKit Tkatchenko-Scheffler style Lennard-Jones 12-6 models which works directly on
+arrays of atomic numbers and MBIS volumes, so whole batches of atoms can be parameterised without a QUBEKit Ligand.
+"""
+
+import numpy as np
+from rdkit import Chem
+
+# unit conversions used by qubekit.utils.constants
+BOHR_TO_ANGS = 0.529177
+HA_TO_KCAL_P_MOL = 627.509391
+KCAL_TO_KJ = 4.184
+SIGMA_CONVERSION = 0.1
+EPSILON_CONVERSION = BOHR_TO_ANGS**6 * HA_TO_KCAL_P_MOL * KCAL_TO_KJ
+
+# the largest atomic number we can store parameters for
+MAX_ATOMIC_NUMBER = 118
+
+# free atom volumes (bohr^3) and C6 coefficients (Ha bohr^6) keyed by atomic number, these match the
+# `*_base` protocols in qubekit.nonbonded.protocols
+FREE_ATOM_PARAMETERS = {
+    1: {"v_free": 7.6, "b_free": 6.5},
+    6: {"v_free": 34.4, "b_free": 46.6},
+    7: {"v_free": 25.9, "b_free": 24.2},
+    8: {"v_free": 22.1, "b_free": 15.6},
+    9: {"v_free": 18.2, "b_free": 9.5},
+    16: {"v_free": 75.2, "b_free": 134.0},
+    17: {"v_free": 65.1, "b_free": 94.6},
+    35: {"v_free": 95.7, "b_free": 162.0},
+}
+# elements which make a bonded hydrogen polar
+POLAR_ELEMENTS = (7, 8, 16)
+
+
+def _element_array(values: dict[int, float]) -> np.ndarray:
+    """Build an array indexed by atomic number, elements without a value are nan."""
+    array = np.full(MAX_ATOMIC_NUMBER + 1, np.nan)
+    for atomic_number, value in values.items():
+        array[atomic_number] = value
+    return array
+
+
+V_FREE = _element_array(
+    {number: data["v_free"] for number, data in FREE_ATOM_PARAMETERS.items()}
+)
+B_FREE = _element_array(
+    {number: data["b_free"] for number, data in FREE_ATOM_PARAMETERS.items()}
+)
+
+
+class MissingRfreeError(ValueError):
+    """Raised when a model has no Rfree parameter for an element in the molecule."""
+
+
+class LennardJones612Model:
+    """
+    A Lennard-Jones 12-6 model with per-element Rfree parameters which derives sigma and epsilon from MBIS volumes.
+
+    The parameters are stored as arrays indexed by atomic number so that sigma and epsilon can be computed for any
+    number of atoms with a handful of numpy operations.
+    """
+
+    def __init__(
+        self,
+        r_free: dict[str, float],
+        alpha: float,
+        beta: float,
+        lj_on_polar_h: bool = True,
+    ):
+        """
+        Args:
+            r_free: The Rfree parameter (angstrom) of each element keyed by symbol, polar hydrogens use the key `X`.
+            alpha: The scaling factor applied to epsilon.
+            beta: The power of the volume ratio used to scale epsilon.
+            lj_on_polar_h: If polar hydrogens should have LJ terms, if `False` they are folded into their parent atom.
+        """
+        self.r_free_parameters = dict(r_free)
+        self.alpha = alpha
+        self.beta = beta
+        self.lj_on_polar_h = lj_on_polar_h
+
+        table = Chem.GetPeriodicTable()
+        self.r_free = _element_array(
+            {
+                table.GetAtomicNumber(symbol): value
+                for symbol, value in r_free.items()
+                if symbol != "X"
+            }
+        )
+        self.polar_h_r_free = r_free.get("X", np.nan)
+
+    def __repr__(self):
+        return (
+            f"{self.__class__.__name__}(r_free={self.r_free_parameters}, alpha={self.alpha}, "
+            f"beta={self.beta}, lj_on_polar_h={self.lj_on_polar_h})"
+        )
+
+    def _atom_r_free(
+        self, atomic_numbers: np.ndarray, polar_h_partners: np.ndarray
+    ) -> np.ndarray:
+        """Get the Rfree parameter of each atom, using the polar hydrogen value where needed."""
+        r_free = self.r_free[atomic_numbers]
+        if self.lj_on_polar_h:
+            r_free = np.where(polar_h_partners >= 0, self.polar_h_r_free, r_free)
+        return r_free
+
+    def check_element_coverage(
+        self, atomic_numbers: np.ndarray, polar_h_partners: np.ndarray
+    ):
+        """
+        Make sure the model has parameters for every atom.
+
+        Raises:
+            MissingRfreeError: If any of the atoms have no Rfree or free atom parameters.
+        """
+        atomic_numbers = np.asarray(atomic_numbers)
+        polar_h_partners = np.asarray(polar_h_partners)
+        missing = np.isnan(
+            self._atom_r_free(atomic_numbers, polar_h_partners)
+        ) | np.isnan(V_FREE[atomic_numbers])
+        if missing.any():
+            table = Chem.GetPeriodicTable()
+            symbols = set()
+            for atomic_number, is_polar in zip(
+                atomic_numbers[missing], polar_h_partners[missing] >= 0
+            ):
+                symbols.add(
+                    "X"
+                    if is_polar and self.lj_on_polar_h
+                    else table.GetElementSymbol(int(atomic_number))
+                )
+            raise MissingRfreeError(
+                f"The model has no Rfree parameters for the elements {sorted(symbols)}."
+            )
+
+    def compute_parameters(
+        self,
+        atomic_numbers: np.ndarray,
+        volumes: np.ndarray,
+        polar_h_partners: np.ndarray,
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Compute the sigma and epsilon values for a flat array of atoms which can span many molecules.
+
+        Args:
+            atomic_numbers: The atomic number of each atom.
+            volumes: The MBIS volume of each atom in bohr^3.
+            polar_h_partners: The index of the N, O or S atom bonded to each polar hydrogen, or -1 for all other atoms.
+                This should index into the same flat arrays, see `find_polar_hydrogens`.
+
+        Returns:
+            The sigma (nm) and epsilon (kJ / mol) values of each atom.
+        """
+        atomic_numbers = np.asarray(atomic_numbers, dtype=np.int64)
+        volumes = np.asarray(volumes, dtype=np.float64).reshape(-1)
+        polar_h_partners = np.asarray(polar_h_partners, dtype=np.int64)
+        self.check_element_coverage(atomic_numbers, polar_h_partners)
+
+        volume_ratio = volumes / V_FREE[atomic_numbers]
+        r_aim = self._atom_r_free(atomic_numbers, polar_h_partners) * (
+            volume_ratio ** (1 / 3)
+        )
+        b_i = B_FREE[atomic_numbers] * (volume_ratio**2)
+
+        if not self.lj_on_polar_h:
+            # move the dispersion of each polar hydrogen onto its parent atom
+            polar_h = np.flatnonzero(polar_h_partners >= 0)
+            sqrt_b = np.sqrt(b_i)
+            np.add.at(sqrt_b, polar_h_partners[polar_h], sqrt_b[polar_h])
+            b_i = sqrt_b**2
+            b_i[polar_h] = 0
+
+        a_i = 32 * b_i * (r_aim**6)
+        has_lj = b_i != 0
+        sigma = np.ones_like(b_i)
+        epsilon = np.zeros_like(b_i)
+        sigma[has_lj] = (a_i[has_lj] / b_i[has_lj]) ** (1 / 6) * SIGMA_CONVERSION
+        epsilon[has_lj] = (
+            (b_i[has_lj] ** 2)
+            / (4 * a_i[has_lj])
+            * EPSILON_CONVERSION
+            * self.alpha
+            * (volume_ratio[has_lj] ** self.beta)
+        )
+        return sigma, epsilon
+
+
+def find_polar_hydrogens(molecule: Chem.Mol) -> np.ndarray:
+    """
+    Find the polar hydrogens in the molecule.
+
+    Returns:
+        An array with the index of the N, O or S atom bonded to each polar hydrogen and -1 for all other atoms.
+    """
+    partners = np.full(molecule.GetNumAtoms(), -1, dtype=np.int64)
+    for bond in molecule.GetBonds():
+        atom_a, atom_b = bond.GetBeginAtom(), bond.GetEndAtom()
+        for hydrogen, heavy_atom in [(atom_a, atom_b), (atom_b, atom_a)]:
+            if (
+                hydrogen.GetAtomicNum() == 1
+                and heavy_atom.GetAtomicNum() in POLAR_ELEMENTS
+            ):
+                partners[hydrogen.GetIdx()] = heavy_atom.GetIdx()
+    return partners
+
+
+def get_atomic_numbers(molecule: Chem.Mol) -> np.ndarray:
+    """Get the atomic number of each atom in the molecule."""
+    return np.array(
+        [atom.GetAtomicNum() for atom in molecule.GetAtoms()], dtype=np.int64
+    )
+
+
+# Rfree parameters optimised with nagl-v1 charges and volumes
+model_v1 = LennardJones612Model(
+    r_free={
+        "H": 1.765,
+        "C": 2.067,
+        "N": 1.688,
+        "O": 1.653,
+        "X": 1.211,
+        "Cl": 1.935,
+        "S": 2.043,
+        "F": 1.642,
+        "Br": 2.037,
+    },
+    alpha=1.166,
+    beta=0.479,
+)
+
+# A second model trained on Mixture parameters against tip4pfb water
+model_v1_mixture = LennardJones612Model(
+    r_free={
+        "H": 1.887,
+        "C": 2.058,
+        "N": 1.631,
+        "O": 1.659,
+        "X": 0.978,
+        "Cl": 1.868,
+        "S": 1.841,
+        "F": 1.644,
+        "Br": 1.932,
+    },
+    alpha=1.216,
+    beta=0.487,
+)
+
+# Trained on mixture properties with tip4p-fb and bccs using nagl charge and volume v1 no polar h
+model_v1_mixture_no_polar_bcc = LennardJones612Model(
+    r_free={
+        "H": 1.825,
+        "C": 2.059,
+        "N": 1.636,
+        "O": 1.707,
+        "Cl": 1.877,
+        "S": 1.811,
+        "F": 1.637,
+        "Br": 1.917,
+    },
+    lj_on_polar_h=False,
+    alpha=1.165,
+    beta=0.476,
+)
+
+# A model optimised with Mixture properties against tip4p-fb using espaloma-charge-0.0.8
+model_v1_espaloma_mixture = LennardJones612Model(
+    r_free={
+        "H": 1.925,
+        "C": 2.013,
+        "N": 1.807,
+        "O": 1.537,
+        "X": 1.256,
+        "Cl": 1.866,
+        "S": 1.812,
+        "F": 1.627,
+        "Br": 1.969,
+    },
+    alpha=1.2,
+    beta=0.502,
+)
+
+model_v2_espaloma_mixture_no_polar_h = LennardJones612Model(
+    r_free={
+        "H": 1.868,
+        "C": 2.022,
+        "N": 1.835,
+        "O": 1.603,
+        "Cl": 1.846,
+        "S": 1.810,
+        "F": 1.566,
+        "Br": 1.930,
+    },
+    lj_on_polar_h=False,
+    alpha=1.129,
+    beta=0.555,
+)
+
+LJ_MODELS = {
+    1: model_v1,
+    2: model_v1_mixture,
+    3: model_v1_mixture_no_polar_bcc,
+    "espaloma-v1": model_v1_espaloma_mixture,
+    "espaloma-v2": model_v2_espaloma_mixture_no_polar_h,
+}
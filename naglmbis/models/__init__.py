@@ -1,4 +1,23 @@
-from naglmbis.models.base_model import MBISGraphModel
-from naglmbis.models.models import CHARGE_MODELS, load_charge_model
+from naglmbis.models.base_model import HiddenStates, MBISGraphModel
+from naglmbis.models.environment_cache import EnvironmentCache
+from naglmbis.models.fragments import FragmentPredictor
+from naglmbis.models.models import (
+    CHARGE_MODELS,
+    VOLUME_MODELS,
+    load_charge_model,
+    load_volume_model,
+)
+from naglmbis.models.templates import ResidueTemplateCharges, TemplateLibrary
 
-__all__ = [MBISGraphModel, CHARGE_MODELS, load_charge_model]
+__all__ = [
+    MBISGraphModel,
+    HiddenStates,
+    EnvironmentCache,
+    FragmentPredictor,
+    ResidueTemplateCharges,
+    TemplateLibrary,
+    CHARGE_MODELS,
+    VOLUME_MODELS,
+    load_charge_model,
+    load_volume_model,
+]
@@ -1,17 +1,372 @@
 # models for the nagl run
+import dataclasses
+from typing import Optional, Union
 
+import dgl
+import numpy as np
 import torch
-from nagl.molecules import DGLMolecule
+from nagl.molecules import DGLMolecule, DGLMoleculeBatch
 from nagl.training import DGLMoleculeLightningModel
 from rdkit import Chem
 
+from naglmbis.charges import (
+    equilibrate_charges,
+    fix_net_charges,
+    get_formal_charges,
+    get_molecule_offsets,
+)
+from naglmbis.models.featurize import molecule_to_dgl
+from naglmbis.models.graph import get_k_hop_atoms, get_neighbour_lists
+from naglmbis.predictions import BatchPredictions
+
+# the postprocess layers which can be applied to readout values computed on subgraphs
+LOCAL_POSTPROCESS = (None, "charges")
+
+
+@dataclasses.dataclass
+class HiddenStates:
+    """The node states of every convolution layer for a molecule."""
+
+    layer_states: list[torch.Tensor]
+    """The input atom features followed by the output of each convolution layer."""
+    neighbour_lists: list[list[int]]
+    """The bonded neighbours of each atom."""
+    n_recomputed: int = 0
+    """The number of atom states recomputed over all layers when the states were made from a parent molecule."""
+
 
 class MBISGraphModel(DGLMoleculeLightningModel):
-    "A wrapper to make it easy to load and evaluate models"
+    """
+    A wrapper to make it easy to load and evaluate models.
+
+    The `compute_*` methods run under `torch.inference_mode` and only build per call molecule graphs, they never
+    change the model so a single loaded model can be shared by many threads without a lock.
+    """
+
+    @property
+    def receptive_field(self) -> int:
+        """The number of bonds an atom can see through the convolution layers."""
+        return len(self.config.model.convolution.hidden_feats)
+
+    def forward_readouts(
+        self,
+        molecule: Union[DGLMolecule, DGLMoleculeBatch],
+        readouts: Optional[list[str]] = None,
+    ) -> dict[str, torch.Tensor]:
+        """
+        Run the convolution module once and evaluate only the requested readout modules.
+
+        Args:
+            molecule: The featurized molecule or batch of molecules.
+            readouts: The names of the readouts to compute, by default all readouts are computed.
+
+        Raises:
+            ValueError: If a requested readout is not part of the model.
+        """
+        molecule.graph.ndata["h"] = self.convolution_module(
+            molecule.graph, molecule.atom_features
+        )
+        return self._compute_readouts(molecule, readouts=readouts)
 
-    def compute_properties(self, molecule: Chem.Mol) -> dict[str, torch.Tensor]:
-        dgl_molecule = DGLMolecule.from_rdkit(
+    def _compute_readouts(
+        self,
+        molecule: Union[DGLMolecule, DGLMoleculeBatch],
+        readouts: Optional[list[str]] = None,
+    ) -> dict[str, torch.Tensor]:
+        """Evaluate the requested readout modules from the final node states stored on the molecule graph."""
+        if readouts is None:
+            readouts = list(self.readout_modules.keys())
+        missing_readouts = set(readouts) - set(self.readout_modules.keys())
+        if missing_readouts:
+            raise ValueError(
+                f"The model does not have the readouts {sorted(missing_readouts)}, available readouts are "
+                f"{list(self.readout_modules.keys())}."
+            )
+
+        return {
+            readout_name: self.readout_modules[readout_name](molecule)
+            for readout_name in readouts
+        }
+
+    def _featurize(self, molecule: Chem.Mol) -> DGLMolecule:
+        return molecule_to_dgl(
             molecule, self.config.model.atom_features, self.config.model.bond_features
         )
 
-        return self.forward(dgl_molecule)
+    def check_local_readouts(self, readouts: Optional[list[str]] = None) -> list[str]:
+        """
+        Check the readouts can be computed from subgraphs of a molecule, which needs atom pooling and a postprocess
+        layer that can be applied once the atom values are stitched back together.
+
+        Returns:
+            The names of the readouts, by default all readouts of the model.
+
+        Raises:
+            ValueError: If a readout is missing or can not be computed locally.
+        """
+        readouts = list(self.readout_modules.keys()) if readouts is None else readouts
+        for readout_name in readouts:
+            if readout_name not in self.readout_modules:
+                raise ValueError(f"The model does not have the readout {readout_name}.")
+            readout_config = self.config.model.readouts[readout_name]
+            if (
+                readout_config.pooling != "atom"
+                or readout_config.postprocess not in LOCAL_POSTPROCESS
+            ):
+                raise ValueError(
+                    f"The readout {readout_name} can not be computed locally, only atom pooled readouts with the "
+                    f"postprocess layers {LOCAL_POSTPROCESS} are supported."
+                )
+        return list(readouts)
+
+    def compute_local_readout_values(
+        self,
+        dgl_molecules: list[DGLMolecule],
+        neighbour_lists: list[list[list[int]]],
+        centre_atoms: list[np.ndarray],
+        readouts: list[str],
+        n_buffer_hops: int = 0,
+    ) -> list[np.ndarray]:
+        """
+        Compute the readout values, before postprocessing, of a set of centre atoms in each molecule.
+
+        The convolution is run once over the batch of induced subgraphs which hold the receptive field of the
+        centre atoms, plus an optional buffer, rather than the whole molecules. The atom features are taken from
+        the whole molecules so the centre values match a full forward pass.
+
+        Args:
+            dgl_molecules: The featurized molecules.
+            neighbour_lists: The bonded neighbours of each atom in each molecule.
+            centre_atoms: The atoms of each molecule to compute the values for, see `check_local_readouts`.
+            readouts: The readouts to compute.
+            n_buffer_hops: The number of bonds to add to the subgraphs past the receptive field.
+
+        Returns:
+            The values of each readout with the centre atoms of all molecules in order.
+        """
+        n_hops = self.receptive_field + n_buffer_hops
+        subgraphs, centre_positions, n_subgraph_atoms = [], [], 0
+        for dgl_molecule, neighbours, centres in zip(
+            dgl_molecules, neighbour_lists, centre_atoms
+        ):
+            if len(centres) == 0:
+                continue
+            subgraph_atoms = get_k_hop_atoms(neighbours, centres, n_hops)
+            subgraphs.append(
+                dgl.node_subgraph(dgl_molecule.graph, torch.from_numpy(subgraph_atoms))
+            )
+            centre_positions.append(
+                np.searchsorted(subgraph_atoms, centres) + n_subgraph_atoms
+            )
+            n_subgraph_atoms += len(subgraph_atoms)
+
+        if not subgraphs:
+            return [np.empty((0, 0), dtype=np.float32) for _ in readouts]
+
+        graph = dgl.batch(subgraphs)
+        centre_positions = torch.from_numpy(np.concatenate(centre_positions))
+        with torch.inference_mode():
+            hidden_states = self.convolution_module(graph, graph.ndata["feat"])
+            centre_states = hidden_states[centre_positions]
+            return [
+                self.readout_modules[readout_name].forward_layers(centre_states).numpy()
+                for readout_name in readouts
+            ]
+
+    def postprocess_local_readout_values(
+        self,
+        values: list[np.ndarray],
+        readouts: list[str],
+        molecules: list[Chem.Mol],
+    ) -> dict[str, torch.Tensor]:
+        """
+        Apply the postprocess layer of each readout to the stitched atom values of whole molecules, charges are
+        equilibrated over each molecule so they sum to its formal charge.
+
+        Args:
+            values: The flat values of each readout for all atoms of the molecules in order.
+            readouts: The names of the readouts.
+            molecules: The molecules the values belong to.
+        """
+        properties = {}
+        for readout_values, readout_name in zip(values, readouts):
+            if self.config.model.readouts[readout_name].postprocess == "charges":
+                readout_values = equilibrate_charges(
+                    electronegativity=readout_values[:, 0],
+                    hardness=readout_values[:, 1],
+                    molecule_offsets=get_molecule_offsets(
+                        [molecule.GetNumAtoms() for molecule in molecules]
+                    ),
+                    total_charges=get_formal_charges(molecules),
+                ).reshape(-1, 1)
+            properties[readout_name] = torch.from_numpy(np.asarray(readout_values)).to(
+                torch.float32
+            )
+        return properties
+
+    def compute_hidden_states(self, molecule: Chem.Mol) -> HiddenStates:
+        """
+        Run the convolution layers one at a time and keep the node states of every layer, these can be used with
+        `compute_edited_properties` to evaluate edits of the molecule.
+        """
+        dgl_molecule = self._featurize(molecule)
+        layer_states = [dgl_molecule.atom_features]
+        with torch.inference_mode():
+            for layer in self.convolution_module:
+                layer_states.append(layer(dgl_molecule.graph, layer_states[-1]))
+        return HiddenStates(
+            layer_states=layer_states, neighbour_lists=get_neighbour_lists(molecule)
+        )
+
+    def compute_edited_properties(
+        self,
+        parent_states: HiddenStates,
+        molecule: Chem.Mol,
+        atom_map: dict[int, int],
+        readouts: Optional[list[str]] = None,
+    ) -> tuple[dict[str, torch.Tensor], HiddenStates]:
+        """
+        Compute the properties of an edited molecule by reusing the node states of its parent.
+
+        At layer `l` only atoms within `l` bonds of a changed atom are recomputed, every other atom reuses the state
+        of its parent atom. The readouts and their postprocessing, such as charge equilibration, are then applied
+        to the whole edited molecule.
+
+        Args:
+            parent_states: The hidden states of the parent molecule, see `compute_hidden_states`.
+            molecule: The edited molecule.
+            atom_map: The index of each kept parent atom in the edited molecule.
+            readouts: The names of the readouts to compute, by default all readouts are computed.
+
+        Returns:
+            The properties of the edited molecule and its hidden states, which can be used as the parent of
+            further edits.
+        """
+        dgl_molecule = self._featurize(molecule)
+        atom_features = dgl_molecule.atom_features
+        neighbour_lists = get_neighbour_lists(molecule)
+
+        parent_indices = torch.tensor(list(atom_map.keys()), dtype=torch.long)
+        child_indices = torch.tensor(list(atom_map.values()), dtype=torch.long)
+        # an atom has changed if it is new, its features changed or its bonded neighbours changed
+        changed = np.ones(molecule.GetNumAtoms(), dtype=bool)
+        changed[child_indices.numpy()] = False
+        for parent_index, child_index in atom_map.items():
+            mapped_neighbours = {
+                atom_map.get(neighbour, -1)
+                for neighbour in parent_states.neighbour_lists[parent_index]
+            }
+            if mapped_neighbours != set(
+                neighbour_lists[child_index]
+            ) or not torch.equal(
+                parent_states.layer_states[0][parent_index], atom_features[child_index]
+            ):
+                changed[child_index] = True
+        changed_atoms = np.flatnonzero(changed)
+
+        layer_states, n_recomputed = [atom_features], 0
+        with torch.inference_mode():
+            for layer_index, layer in enumerate(self.convolution_module, start=1):
+                parent_layer = parent_states.layer_states[layer_index]
+                states = parent_layer.new_zeros(
+                    (molecule.GetNumAtoms(), parent_layer.shape[1])
+                )
+                states[child_indices] = parent_layer[parent_indices]
+                affected_atoms = get_k_hop_atoms(
+                    neighbour_lists, changed_atoms, layer_index
+                )
+                if len(affected_atoms) > 0:
+                    # the affected atoms and their neighbours hold every message the affected atoms need
+                    subgraph_atoms = get_k_hop_atoms(neighbour_lists, affected_atoms, 1)
+                    subgraph = dgl.node_subgraph(
+                        dgl_molecule.graph, torch.from_numpy(subgraph_atoms)
+                    )
+                    subgraph_states = layer(
+                        subgraph, layer_states[-1][torch.from_numpy(subgraph_atoms)]
+                    )
+                    states[torch.from_numpy(affected_atoms)] = subgraph_states[
+                        torch.from_numpy(
+                            np.searchsorted(subgraph_atoms, affected_atoms)
+                        )
+                    ]
+                    n_recomputed += len(affected_atoms)
+                layer_states.append(states)
+
+            dgl_molecule.graph.ndata["h"] = layer_states[-1]
+            properties = self._compute_readouts(dgl_molecule, readouts=readouts)
+
+        return properties, HiddenStates(
+            layer_states=layer_states,
+            neighbour_lists=neighbour_lists,
+            n_recomputed=n_recomputed,
+        )
+
+    @torch.inference_mode()
+    def compute_properties(
+        self, molecule: Chem.Mol, readouts: Optional[list[str]] = None
+    ) -> dict[str, torch.Tensor]:
+        """
+        Compute the properties of the molecule.
+
+        Args:
+            molecule: The rdkit molecule to predict the properties for.
+            readouts: The names of the readouts to compute, unused readouts are never evaluated. By default all
+                readouts are computed.
+        """
+        return self.forward_readouts(self._featurize(molecule), readouts=readouts)
+
+    @torch.inference_mode()
+    def compute_batch_properties(
+        self,
+        molecules: list[Chem.Mol],
+        fix_net_charge: bool = True,
+        charge_weights: Optional[np.ndarray] = None,
+        readouts: Optional[list[str]] = None,
+        molecule_ids: Optional[list[str]] = None,
+    ) -> BatchPredictions:
+        """
+        Compute the properties of a list of molecules in a single batched forward pass.
+
+        Args:
+            molecules: The rdkit molecules to predict the properties for.
+            fix_net_charge: If the `mbis-charges` of each molecule should be corrected to sum exactly to the total
+                formal charge of the molecule.
+            charge_weights: Optional per atom weights used to spread the net charge residual of each molecule,
+                by default the residual is spread equally.
+            readouts: The names of the readouts to compute, by default all readouts are computed.
+            molecule_ids: The identifier of each molecule, by default the smiles of each molecule.
+
+        Returns:
+            The predictions with one flat array per property and the offset of each molecule.
+        """
+        batch = DGLMoleculeBatch(*[self._featurize(molecule) for molecule in molecules])
+        properties = {
+            name: values.numpy()
+            for name, values in self.forward_readouts(batch, readouts=readouts).items()
+        }
+        molecule_offsets = get_molecule_offsets(
+            [molecule.GetNumAtoms() for molecule in molecules]
+        )
+
+        if fix_net_charge and "mbis-charges" in properties:
+            charges = properties["mbis-charges"]
+            properties["mbis-charges"] = (
+                fix_net_charges(
+                    charges,
+                    molecule_offsets=molecule_offsets,
+                    total_charges=get_formal_charges(molecules),
+                    weights=charge_weights,
+                )
+                .astype(charges.dtype)
+                .reshape(charges.shape)
+            )
+
+        return BatchPredictions(
+            properties=properties,
+            molecule_offsets=molecule_offsets,
+            molecule_ids=(
+                [Chem.MolToSmiles(molecule) for molecule in molecules]
+                if molecule_ids is None
+                else molecule_ids
+            ),
+        )
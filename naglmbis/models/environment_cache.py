@@ -0,0 +1,137 @@
+"""
+Reuse the per atom outputs of a model between molecules which share atom environments.
+"""
+
+from typing import Optional
+
+import numpy as np
+import torch
+from nagl.molecules import DGLMolecule
+from rdkit import Chem
+
+from naglmbis.models.base_model import MBISGraphModel
+from naglmbis.models.graph import get_environment_hashes, get_neighbour_lists
+
+
+class EnvironmentCache:
+    """
+    A cache of the per atom readout values of a model, before any postprocessing, keyed by the hash of the
+    featurized environment of each atom within the receptive field of the model.
+
+    The convolution is only run on the subgraphs around atoms with uncached environments and the postprocess
+    layers, such as charge equilibration, are then applied to each whole molecule.
+    """
+
+    def __init__(self, model: MBISGraphModel, readouts: Optional[list[str]] = None):
+        """
+        Args:
+            model: The model whose readouts should be cached.
+            readouts: The readouts to compute, by default all readouts of the model.
+
+        Raises:
+            ValueError: If a readout is missing or does not use atom pooling and a supported postprocess layer.
+        """
+        self.model = model
+        self.readouts = model.check_local_readouts(readouts)
+        self.n_hops = model.receptive_field
+        # the readout values of each environment in the order of `self.readouts`
+        self._values: dict[bytes, tuple[np.ndarray, ...]] = {}
+        self.n_lookups = 0
+        self.n_hits = 0
+
+    def __len__(self):
+        return len(self._values)
+
+    @property
+    def hit_rate(self) -> float:
+        """The fraction of atom lookups which did not need the model to be run."""
+        return self.n_hits / self.n_lookups if self.n_lookups > 0 else 0.0
+
+    def get_statistics(self) -> dict:
+        """Get a summary of the cache size and hit rate."""
+        return {
+            "n_environments": len(self),
+            "n_lookups": self.n_lookups,
+            "n_hits": self.n_hits,
+            "hit_rate": self.hit_rate,
+        }
+
+    def clear(self):
+        """Remove all cached environments and reset the statistics."""
+        self._values = {}
+        self.n_lookups = 0
+        self.n_hits = 0
+
+    def _compute_missing_environments(
+        self,
+        dgl_molecules: list[DGLMolecule],
+        neighbour_lists: list[list[list[int]]],
+        centre_atoms: list[np.ndarray],
+        centre_hashes: list[bytes],
+    ):
+        """Run the model on the subgraphs around each centre atom and cache their readout values."""
+        readout_values = self.model.compute_local_readout_values(
+            dgl_molecules=dgl_molecules,
+            neighbour_lists=neighbour_lists,
+            centre_atoms=centre_atoms,
+            readouts=self.readouts,
+        )
+        for i, environment_hash in enumerate(centre_hashes):
+            self._values[environment_hash] = tuple(
+                values[i] for values in readout_values
+            )
+
+    def compute_batch_properties(
+        self, molecules: list[Chem.Mol]
+    ) -> dict[str, torch.Tensor]:
+        """
+        Compute the readouts of a list of molecules reusing the cached environments where possible.
+
+        Each property is returned as a single flat tensor with the atoms of each molecule in order, matching the
+        properties of `MBISGraphModel.compute_batch_properties` without the net charge correction.
+        """
+        dgl_molecules, neighbour_lists, molecule_hashes = [], [], []
+        centre_atoms, centre_hashes, scheduled = [], [], set()
+        for molecule in molecules:
+            dgl_molecule = self.model._featurize(molecule)
+            neighbours = get_neighbour_lists(molecule)
+            hashes = get_environment_hashes(
+                dgl_molecule.atom_features.numpy(), neighbours, self.n_hops
+            )
+            # only run the model for the first atom of each new environment
+            centres = []
+            for atom_index, environment_hash in enumerate(hashes):
+                if environment_hash in self._values or environment_hash in scheduled:
+                    self.n_hits += 1
+                else:
+                    scheduled.add(environment_hash)
+                    centres.append(atom_index)
+                    centre_hashes.append(environment_hash)
+            self.n_lookups += len(hashes)
+
+            dgl_molecules.append(dgl_molecule)
+            neighbour_lists.append(neighbours)
+            molecule_hashes.extend(hashes)
+            centre_atoms.append(np.array(centres, dtype=np.int64))
+
+        if centre_hashes:
+            self._compute_missing_environments(
+                dgl_molecules, neighbour_lists, centre_atoms, centre_hashes
+            )
+
+        values = [
+            np.stack(
+                [
+                    self._values[environment_hash][i]
+                    for environment_hash in molecule_hashes
+                ]
+            )
+            for i in range(len(self.readouts))
+        ]
+        return self.model.postprocess_local_readout_values(
+            values=values, readouts=self.readouts, molecules=molecules
+        )
+
+    def compute_properties(self, molecule: Chem.Mol) -> dict[str, torch.Tensor]:
+        """Compute the readouts of a single molecule reusing the cached environments where possible."""
+        return self.compute_batch_properties([molecule])
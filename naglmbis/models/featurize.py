@@ -0,0 +1,111 @@
+"""
+A fast RDKit to DGL graph builder used for inference and training.
+"""
+
+from typing import Optional, Union
+
+import dgl
+import torch
+from nagl.molecules import DGLMolecule, DGLMoleculeBatch
+from rdkit import Chem
+
+from naglmbis.models.graph import get_bond_indices
+
+# the node data of graphs whose atom features are kept packed until they reach the model
+PACKED_BITS = "feat-bits"
+PACKED_DENSE = "feat-dense"
+
+
+def molecule_to_dgl(
+    molecule: Chem.Mol, atom_features: list, bond_features: list
+) -> DGLMolecule:
+    """
+    Build the featurized graph of a molecule, equivalent to `DGLMolecule.from_rdkit` but with the bond arrays
+    pulled out of the molecule in bulk and the forward and reverse edge tensors made in one step.
+
+    Args:
+        molecule: The rdkit molecule with explicit hydrogens.
+        atom_features: The atom features of the model.
+        bond_features: The bond features of the model, the bond order of the graph follows the bond indices
+            when bond features are used so these molecules are built with `DGLMolecule.from_rdkit`.
+    """
+    if len(bond_features) > 0:
+        return DGLMolecule.from_rdkit(molecule, atom_features, bond_features)
+
+    atom_feature_values = (
+        torch.hstack([feature(molecule) for feature in atom_features])
+        if len(atom_features) > 0
+        else None
+    )
+    return graph_from_arrays(
+        bonds=torch.from_numpy(get_bond_indices(molecule)),
+        n_atoms=molecule.GetNumAtoms(),
+        atom_features=atom_feature_values,
+        formal_charges=torch.tensor(
+            [atom.GetFormalCharge() for atom in molecule.GetAtoms()]
+        ),
+    )
+
+
+def graph_from_arrays(
+    bonds: torch.Tensor,
+    n_atoms: int,
+    atom_features: Optional[torch.Tensor],
+    formal_charges: torch.Tensor,
+) -> DGLMolecule:
+    """
+    Build a featurized graph from its arrays in the same layout as `DGLMolecule.from_rdkit`.
+
+    Args:
+        bonds: The (n_bonds, 2) atom indices of each bond.
+        n_atoms: The number of atoms.
+        atom_features: The (n_atoms, n_features) atom features.
+        formal_charges: The formal charge of each atom.
+    """
+    bonds = bonds.to(torch.int32)
+    graph = dgl.heterograph(
+        {
+            ("atom", "forward", "atom"): (bonds[:, 0], bonds[:, 1]),
+            ("atom", "reverse", "atom"): (bonds[:, 1], bonds[:, 0]),
+        },
+        num_nodes_dict={"atom": n_atoms},
+    )
+    if atom_features is not None:
+        graph.ndata["feat"] = atom_features
+    graph.ndata["formal_charge"] = formal_charges
+    return DGLMolecule(graph=graph, n_representations=1)
+
+
+def unpack_atom_features(
+    bits: torch.Tensor, dense: torch.Tensor, binary_columns: torch.Tensor
+) -> torch.Tensor:
+    """
+    Expand atom features stored with their binary columns packed into bits to the float features of the model.
+
+    Args:
+        bits: The (n_atoms, n_bytes) uint8 binary columns packed with the first column in the highest bit.
+        dense: The (n_atoms, n_dense) values of the other columns.
+        binary_columns: The boolean mask of the binary columns over all of the feature columns.
+    """
+    binary_columns = binary_columns.to(bits.device)
+    n_atoms, n_binary = len(bits), int(binary_columns.sum())
+    shifts = torch.arange(7, -1, -1, dtype=torch.uint8, device=bits.device)
+    binary = ((bits.unsqueeze(-1) >> shifts) & 1).reshape(n_atoms, -1)[:, :n_binary]
+    features = torch.empty(
+        (n_atoms, len(binary_columns)), dtype=torch.float32, device=bits.device
+    )
+    features[:, binary_columns] = binary.float()
+    features[:, ~binary_columns] = dense.float()
+    return features
+
+
+def expand_packed_features(
+    molecule: Union[DGLMolecule, DGLMoleculeBatch], binary_columns: torch.Tensor
+):
+    """Replace the packed atom features of a molecule or batch with the float features, if they are packed."""
+    node_data = molecule.graph.ndata
+    if PACKED_BITS not in node_data:
+        return
+    node_data["feat"] = unpack_atom_features(
+        node_data.pop(PACKED_BITS), node_data.pop(PACKED_DENSE), binary_columns
+    )
@@ -0,0 +1,138 @@
+"""
+Predict the properties of very large molecules such as proteins and polymers from overlapping fragments.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+import numpy as np
+import torch
+from rdkit import Chem
+
+from naglmbis.models.base_model import MBISGraphModel
+from naglmbis.models.graph import (
+    get_breadth_first_order,
+    get_k_hop_atoms,
+    get_neighbour_lists,
+)
+
+
+class FragmentPredictor:
+    """
+    Split a molecule into cores of bonded atoms, run the model on each core plus its receptive field and a buffer
+    and stitch the core atom values back together before applying the postprocess layers, such as charge
+    equilibration, to the whole molecule.
+
+    Only the atom features are computed for the whole molecule, the convolution hidden states are only ever held
+    for one batch of fragments at a time.
+    """
+
+    def __init__(
+        self,
+        model: MBISGraphModel,
+        core_size: int = 512,
+        n_buffer_hops: int = 1,
+        max_batch_atoms: int = 20000,
+        n_workers: int = 1,
+        readouts: Optional[list[str]] = None,
+    ):
+        """
+        Args:
+            model: The model used to predict the fragments.
+            core_size: The number of atoms in the core of each fragment.
+            n_buffer_hops: The number of bonds added to each fragment past the receptive field of the model.
+            max_batch_atoms: The memory ceiling given as the largest number of fragment atoms in one batch.
+            n_workers: The number of threads used to predict batches of fragments in parallel.
+            readouts: The readouts to compute, by default all readouts of the model.
+
+        Raises:
+            ValueError: If a readout can not be computed from fragments.
+        """
+        self.model = model
+        self.readouts = model.check_local_readouts(readouts)
+        self.core_size = core_size
+        self.n_buffer_hops = n_buffer_hops
+        self.max_batch_atoms = max_batch_atoms
+        self.n_workers = n_workers
+
+    def get_fragments(
+        self, neighbour_lists: list[list[int]]
+    ) -> list[tuple[np.ndarray, np.ndarray]]:
+        """
+        Split the molecule into fragments.
+
+        Returns:
+            The core atoms and all atoms of each fragment.
+
+        Raises:
+            ValueError: If a single fragment is larger than the memory ceiling.
+        """
+        n_hops = self.model.receptive_field + self.n_buffer_hops
+        order = get_breadth_first_order(neighbour_lists)
+        fragments = []
+        for start in range(0, len(order), self.core_size):
+            core = np.sort(order[start : start + self.core_size])
+            fragment = get_k_hop_atoms(neighbour_lists, core, n_hops)
+            if len(fragment) > self.max_batch_atoms:
+                raise ValueError(
+                    f"A fragment has {len(fragment)} atoms which is more than the maximum of "
+                    f"{self.max_batch_atoms} atoms per batch, reduce the core size or raise the memory ceiling."
+                )
+            fragments.append((core, fragment))
+        return fragments
+
+    def _batch_fragments(
+        self, fragments: list[tuple[np.ndarray, np.ndarray]]
+    ) -> list[list[np.ndarray]]:
+        """Group the fragment cores into batches which stay under the memory ceiling."""
+        batches, batch, n_batch_atoms = [], [], 0
+        for core, fragment in fragments:
+            if batch and n_batch_atoms + len(fragment) > self.max_batch_atoms:
+                batches.append(batch)
+                batch, n_batch_atoms = [], 0
+            batch.append(core)
+            n_batch_atoms += len(fragment)
+        if batch:
+            batches.append(batch)
+        return batches
+
+    def compute_properties(self, molecule: Chem.Mol) -> dict[str, torch.Tensor]:
+        """
+        Compute the readouts of the molecule from its fragments.
+
+        Returns:
+            The properties of the molecule in the same layout as `MBISGraphModel.compute_properties`.
+        """
+        dgl_molecule = self.model._featurize(molecule)
+        neighbour_lists = get_neighbour_lists(molecule)
+        batches = self._batch_fragments(self.get_fragments(neighbour_lists))
+
+        def predict_batch(cores: list[np.ndarray]) -> list[np.ndarray]:
+            return self.model.compute_local_readout_values(
+                dgl_molecules=[dgl_molecule] * len(cores),
+                neighbour_lists=[neighbour_lists] * len(cores),
+                centre_atoms=cores,
+                readouts=self.readouts,
+                n_buffer_hops=self.n_buffer_hops,
+            )
+
+        if self.n_workers > 1:
+            with ThreadPoolExecutor(max_workers=self.n_workers) as pool:
+                batch_values = list(pool.map(predict_batch, batches))
+        else:
+            batch_values = [predict_batch(cores) for cores in batches]
+
+        # stitch the core values back into molecule order
+        core_atoms = np.concatenate([np.concatenate(cores) for cores in batches])
+        values = []
+        for i in range(len(self.readouts)):
+            readout_values = np.concatenate(
+                [fragment_values[i] for fragment_values in batch_values]
+            )
+            atom_values = np.empty_like(readout_values)
+            atom_values[core_atoms] = readout_values
+            values.append(atom_values)
+
+        return self.model.postprocess_local_readout_values(
+            values=values, readouts=self.readouts, molecules=[molecule]
+        )
@@ -0,0 +1,105 @@
+"""
+Graph helpers used to find the atoms which can change the output of a message passing model.
+"""
+
+import hashlib
+from typing import Iterable
+
+import numpy as np
+from rdkit import Chem
+
+
+def get_neighbour_lists(molecule: Chem.Mol) -> list[list[int]]:
+    """Get the indices of the bonded neighbours of each atom in the molecule."""
+    return [
+        [neighbour.GetIdx() for neighbour in atom.GetNeighbors()]
+        for atom in molecule.GetAtoms()
+    ]
+
+
+def get_k_hop_atoms(
+    neighbour_lists: list[list[int]], atoms: Iterable[int], n_hops: int
+) -> np.ndarray:
+    """
+    Get the sorted indices of all atoms within `n_hops` bonds of any of the starting atoms, including the starting
+    atoms.
+    """
+    visited = set(int(atom) for atom in atoms)
+    frontier = list(visited)
+    for _ in range(n_hops):
+        next_frontier = []
+        for atom in frontier:
+            for neighbour in neighbour_lists[atom]:
+                if neighbour not in visited:
+                    visited.add(neighbour)
+                    next_frontier.append(neighbour)
+        frontier = next_frontier
+    return np.array(sorted(visited), dtype=np.int64)
+
+
+def get_environment_hashes(
+    atom_features: np.ndarray, neighbour_lists: list[list[int]], n_hops: int
+) -> list[bytes]:
+    """
+    Hash the featurized `n_hops` neighbourhood of each atom using Weisfeiler-Lehman style refinement.
+
+    Atoms with the same hash have the same input features and the same multiset of neighbour environments out to
+    `n_hops` bonds, so any message passing model with at most `n_hops` layers gives them the same output.
+
+    Args:
+        atom_features: The (n_atoms, n_features) input features of the model.
+        neighbour_lists: The bonded neighbours of each atom, see `get_neighbour_lists`.
+        n_hops: The receptive field of the model in bonds.
+
+    Returns:
+        The 128 bit environment hash of each atom.
+    """
+    atom_features = np.ascontiguousarray(atom_features, dtype=np.float32)
+    hashes = [
+        hashlib.blake2b(row.tobytes(), digest_size=16).digest() for row in atom_features
+    ]
+    for _ in range(n_hops):
+        hashes = [
+            hashlib.blake2b(
+                hashes[atom]
+                + b"".join(sorted(hashes[neighbour] for neighbour in neighbours)),
+                digest_size=16,
+            ).digest()
+            for atom, neighbours in enumerate(neighbour_lists)
+        ]
+    return hashes
+
+
+def get_breadth_first_order(neighbour_lists: list[list[int]]) -> np.ndarray:
+    """
+    Get an ordering of the atoms where bonded atoms are close together, each connected component is walked
+    breadth first starting from its lowest index atom.
+    """
+    visited = np.zeros(len(neighbour_lists), dtype=bool)
+    order = []
+    for start in range(len(neighbour_lists)):
+        if visited[start]:
+            continue
+        visited[start] = True
+        frontier = [start]
+        while frontier:
+            order.extend(frontier)
+            next_frontier = []
+            for atom in frontier:
+                for neighbour in neighbour_lists[atom]:
+                    if not visited[neighbour]:
+                        visited[neighbour] = True
+                        next_frontier.append(neighbour)
+            frontier = next_frontier
+    return np.array(order, dtype=np.int64)
+
+
+def get_bond_indices(molecule: Chem.Mol) -> np.ndarray:
+    """
+    Get the indices of the two atoms in every bond of the molecule as an (n_bonds, 2) array in the order of the
+    bond indices.
+    """
+    bonds = [
+        (bond.GetBeginAtomIdx(), bond.GetEndAtomIdx()) for bond in molecule.GetBonds()
+    ]
+    return np.array(bonds, dtype=np.int64).reshape(-1, 2)
@@ -1,4 +1,5 @@
-from typing import Literal
+import os
+from typing import Literal, Optional
 
 import torch
 
@@ -6,35 +7,99 @@ from naglmbis.models.base_model import MBISGraphModel
 from naglmbis.utils import get_model_weights
 
 charge_weights = {
-    "nagl-v1-mbis": {"checkpoint_path": "nagl-v1-mbis.ckpt"},
-    "nagl-v1-mbis-dipole": {"checkpoint_path": "nagl-v1-mbis-dipole.ckpt"},
+    "nagl-v1-mbis": {"checkpoint_path": "nagl-v1-mbis.ckpt", "model_type": "charge"},
+    "nagl-v1-mbis-dipole": {
+        "checkpoint_path": "nagl-v1-mbis-dipole.ckpt",
+        "model_type": "charge",
+    },
 }
-# volume_weights = {
-#     "nagl-v1": {"path": "mbis_volumes_v1.ckpt", "model": MBISGraphModel}
-# }
+# volume models are registered here once their weights are shipped in `naglmbis/data/models/volume`, a multi-readout
+# model made with `scripts/training/train_model.py` should also be added to `charge_weights` so the handler can
+# get both properties from a single forward pass. Models which are not shipped can be registered with the absolute
+# path of their checkpoint.
+volume_weights: dict[str, dict] = {}
 CHARGE_MODELS = Literal["nagl-v1-mbis-dipole", "nagl-v1-mbis"]
-# VOLUME_MODELS = Literal["nagl-v1"]
+VOLUME_MODELS = Literal[tuple(volume_weights)]
 
 
-def load_charge_model(charge_model: CHARGE_MODELS) -> MBISGraphModel:
+def _drop_unused_readouts(model_data: dict, readouts: list[str]):
     """
-    Load up one of the predefined charge models, this will load the weights and parameter settings.
+    Remove the settings and weights of any readout not in `readouts` from the checkpoint data in place.
+
+    Raises:
+        ValueError: If a requested readout is not part of the model.
+    """
+    model_readouts = model_data["hyper_parameters"]["config"]["model"]["readouts"]
+    missing_readouts = set(readouts) - set(model_readouts.keys())
+    if missing_readouts:
+        raise ValueError(
+            f"The model does not have the readouts {sorted(missing_readouts)}, available readouts are "
+            f"{list(model_readouts.keys())}."
+        )
+    unused_readouts = [name for name in model_readouts if name not in readouts]
+    for readout_name in unused_readouts:
+        del model_readouts[readout_name]
+        prefix = f"readout_modules.{readout_name}."
+        for key in [key for key in model_data["state_dict"] if key.startswith(prefix)]:
+            del model_data["state_dict"][key]
+
+
+def _load_model(
+    checkpoint_path: str, model_type: str, readouts: Optional[list[str]] = None
+) -> MBISGraphModel:
     """
-    weight_path = get_model_weights(
-        model_type="charge", model_name=charge_weights[charge_model]["checkpoint_path"]
-    )
+    Load the weights and parameter settings of a model shipped with naglmbis, or of the checkpoint at an absolute
+    path, optionally keeping only the requested readouts.
+    """
+    if os.path.isabs(checkpoint_path):
+        weight_path = checkpoint_path
+    else:
+        weight_path = get_model_weights(
+            model_type=model_type, model_name=checkpoint_path
+        )
     model_data = torch.load(weight_path)
+    if readouts is not None:
+        _drop_unused_readouts(model_data=model_data, readouts=readouts)
     model = MBISGraphModel(**model_data["hyper_parameters"])
     model.load_state_dict(model_data["state_dict"])
     model.eval()
     return model
 
 
-# def load_volume_model(volume_model: VOLUME_MODELS) -> MBISGraphModel:
-#     """
-#     Load one of the predefined volume models, this will load the weights and parameter settings.
-#     """
-#     weight_path = get_model_weights(
-#         model_type="volume", model_name=volume_weights[volume_model]["path"]
-#     )
-#     return volume_weights[volume_model]["model"].load_from_checkpoint(weight_path)
+def load_charge_model(
+    charge_model: CHARGE_MODELS, readouts: Optional[list[str]] = None
+) -> MBISGraphModel:
+    """
+    Load up one of the predefined charge models, this will load the weights and parameter settings.
+
+    Args:
+        charge_model: The name of the model to load.
+        readouts: The readouts to keep, the weights of any other readout are not loaded. By default all
+            readouts are kept.
+    """
+    return _load_model(**charge_weights[charge_model], readouts=readouts)
+
+
+def load_volume_model(
+    volume_model: VOLUME_MODELS, readouts: Optional[list[str]] = None
+) -> MBISGraphModel:
+    """
+    Load one of the predefined volume models, this will load the weights and parameter settings.
+
+    Volume models also have an `mbis-charges` readout so they can be used as the charge model to get both
+    properties from a single forward pass.
+
+    Args:
+        volume_model: The name of the model to load.
+        readouts: The readouts to keep, the weights of any other readout are not loaded. By default all
+            readouts are kept.
+
+    Raises:
+        ValueError: If the volume model is not registered.
+    """
+    if volume_model not in volume_weights:
+        raise ValueError(
+            f"The volume model {volume_model} is not available, the registered volume models are "
+            f"{list(volume_weights)}."
+        )
+    return _load_model(**volume_weights[volume_model], readouts=readouts)
@@ -0,0 +1,264 @@
+"""
+Assemble the charges of proteins and polymers from capped residue templates which are only predicted once.
+"""
+
+import json
+from typing import Optional
+
+import numpy as np
+from rdkit import Chem
+
+from naglmbis.charges import (
+    fix_net_charges,
+    get_canonical_order,
+    get_formal_charges,
+    get_molecule_offsets,
+)
+from naglmbis.models.base_model import MBISGraphModel
+
+# the peptide bond between a carbonyl carbon and the nitrogen of the next residue
+PEPTIDE_BOND_SMARTS = "[C;X3:1](=O)-[N;X3:2]-[C;X4]"
+
+
+def get_residues(
+    molecule: Chem.Mol, bond_smarts: Optional[list[str]] = None
+) -> list[np.ndarray]:
+    """
+    Split the molecule into residues.
+
+    Residues are taken from the PDB residue information of the atoms when every atom has it, otherwise the
+    molecule is cut at the bonds between the atoms mapped as 1 and 2 in any of the SMARTS patterns.
+
+    Args:
+        molecule: The molecule to split.
+        bond_smarts: The patterns of the bonds between residues, by default peptide bonds.
+
+    Returns:
+        The sorted atom indices of each residue.
+    """
+    residue_info = [atom.GetPDBResidueInfo() for atom in molecule.GetAtoms()]
+    if all(info is not None for info in residue_info):
+        residues = {}
+        for atom_index, info in enumerate(residue_info):
+            # blank chain ids and insertion codes may be a space or empty, e.g. on hydrogens added by RDKit
+            key = (
+                info.GetChainId().strip(),
+                info.GetResidueNumber(),
+                info.GetInsertionCode().strip(),
+            )
+            residues.setdefault(key, []).append(atom_index)
+        return [np.array(atoms, dtype=np.int64) for atoms in residues.values()]
+
+    cut_bonds = set()
+    for smarts in bond_smarts or [PEPTIDE_BOND_SMARTS]:
+        pattern = Chem.MolFromSmarts(smarts)
+        map_indices = {
+            atom.GetAtomMapNum(): atom.GetIdx() for atom in pattern.GetAtoms()
+        }
+        for match in molecule.GetSubstructMatches(pattern):
+            bond = molecule.GetBondBetweenAtoms(
+                match[map_indices[1]], match[map_indices[2]]
+            )
+            cut_bonds.add(bond.GetIdx())
+    if not cut_bonds:
+        return [np.arange(molecule.GetNumAtoms(), dtype=np.int64)]
+    fragments = Chem.GetMolFrags(
+        Chem.FragmentOnBonds(molecule, sorted(cut_bonds), addDummies=False)
+    )
+    return [np.array(sorted(atoms), dtype=np.int64) for atoms in fragments]
+
+
+def build_capped_template(
+    molecule: Chem.Mol, residue_atoms: np.ndarray
+) -> tuple[Chem.Mol, np.ndarray]:
+    """
+    Build a template molecule of the residue where each bond to another residue is capped with a hydrogen.
+
+    Returns:
+        The capped template, where the residue atoms keep their order and the caps come last, and the template
+        index of the residue atom each cap is bonded to.
+
+    Raises:
+        ValueError: If a bond between residues is not a single bond.
+    """
+    template_indices = {int(atom): i for i, atom in enumerate(residue_atoms)}
+    template = Chem.RWMol()
+    for atom_index in residue_atoms:
+        atom = molecule.GetAtomWithIdx(int(atom_index))
+        new_atom = Chem.Atom(atom.GetAtomicNum())
+        new_atom.SetFormalCharge(atom.GetFormalCharge())
+        new_atom.SetNumExplicitHs(atom.GetNumExplicitHs())
+        new_atom.SetNoImplicit(True)
+        new_atom.SetIsAromatic(atom.GetIsAromatic())
+        template.AddAtom(new_atom)
+
+    cap_partners = []
+    for bond in molecule.GetBonds():
+        begin, end = bond.GetBeginAtomIdx(), bond.GetEndAtomIdx()
+        if begin in template_indices and end in template_indices:
+            template.AddBond(
+                template_indices[begin], template_indices[end], bond.GetBondType()
+            )
+        elif begin in template_indices or end in template_indices:
+            if bond.GetBondType() != Chem.BondType.SINGLE:
+                raise ValueError(
+                    f"Only single bonds can be cut between residues, found a {bond.GetBondType()} bond between "
+                    f"atoms {begin} and {end}."
+                )
+            partner = template_indices.get(begin, template_indices.get(end))
+            cap = template.AddAtom(Chem.Atom(1))
+            template.AddBond(partner, cap, Chem.BondType.SINGLE)
+            cap_partners.append(partner)
+
+    template = template.GetMol()
+    Chem.SanitizeMol(template)
+    return template, np.array(cap_partners, dtype=np.int64)
+
+
+class TemplateLibrary:
+    """
+    A persistent library of capped residue template charges keyed by the canonical smiles of the template and
+    stored in canonical atom order.
+    """
+
+    def __init__(
+        self, model_name: str, templates: Optional[dict[str, np.ndarray]] = None
+    ):
+        """
+        Args:
+            model_name: The name of the charge model used to predict the templates.
+            templates: The canonical order charges of each template.
+        """
+        self.model_name = model_name
+        self.templates = templates or {}
+
+    def __len__(self):
+        return len(self.templates)
+
+    def __contains__(self, smiles: str):
+        return smiles in self.templates
+
+    def to_file(self, file_name: str):
+        """Write the library to a json file."""
+        with open(file_name, "w") as output:
+            json.dump(
+                {
+                    "model_name": self.model_name,
+                    "templates": {
+                        smiles: charges.tolist()
+                        for smiles, charges in self.templates.items()
+                    },
+                },
+                output,
+                indent=2,
+            )
+
+    @classmethod
+    def from_file(cls, file_name: str) -> "TemplateLibrary":
+        """Load a library made with `to_file`."""
+        with open(file_name) as data_file:
+            data = json.load(data_file)
+        return cls(
+            model_name=data["model_name"],
+            templates={
+                smiles: np.array(charges, dtype=np.float64)
+                for smiles, charges in data["templates"].items()
+            },
+        )
+
+    def check_model(self, model_name: str):
+        """
+        Raises:
+            ValueError: If the library was made with a different model.
+        """
+        if model_name != self.model_name:
+            raise ValueError(
+                f"The template library was made with the model {self.model_name} not {model_name}."
+            )
+
+
+class ResidueTemplateCharges:
+    """
+    Predict the charges of proteins and polymers by predicting each unique capped residue once.
+
+    The charge of each cap is moved onto the residue atom it replaced a bond to, so every residue keeps the
+    integer charge of its template, and any remaining rounding difference is spread over the whole molecule.
+    """
+
+    def __init__(
+        self,
+        model: MBISGraphModel,
+        model_name: str,
+        library: TemplateLibrary,
+        bond_smarts: Optional[list[str]] = None,
+    ):
+        """
+        Args:
+            model: The charge model used to predict new templates.
+            model_name: The name of the charge model, which must match the model the library was made with.
+            library: The template library which is read from and extended with new templates.
+            bond_smarts: The patterns of the bonds between residues when there is no PDB residue information,
+                see `get_residues`.
+
+        Raises:
+            ValueError: If the library was made with a different model.
+        """
+        library.check_model(model_name)
+        self.model = model
+        self.model_name = model_name
+        self.library = library
+        self.bond_smarts = bond_smarts
+        self.n_residues = 0
+        self.n_predicted = 0
+
+    def compute_charges(self, molecule: Chem.Mol) -> np.ndarray:
+        """
+        Compute the charges of a molecule with explicit hydrogens from its residue templates.
+
+        Returns:
+            The flat array of atom charges.
+        """
+        residues = get_residues(molecule, bond_smarts=self.bond_smarts)
+        templates = []
+        for residue_atoms in residues:
+            template, cap_partners = build_capped_template(molecule, residue_atoms)
+            templates.append(
+                (residue_atoms, cap_partners, template, *get_canonical_order(template))
+            )
+        self.n_residues += len(residues)
+
+        # predict the unique new templates in a single batch
+        new_templates = {}
+        for _, _, template, smiles, _ in templates:
+            if smiles not in self.library and smiles not in new_templates:
+                new_templates[smiles] = template
+        if new_templates:
+            new_molecules = list(new_templates.values())
+            predictions = self.model.compute_batch_properties(
+                molecules=new_molecules,
+                readouts=["mbis-charges"],
+                molecule_ids=list(new_templates.keys()),
+            )
+            for i, (smiles, template) in enumerate(new_templates.items()):
+                _, canonical_ranks = get_canonical_order(template)
+                canonical_charges = np.empty(template.GetNumAtoms())
+                canonical_charges[canonical_ranks] = predictions.get_molecule(i)[
+                    "mbis-charges"
+                ].reshape(-1)
+                self.library.templates[smiles] = canonical_charges
+            self.n_predicted += len(new_templates)
+
+        molecule_charges = np.zeros(molecule.GetNumAtoms())
+        for residue_atoms, cap_partners, _, smiles, canonical_ranks in templates:
+            template_charges = self.library.templates[smiles][canonical_ranks]
+            n_residue_atoms = len(residue_atoms)
+            residue_charges = template_charges[:n_residue_atoms].copy()
+            # the caps stand in for the neighbouring residues so give their charge to the boundary atoms
+            np.add.at(residue_charges, cap_partners, template_charges[n_residue_atoms:])
+            molecule_charges[residue_atoms] = residue_charges
+
+        return fix_net_charges(
+            molecule_charges,
+            molecule_offsets=get_molecule_offsets([molecule.GetNumAtoms()]),
+            total_charges=get_formal_charges([molecule]),
+        )
@@ -0,0 +1,172 @@
+"""
+Tools to precompile the NAGLMBIS parameters of a set of molecules into a reusable parameter library.
+"""
+
+import functools
+import json
+import os
+from typing import TYPE_CHECKING, Iterable, Optional
+from xml.etree import ElementTree
+
+import numpy as np
+from openff.toolkit.topology import Molecule
+from rdkit import Chem
+
+from naglmbis.charges import get_canonical_order, get_molecule_offsets
+from naglmbis.plugins.pipeline import NonbondedParameters
+
+if TYPE_CHECKING:
+    from naglmbis.plugins.plugins import NAGLMBISHandler
+
+
+class NonbondedLibrary:
+    """
+    A library of final NAGLMBIS parameters stored in canonical atom order and keyed by the canonical smiles of each
+    molecule, along with the handler settings used to generate them.
+    """
+
+    def __init__(
+        self,
+        settings: dict,
+        parameters: Optional[dict[str, NonbondedParameters]] = None,
+    ):
+        """
+        Args:
+            settings: The model and net charge settings of the handler used to make the parameters.
+            parameters: The canonical order parameters keyed by canonical smiles.
+        """
+        self.settings = dict(settings)
+        self.parameters = parameters or {}
+
+    def __len__(self):
+        return len(self.parameters)
+
+    def __contains__(self, smiles: str):
+        return smiles in self.parameters
+
+    def add_molecule(self, molecule: Molecule, parameters: NonbondedParameters):
+        """Add the parameters of a molecule given in the molecule atom order."""
+        canonical_smiles, canonical_ranks = get_canonical_order(molecule.to_rdkit())
+        self.parameters[canonical_smiles] = parameters.to_canonical_order(
+            canonical_ranks
+        )
+
+    def get_molecule_parameters(
+        self, molecule: Molecule
+    ) -> Optional[NonbondedParameters]:
+        """
+        Get the parameters of the molecule in its atom order or `None` if the molecule is not in the library.
+        """
+        canonical_smiles, canonical_ranks = get_canonical_order(molecule.to_rdkit())
+        canonical_parameters = self.parameters.get(canonical_smiles, None)
+        if canonical_parameters is None:
+            return None
+        return canonical_parameters.from_canonical_order(canonical_ranks)
+
+    def check_settings(self, settings: dict):
+        """
+        Raises:
+            ValueError: If the library was made with different model settings.
+        """
+        if settings != self.settings:
+            raise ValueError(
+                f"The parameter library was made with the settings {self.settings} which do not match the "
+                f"requested settings {settings}."
+            )
+
+    def to_file(self, file_name: str):
+        """Write the library to a compressed numpy archive."""
+        smiles = list(self.parameters.keys())
+        parameters = [self.parameters[key] for key in smiles]
+        np.savez_compressed(
+            file_name,
+            settings=np.array(json.dumps(self.settings)),
+            smiles=np.array(smiles, dtype=str),
+            offsets=get_molecule_offsets([len(p.charges) for p in parameters]),
+            charges=np.concatenate([p.charges for p in parameters]),
+            sigmas=np.concatenate([p.sigmas for p in parameters]),
+            epsilons=np.concatenate([p.epsilons for p in parameters]),
+        )
+
+    @classmethod
+    def from_file(cls, file_name: str) -> "NonbondedLibrary":
+        """Load a library from a numpy archive made with `to_file`."""
+        with np.load(file_name, allow_pickle=False) as data:
+            offsets = data["offsets"]
+            charges, sigmas, epsilons = (
+                data["charges"],
+                data["sigmas"],
+                data["epsilons"],
+            )
+            parameters = {
+                str(smiles): NonbondedParameters(
+                    charges=charges[start:end],
+                    sigmas=sigmas[start:end],
+                    epsilons=epsilons[start:end],
+                )
+                for smiles, start, end in zip(data["smiles"], offsets[:-1], offsets[1:])
+            }
+            return cls(
+                settings=json.loads(str(data["settings"])), parameters=parameters
+            )
+
+    def to_offxml(self, file_name: str):
+        """
+        Write the charges in the library to an offxml fragment of library charges which can be combined with any
+        openff force field. The LJ parameters are per-atom and are only stored by `to_file`.
+        """
+        root = ElementTree.Element(
+            "SMIRNOFF", version="0.3", aromaticity_model="OEAroModel_MDL"
+        )
+        library_charges = ElementTree.SubElement(root, "LibraryCharges", version="0.3")
+        smiles_parser = Chem.SmilesParserParams()
+        smiles_parser.removeHs = False
+        for smiles, canonical_parameters in self.parameters.items():
+            rdkit_mol = Chem.MolFromSmiles(smiles, smiles_parser)
+            _, canonical_ranks = get_canonical_order(rdkit_mol)
+            charges = canonical_parameters.from_canonical_order(canonical_ranks).charges
+            for atom in rdkit_mol.GetAtoms():
+                atom.SetAtomMapNum(atom.GetIdx() + 1)
+            attributes = {"smirks": Chem.MolToSmiles(rdkit_mol)}
+            for i, charge in enumerate(charges):
+                attributes[f"charge{i + 1}"] = f"{charge:.10f} * elementary_charge"
+            ElementTree.SubElement(library_charges, "LibraryCharge", **attributes)
+        ElementTree.indent(root)
+        ElementTree.ElementTree(root).write(file_name)
+
+
+@functools.lru_cache(maxsize=16)
+def _load_parameter_library(
+    file_name: str, modified_time: int, file_size: int
+) -> NonbondedLibrary:
+    return NonbondedLibrary.from_file(file_name)
+
+
+def load_parameter_library(file_name: str) -> NonbondedLibrary:
+    """
+    Load a parameter library from file, each version of a library is only read once per process while a library
+    which is rebuilt in place is read again.
+    """
+    file_stat = os.stat(file_name)
+    return _load_parameter_library(
+        os.path.abspath(file_name), file_stat.st_mtime_ns, file_stat.st_size
+    )
+
+
+def build_parameter_library(
+    molecules: Iterable[Molecule], handler: "NAGLMBISHandler"
+) -> NonbondedLibrary:
+    """
+    Run the full NAGLMBIS pipeline once for each molecule and collect the final parameters into a library.
+
+    Args:
+        molecules: The molecules to add to the library.
+        handler: The NAGLMBIS handler with the model settings which should be used.
+    """
+    library = NonbondedLibrary(settings=handler.get_model_settings())
+    for molecule in molecules:
+        library.add_molecule(
+            molecule=molecule,
+            parameters=handler.get_molecule_parameters(molecule=molecule),
+        )
+    return library
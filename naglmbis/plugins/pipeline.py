@@ -0,0 +1,197 @@
+"""
+A lightweight nonbonded parameter pipeline which works on flat arrays rather than QUBEKit molecules.
+
+The QUBEKit `Ligand` based route is kept in `naglmbis.plugins.trained_models` as a verification reference only.
+"""
+
+import dataclasses
+from typing import Callable, Literal, Optional, Union
+
+import numpy as np
+from openff.toolkit.topology import Molecule
+from openff.toolkit.typing.engines.smirnoff import ParameterHandler
+from openmm import unit
+from rdkit import Chem
+
+from naglmbis.charges import (
+    apply_bond_charge_corrections,
+    fix_net_charge,
+    fix_net_charges,
+    get_molecule_offsets,
+    get_symmetry_classes,
+    symmetrise,
+)
+from naglmbis.lennard_jones import (
+    LennardJones612Model,
+    find_polar_hydrogens,
+    get_atomic_numbers,
+)
+from naglmbis.models import MBISGraphModel
+
+
+@dataclasses.dataclass
+class NonbondedParameters:
+    """The final nonbonded parameters of each atom in a molecule."""
+
+    charges: np.ndarray
+    """The partial charge of each atom in e."""
+    sigmas: np.ndarray
+    """The LJ sigma of each atom in nm."""
+    epsilons: np.ndarray
+    """The LJ epsilon of each atom in kJ / mol."""
+
+    def to_canonical_order(self, canonical_ranks: np.ndarray) -> "NonbondedParameters":
+        """Reorder the parameters from the molecule atom order into canonical atom order."""
+        parameters = {}
+        for field in dataclasses.fields(self):
+            values = getattr(self, field.name)
+            canonical_values = np.empty_like(values)
+            canonical_values[canonical_ranks] = values
+            parameters[field.name] = canonical_values
+        return NonbondedParameters(**parameters)
+
+    def from_canonical_order(
+        self, canonical_ranks: np.ndarray
+    ) -> "NonbondedParameters":
+        """Reorder the parameters from canonical atom order into the atom order given by the canonical ranks."""
+        return NonbondedParameters(
+            **{
+                field.name: getattr(self, field.name)[canonical_ranks]
+                for field in dataclasses.fields(self)
+            }
+        )
+
+
+def predict_mbis_properties(
+    molecule: Chem.Mol,
+    charge_model: Union[MBISGraphModel, Callable],
+    volume_model: MBISGraphModel,
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Predict the MBIS charges and volumes of the molecule.
+
+    When the same multi-readout model is used for the charges and volumes both properties come from a single
+    featurization and convolution pass.
+
+    Args:
+        molecule: The rdkit molecule to predict the properties for.
+        charge_model: A nagl charge model or the espaloma charge function.
+        volume_model: The nagl volume model.
+
+    Returns:
+        The flat arrays of charges and volumes.
+    """
+    # only evaluate the readouts we need from each model
+    if charge_model is volume_model:
+        properties = volume_model.compute_properties(
+            molecule=molecule, readouts=["mbis-charges", "mbis-volumes"]
+        )
+        charges = properties["mbis-charges"].detach().numpy()
+        volumes = properties["mbis-volumes"]
+    else:
+        if isinstance(charge_model, MBISGraphModel):
+            charges = charge_model.compute_properties(
+                molecule=molecule, readouts=["mbis-charges"]
+            )["mbis-charges"]
+            charges = charges.detach().numpy()
+        else:
+            charges = charge_model(molecule)
+        volumes = volume_model.compute_properties(
+            molecule=molecule, readouts=["mbis-volumes"]
+        )["mbis-volumes"]
+    return (
+        np.asarray(charges, dtype=np.float64).reshape(-1),
+        volumes.detach().numpy().astype(np.float64).reshape(-1),
+    )
+
+
+def get_bond_charge_corrections(
+    molecule: Molecule, bcc_model: ParameterHandler
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Find the bond charge corrections which should be applied to the molecule.
+
+    Returns:
+        The (n_bccs, 2) array of atom indices which gain and lose charge and the array of corrections in e.
+    """
+    matches = bcc_model.find_matches(molecule.to_topology())
+    # the matches have been sorted so we need to use
+    # the environment match to ensure we get the correct atoms
+    atom_indices = [
+        match.environment_match.topology_atom_indices for match in matches.values()
+    ]
+    corrections = [
+        match.parameter_type.charge_correction.value_in_unit(unit.elementary_charge)
+        for match in matches.values()
+    ]
+    return np.array(atom_indices, dtype=np.int64).reshape(-1, 2), np.array(
+        corrections, dtype=np.float64
+    )
+
+
+def compute_nonbonded_parameters(
+    molecule: Molecule,
+    charge_model: Union[MBISGraphModel, Callable],
+    volume_model: MBISGraphModel,
+    lj_model: LennardJones612Model,
+    bcc_model: Optional[ParameterHandler] = None,
+    net_charge_method: Literal["qubekit", "equal"] = "qubekit",
+) -> NonbondedParameters:
+    """
+    Run the full NAGLMBIS pipeline for a molecule: prediction, bond charge corrections, symmetrisation, net charge
+    correction and LJ parameter assignment.
+
+    Args:
+        molecule: The openff molecule to parameterise.
+        charge_model: A nagl charge model or the espaloma charge function.
+        volume_model: The nagl volume model.
+        lj_model: The Rfree model used to derive the LJ parameters.
+        bcc_model: The optional bond charge correction handler.
+        net_charge_method: How the charges are corrected to the formal charge, `qubekit` rounds the charges to 6
+            decimals and puts the difference on the last atom like QUBEKit, `equal` spreads it over every atom.
+
+    Returns:
+        The charge, sigma and epsilon of each atom.
+
+    Raises:
+        ValueError: If the net charge method is not known.
+    """
+    if net_charge_method not in ("qubekit", "equal"):
+        raise ValueError(
+            f"The net charge method {net_charge_method} is not supported, use `qubekit` or `equal`."
+        )
+    rdkit_mol = molecule.to_rdkit()
+    atomic_numbers = get_atomic_numbers(rdkit_mol)
+    polar_h_partners = find_polar_hydrogens(rdkit_mol)
+    # before we predict make sure we have enough Rfree terms to run
+    lj_model.check_element_coverage(atomic_numbers, polar_h_partners)
+
+    charges, volumes = predict_mbis_properties(
+        molecule=rdkit_mol, charge_model=charge_model, volume_model=volume_model
+    )
+    if bcc_model is not None:
+        bcc_indices, bcc_corrections = get_bond_charge_corrections(
+            molecule=molecule, bcc_model=bcc_model
+        )
+        charges = apply_bond_charge_corrections(charges, bcc_indices, bcc_corrections)
+
+    # apply charge and volume symmetry probably handled by the GNN but apply to be sure
+    symmetry_classes = get_symmetry_classes(rdkit_mol)
+    charges = symmetrise(charges, symmetry_classes)
+    volumes = symmetrise(volumes, symmetry_classes)
+    total_charge = Chem.GetFormalCharge(rdkit_mol)
+    if net_charge_method == "qubekit":
+        charges = fix_net_charge(charges, total_charge=total_charge)
+    else:
+        charges = fix_net_charges(
+            charges,
+            molecule_offsets=get_molecule_offsets([rdkit_mol.GetNumAtoms()]),
+            total_charges=[total_charge],
+        )
+
+    sigmas, epsilons = lj_model.compute_parameters(
+        atomic_numbers=atomic_numbers,
+        volumes=volumes,
+        polar_h_partners=polar_h_partners,
+    )
+    return NonbondedParameters(charges=charges, sigmas=sigmas, epsilons=epsilons)
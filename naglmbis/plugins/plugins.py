@@ -1,4 +1,8 @@
-from openff.toolkit.topology import TopologyAtom, TopologyVirtualSite
+import functools
+
+import numpy as np
+import openmm
+from openff.toolkit.topology import Molecule, TopologyAtom, TopologyVirtualSite
 from openff.toolkit.typing.engines.smirnoff import (
     ElectrostaticsHandler,
     LibraryChargeHandler,
@@ -10,12 +14,34 @@ from openff.toolkit.typing.engines.smirnoff.parameters import (
     _NonbondedHandler,
 )
 from openmm import unit
-from qubekit.charges import MBISCharges
-from qubekit.molecules import Ligand
 
+from naglmbis.charges import get_canonical_order
+from naglmbis.lennard_jones import LJ_MODELS
 from naglmbis.models import load_charge_model, load_volume_model
+from naglmbis.models.models import charge_weights, volume_weights
 from naglmbis.plugins.bccs import bcc_force_fields, load_bcc_model
-from naglmbis.plugins.trained_models import trained_models
+from naglmbis.plugins.library import load_parameter_library
+from naglmbis.plugins.pipeline import (
+    NonbondedParameters,
+    compute_nonbonded_parameters,
+)
+
+# models are shared between handlers and only loaded once per process
+_load_charge_model = functools.lru_cache(maxsize=None)(load_charge_model)
+_load_volume_model = functools.lru_cache(maxsize=None)(load_volume_model)
+_load_bcc_model = functools.lru_cache(maxsize=None)(load_bcc_model)
+
+
+def _allow_registered(registry: dict, extra_values: list):
+    """
+    Like `_allow_only` but the allowed values are read from the model registry each time the attribute is set, so
+    models registered after the handler class is made can be used.
+    """
+
+    def _value_checker(instance, attr, new_value):
+        return _allow_only(list(registry) + extra_values)(instance, attr, new_value)
+
+    return _value_checker
 
 
 class NAGLMBISHandler(_NonbondedHandler):
@@ -31,25 +57,66 @@ class NAGLMBISHandler(_NonbondedHandler):
     ]  # we need to let waters be handled by libray charges first
     _KWARGS = []
     charge_model = ParameterAttribute(
-        default="nagl-v1", converter=_allow_only(["nagl-v1", "espaloma-v1"])
+        default="nagl-v1-mbis",
+        converter=_allow_registered(charge_weights, ["espaloma-v1"]),
     )
+    # no volume model weights are shipped yet so a volume model must be set once one is registered, a model
+    # registered as both a charge and volume model can be used for both to get the properties from a single pass
     volume_model = ParameterAttribute(
-        default="nagl-v1", converter=_allow_only(["nagl-v1"])
+        default=None, converter=_allow_registered(volume_weights, [None])
     )
     rfree_model = ParameterAttribute(
-        default=1, converter=_allow_only(list(trained_models.keys()))
+        default=1, converter=_allow_only(list(LJ_MODELS.keys()))
     )
     bcc_model = ParameterAttribute(
         default=None, converter=_allow_only(list(bcc_force_fields.keys()) + [None])
     )
+    # how the charges are corrected to the formal charge, see `compute_nonbonded_parameters`
+    net_charge_method = ParameterAttribute(
+        default="qubekit", converter=_allow_only(["qubekit", "equal"])
+    )
+    # an optional precompiled library of parameters made with `build_parameter_library`
+    parameter_library = ParameterAttribute(default=None)
+
+    # the attributes which change the final parameters of a molecule
+    _MODEL_ATTRIBUTES = (
+        "charge_model",
+        "volume_model",
+        "rfree_model",
+        "bcc_model",
+        "net_charge_method",
+    )
 
     def check_handler_compatibility(self, handler_kwargs):
         """We do not want to be mixed with AM1 handler as this is not compatible."""
         pass
 
-    def create_force(self, system, topology, **kwargs):
+    def __setattr__(self, key, value):
+        super().__setattr__(key, value)
+        if key in self._MODEL_ATTRIBUTES:
+            self.clear_parameter_cache()
+
+    @property
+    def _parameter_cache(self) -> dict[tuple, NonbondedParameters]:
+        """The memo of final parameters in canonical atom order keyed by the molecule and model settings."""
+        if "_nonbonded_parameter_cache" not in self.__dict__:
+            self.__dict__["_nonbonded_parameter_cache"] = {}
+        return self.__dict__["_nonbonded_parameter_cache"]
+
+    def clear_parameter_cache(self):
+        """Remove all memoized molecule parameters."""
+        self.__dict__["_nonbonded_parameter_cache"] = {}
+
+    def get_model_settings(self) -> dict:
+        """Get the model settings of the handler which determine the final parameters of a molecule."""
+        return {
+            attribute: getattr(self, attribute) for attribute in self._MODEL_ATTRIBUTES
+        }
+
+    def _load_models(self) -> dict:
+        """Load the charge, volume, LJ and BCC models requested by the handler."""
         if "nagl" in self.charge_model:
-            charge_model = load_charge_model(charge_model=self.charge_model)
+            charge_model = _load_charge_model(charge_model=self.charge_model)
         elif "espaloma" in self.charge_model:
             from espaloma_charge import charge
 
@@ -59,13 +126,100 @@ class NAGLMBISHandler(_NonbondedHandler):
                 "Only NAGL and Esaploma type models are supported!"
             )
         bcc_model = None
-        if self.bcc_model is not None:
-            bcc_model = load_bcc_model(self.bcc_model)
+        # bccs were only fit for the nagl charge models
+        if self.bcc_model is not None and "nagl" in self.charge_model:
+            bcc_model = _load_bcc_model(self.bcc_model)
 
-        volume_model = load_volume_model(volume_model=self.volume_model)
-        # the volume and charge models are tied to the trained model
-        lj = trained_models[self.rfree_model]
+        if self.volume_model is None:
+            raise ValueError(
+                "A volume model is needed to derive the LJ parameters, set `volume_model` to one of "
+                f"{list(volume_weights)}."
+            )
+        if self.volume_model == self.charge_model:
+            # share the multi-readout model so the plugin only runs it once
+            volume_model = charge_model
+        else:
+            volume_model = _load_volume_model(volume_model=self.volume_model)
+
+        return {
+            "charge_model": charge_model,
+            "volume_model": volume_model,
+            # the volume and charge models are tied to the trained model
+            "lj_model": LJ_MODELS[self.rfree_model],
+            "bcc_model": bcc_model,
+        }
+
+    def get_molecule_parameters(self, molecule: Molecule) -> NonbondedParameters:
+        """
+        Get the nonbonded parameters of the molecule, reusing the memoized parameters of any molecule which has
+        already been seen with the same model settings. Molecules in the parameter library are not predicted.
+        """
+        canonical_smiles, canonical_ranks = get_canonical_order(molecule.to_rdkit())
+        settings = self.get_model_settings()
+        key = (canonical_smiles,) + tuple(settings.values())
+        canonical_parameters = self._parameter_cache.get(key, None)
+        if canonical_parameters is None and self.parameter_library is not None:
+            library = load_parameter_library(self.parameter_library)
+            library.check_settings(settings)
+            canonical_parameters = library.parameters.get(canonical_smiles, None)
+            if canonical_parameters is not None:
+                self._parameter_cache[key] = canonical_parameters
+
+        if canonical_parameters is None:
+            parameters = compute_nonbonded_parameters(
+                molecule=molecule,
+                net_charge_method=self.net_charge_method,
+                **self._load_models(),
+            )
+            self._parameter_cache[key] = parameters.to_canonical_order(canonical_ranks)
+            return parameters
+
+        return canonical_parameters.from_canonical_order(canonical_ranks)
+
+    @staticmethod
+    def _get_particle_indices(topology, ref_mol: Molecule) -> np.ndarray:
+        """
+        Get the topology particle index and reference molecule particle index of every copy of the reference
+        molecule in the topology as an array of shape (n_particles, 2).
+        """
+        particle_indices = []
+        for topology_molecule in topology._reference_molecule_to_topology_molecules[
+            ref_mol
+        ]:
+            for topology_particle in topology_molecule.atoms:
+                if type(topology_particle) is TopologyAtom:
+                    ref_mol_particle_index = (
+                        topology_particle.atom.molecule_particle_index
+                    )
+                elif type(topology_particle) is TopologyVirtualSite:
+                    ref_mol_particle_index = (
+                        topology_particle.virtual_site.molecule_particle_index
+                    )
+                else:
+                    raise ValueError(
+                        f"Particles of type {type(topology_particle)} are not supported"
+                    )
+                particle_indices.append(
+                    (topology_particle.topology_particle_index, ref_mol_particle_index)
+                )
+        return np.array(particle_indices, dtype=np.int64).reshape(-1, 2)
 
+    @staticmethod
+    def _set_particle_parameters(
+        force: openmm.NonbondedForce,
+        particle_indices: np.ndarray,
+        parameters: NonbondedParameters,
+    ):
+        """Set the nonbonded force parameters of the (topology index, molecule index) pairs."""
+        for topology_particle_index, ref_mol_particle_index in particle_indices:
+            force.setParticleParameters(
+                int(topology_particle_index),
+                parameters.charges[ref_mol_particle_index],
+                parameters.sigmas[ref_mol_particle_index],
+                parameters.epsilons[ref_mol_particle_index],
+            )
+
+    def create_force(self, system, topology, **kwargs):
         force = super().create_force(system, topology, **kwargs)
 
         for ref_mol in topology.reference_molecules:
@@ -74,93 +228,162 @@ class NAGLMBISHandler(_NonbondedHandler):
             if self.check_charges_assigned(ref_mol, topology):
                 continue
 
-            # qubekit assumes conformers so make one if there are non
-            if ref_mol.n_conformers == 0:
-                ref_mol.generate_conformers(n_conformers=1)
-
-            qb_mol = Ligand.from_rdkit(ref_mol.to_rdkit())
-            # before we run make sure we have enough Rfree terms to run
-            lj.check_element_coverage(molecule=qb_mol)
-
-            bcc_matches = None
-            # predict the mbis charges and volumes
-            if "nagl" in self.charge_model:
-                mbis_charges = charge_model.compute_properties(molecule=ref_mol)[
-                    "mbis-charges"
-                ].detach()
-                if bcc_model is not None:
-                    bcc_matches = bcc_model.find_matches(ref_mol.to_topology())
-            elif "espaloma" in self.charge_model:
-                mbis_charges = charge_model(ref_mol.to_rdkit())
-                mbis_charges = mbis_charges.reshape((ref_mol.n_atoms, 1))
-            mbis_volumes = volume_model.compute_properties(molecule=ref_mol)[
-                "mbis-volumes"
-            ].detach()
-
-            # fix the charges and volumes
-            for i in range(qb_mol.n_atoms):
-                qb_mol.atoms[i].aim.charge = float(mbis_charges[i][0])
-                qb_mol.atoms[i].aim.volume = float(mbis_volumes[i][0])
-            # check for bccs and transfer charges
-            if bcc_matches is not None:
-                # the matches have been sorted so we need to use
-                # the environment match to ensure we get the correct atoms
-                for match in bcc_matches.values():
+            parameters = self.get_molecule_parameters(molecule=ref_mol)
+
+            # now assign the parameters in the openmm system
+            self._set_particle_parameters(
+                force=force,
+                particle_indices=self._get_particle_indices(topology, ref_mol),
+                parameters=parameters,
+            )
+
+            # Mark that we have assigned the parameters
+            self.mark_charges_assigned(ref_mol, topology)
+
+    @staticmethod
+    def _get_molecule_template(
+        force: openmm.NonbondedForce, particle_indices: np.ndarray, n_particles: int
+    ) -> tuple[NonbondedParameters, list[tuple]]:
+        """
+        Read the particle parameters and the exceptions of one copy of a molecule from a nonbonded force.
+
+        Args:
+            force: The nonbonded force which holds the copy.
+            particle_indices: The (topology index, molecule index) pairs of the particles of the copy.
+            n_particles: The number of particles in the molecule.
+
+        Returns:
+            The parameters of each particle in molecule order and the exceptions as tuples of the two molecule
+            particle indices, the charge product, sigma and epsilon.
+        """
+        charges, sigmas, epsilons = (np.empty(n_particles) for _ in range(3))
+        for topology_particle_index, ref_mol_particle_index in particle_indices:
+            charge, sigma, epsilon = force.getParticleParameters(
+                int(topology_particle_index)
+            )
+            charges[ref_mol_particle_index] = charge.value_in_unit(
+                unit.elementary_charge
+            )
+            sigmas[ref_mol_particle_index] = sigma.value_in_unit(unit.nanometer)
+            epsilons[ref_mol_particle_index] = epsilon.value_in_unit(
+                unit.kilojoule_per_mole
+            )
+
+        to_molecule = dict(particle_indices.tolist())
+        exceptions = []
+        for exception_index in range(force.getNumExceptions()):
+            particle_1, particle_2, *exception_parameters = (
+                force.getExceptionParameters(exception_index)
+            )
+            if particle_1 in to_molecule and particle_2 in to_molecule:
+                exceptions.append(
                     (
-                        charge_added_atom,
-                        charge_subtracted_atom,
-                    ) = match.environment_match.topology_atom_indices
-                    charge_correction = (
-                        match.parameter_type.charge_correction.value_in_unit(
-                            unit.elementary_charge
-                        )
+                        to_molecule[particle_1],
+                        to_molecule[particle_2],
+                        *exception_parameters,
                     )
-                    qb_mol.atoms[charge_added_atom].aim.charge += charge_correction
-                    qb_mol.atoms[charge_subtracted_atom].aim.charge -= charge_correction
-
-            # apply charge and volume symmetry probably handled by the GNN but apply to be sure
-            MBISCharges.apply_symmetrisation(qb_mol)
-            # update nonbonded params with aim values and fix net charge
-            for i in range(qb_mol.n_atoms):
-                atom = qb_mol.atoms[i]
-                qb_mol.NonbondedForce.create_parameter(
-                    atoms=(i,), charge=atom.aim.charge, sigma=0, epsilon=0
                 )
+        return (
+            NonbondedParameters(charges=charges, sigmas=sigmas, epsilons=epsilons),
+            exceptions,
+        )
 
-            qb_mol.fix_net_charge()
+    def extend_force(
+        self,
+        force: openmm.NonbondedForce,
+        topology,
+        n_existing_particles: int,
+        force_field,
+    ):
+        """
+        Incrementally parameterise a topology which was grown by adding molecules to the end of a topology which has
+        already been parameterised.
 
-            # calculate the LJ terms for the model
-            lj.run(qb_mol)
+        Only the particles from `n_existing_particles` onwards are written, along with their exceptions. New copies
+        of molecules which are already in the force copy the parameters and exceptions of an existing copy. A single
+        copy of each new species is parameterised with the full force field, so library charged molecules such as
+        ions are skipped by `create_force` exactly as in a full build, the vdW types and 1-4 scaling come from the
+        force field and only molecules never seen by the memoized handler run through prediction.
 
-            # now assign the parameters in the openmm system
-            for topology_molecule in topology._reference_molecule_to_topology_molecules[
-                ref_mol
-            ]:
-                for topology_particle in topology_molecule.atoms:
-                    if type(topology_particle) is TopologyAtom:
-                        ref_mol_particle_index = (
-                            topology_particle.atom.molecule_particle_index
-                        )
-                    elif type(topology_particle) is TopologyVirtualSite:
-                        ref_mol_particle_index = (
-                            topology_particle.virtual_site.molecule_particle_index
-                        )
-                    else:
-                        raise ValueError(
-                            f"Particles of type {type(topology_particle)} are not supported"
-                        )
-
-                    topology_particle_index = topology_particle.topology_particle_index
-                    particle_parameters = qb_mol.NonbondedForce[
-                        (ref_mol_particle_index,)
-                    ]
-                    # Set the nonbonded force parameters
-                    force.setParticleParameters(
-                        topology_particle_index,
-                        particle_parameters.charge,
-                        particle_parameters.sigma,
-                        particle_parameters.epsilon,
+        Only the nonbonded force is extended, the caller must add the new particles and their masses to the
+        `openmm.System` and extend every other force, such as the bonded forces, constraints and virtual sites. The
+        existing molecules must keep their order at the start of the topology.
+
+        Args:
+            force: The nonbonded force of the existing system, particles are added for the new molecules.
+            topology: The full topology including the new molecules.
+            n_existing_particles: The number of particles which already have parameters in the force, this must
+                be the number of particles in the force.
+            force_field: The force field which made the force, it must use this handler.
+
+        Raises:
+            ValueError: If the force field does not use this handler or the number of existing particles does
+                not match the force or the topology.
+        """
+        if force_field.get_parameter_handler(self._TAGNAME) is not self:
+            raise ValueError(
+                "The force field must use this handler so the memoized parameters are shared."
+            )
+        if n_existing_particles != force.getNumParticles():
+            raise ValueError(
+                f"The force has {force.getNumParticles()} particles but {n_existing_particles} existing particles "
+                f"were given."
+            )
+        if n_existing_particles > topology.n_topology_particles:
+            raise ValueError(
+                f"The topology has {topology.n_topology_particles} particles, fewer than the "
+                f"{n_existing_particles} existing particles."
+            )
+
+        for _ in range(force.getNumParticles(), topology.n_topology_particles):
+            force.addParticle(0.0, 1.0, 0.0)
+
+        for ref_mol in topology.reference_molecules:
+            # group the particles by copy of the molecule
+            n_copies = len(topology._reference_molecule_to_topology_molecules[ref_mol])
+            particle_indices = self._get_particle_indices(topology, ref_mol).reshape(
+                n_copies, -1, 2
+            )
+            is_new = particle_indices[:, 0, 0] >= n_existing_particles
+            if not is_new.any():
+                continue
+
+            if is_new.all():
+                # build a single copy with the whole force field so it is charged by the same handler as in a full build
+                molecule_topology = ref_mol.to_topology()
+                template_force = _get_nonbonded_force(
+                    force_field.create_openmm_system(topology=molecule_topology)
+                )
+                template_indices = self._get_particle_indices(
+                    molecule_topology, next(iter(molecule_topology.reference_molecules))
+                )
+            else:
+                template_force = force
+                template_indices = particle_indices[~is_new][0]
+            parameters, exceptions = self._get_molecule_template(
+                force=template_force,
+                particle_indices=template_indices,
+                n_particles=ref_mol.n_particles,
+            )
+
+            for copy_indices in particle_indices[is_new]:
+                self._set_particle_parameters(
+                    force=force, particle_indices=copy_indices, parameters=parameters
+                )
+                to_topology = np.empty(ref_mol.n_particles, dtype=np.int64)
+                to_topology[copy_indices[:, 1]] = copy_indices[:, 0]
+                for particle_1, particle_2, *exception_parameters in exceptions:
+                    force.addException(
+                        int(to_topology[particle_1]),
+                        int(to_topology[particle_2]),
+                        *exception_parameters,
                     )
 
-            # Mark that we have assigned the parameters
-            self.mark_charges_assigned(ref_mol, topology)
+
+def _get_nonbonded_force(system: openmm.System) -> openmm.NonbondedForce:
+    """Get the nonbonded force of a system."""
+    return [
+        force
+        for force in system.getForces()
+        if isinstance(force, openmm.NonbondedForce)
+    ][0]
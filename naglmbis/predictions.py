@@ -0,0 +1,124 @@
+"""
+A flat container for the per atom predictions of a batch of molecules.
+"""
+
+import dataclasses
+
+import numpy as np
+import pyarrow
+import pyarrow.parquet
+
+# the name of the molecule identifier column in arrow tables
+MOLECULE_ID_COLUMN = "molecule_id"
+
+
+@dataclasses.dataclass
+class BatchPredictions:
+    """
+    The predicted per atom properties of a batch of molecules, each property is stored as one contiguous
+    (n_atoms, n_values) array with the atoms of each molecule in order.
+    """
+
+    properties: dict[str, np.ndarray]
+    """The flat array of each property for all atoms in the batch."""
+    molecule_offsets: np.ndarray
+    """The offsets of each molecule into the flat arrays, the atoms of molecule `i` are `offsets[i]:offsets[i + 1]`."""
+    molecule_ids: list[str]
+    """The identifier of each molecule."""
+
+    def __post_init__(self):
+        self.molecule_offsets = np.ascontiguousarray(
+            self.molecule_offsets, dtype=np.int64
+        )
+        self.molecule_ids = list(self.molecule_ids)
+        if len(self.molecule_ids) != len(self.molecule_offsets) - 1:
+            raise ValueError(
+                f"The batch has {len(self.molecule_offsets) - 1} molecules but {len(self.molecule_ids)} ids."
+            )
+        for name, values in self.properties.items():
+            values = np.ascontiguousarray(values)
+            if values.ndim == 1:
+                values = values.reshape(-1, 1)
+            if values.shape[0] != self.n_atoms:
+                raise ValueError(
+                    f"The property {name} has {values.shape[0]} values but the batch has {self.n_atoms} atoms."
+                )
+            self.properties[name] = values
+
+    @property
+    def n_molecules(self) -> int:
+        return len(self.molecule_ids)
+
+    @property
+    def n_atoms(self) -> int:
+        return int(self.molecule_offsets[-1])
+
+    def __len__(self):
+        return self.n_molecules
+
+    def __contains__(self, name: str):
+        return name in self.properties
+
+    def __getitem__(self, name: str) -> np.ndarray:
+        """Get the flat array of a property for all atoms in the batch."""
+        return self.properties[name]
+
+    def keys(self):
+        return self.properties.keys()
+
+    def get_molecule(self, index: int) -> dict[str, np.ndarray]:
+        """Get views of the properties of a single molecule without copying."""
+        start, end = self.molecule_offsets[index], self.molecule_offsets[index + 1]
+        return {name: values[start:end] for name, values in self.properties.items()}
+
+    def to_arrow(self) -> pyarrow.Table:
+        """
+        Build an arrow table with one row per molecule where each property is a `LargeListArray` of the atom
+        values, the flat property arrays are shared with the table rather than copied.
+        """
+        offsets = pyarrow.array(self.molecule_offsets, type=pyarrow.int64())
+        columns = {MOLECULE_ID_COLUMN: pyarrow.array(self.molecule_ids)}
+        for name, values in self.properties.items():
+            atom_values = pyarrow.array(values.reshape(-1))
+            if values.shape[1] > 1:
+                atom_values = pyarrow.FixedSizeListArray.from_arrays(
+                    atom_values, values.shape[1]
+                )
+            columns[name] = pyarrow.LargeListArray.from_arrays(offsets, atom_values)
+        return pyarrow.table(columns)
+
+    def to_parquet(self, file_name: str):
+        """Write the predictions to a parquet file with one row per molecule."""
+        pyarrow.parquet.write_table(self.to_arrow(), file_name)
+
+    @classmethod
+    def from_arrow(cls, table: pyarrow.Table) -> "BatchPredictions":
+        """Load predictions from an arrow table made with `to_arrow`."""
+        properties, molecule_offsets = {}, None
+        for name in table.column_names:
+            if name == MOLECULE_ID_COLUMN:
+                continue
+            column = table.column(name).combine_chunks()
+            atom_values = column.flatten()
+            n_values = 1
+            if pyarrow.types.is_fixed_size_list(atom_values.type):
+                n_values = atom_values.type.list_size
+                atom_values = atom_values.flatten()
+            properties[name] = atom_values.to_numpy().reshape(-1, n_values)
+            if molecule_offsets is None:
+                molecule_offsets = column.offsets.to_numpy()
+                molecule_offsets = molecule_offsets - molecule_offsets[0]
+        return cls(
+            properties=properties,
+            molecule_offsets=(
+                np.zeros(table.num_rows + 1, dtype=np.int64)
+                if molecule_offsets is None
+                else molecule_offsets
+            ),
+            molecule_ids=table.column(MOLECULE_ID_COLUMN).to_pylist(),
+        )
+
+    @classmethod
+    def from_parquet(cls, file_name: str) -> "BatchPredictions":
+        """Load predictions from a parquet file made with `to_parquet`."""
+        return cls.from_arrow(pyarrow.parquet.read_table(file_name))
@@ -1,3 +1,5 @@
+import os
+
 import pytest
 from openff.toolkit.topology import Molecule
 
@@ -32,3 +34,23 @@ def iodobezene():
 def methane_no_conf():
     """Make an OpenFF molecule of methane with no conformer"""
     return Molecule.from_smiles("C").to_rdkit()
+
+
+@pytest.fixture()
+def charge_volume_model(monkeypatch):
+    """
+    Register the small untrained charge and volume model made with `scripts/training/make_test_model.py` as both a
+    charge and volume model, its predictions are only useful for testing.
+    """
+    from naglmbis.models import models
+
+    model_name = "nagl-test-charge-volume"
+    model_entry = {
+        "checkpoint_path": os.path.join(
+            os.path.dirname(__file__), "data", f"{model_name}.ckpt"
+        ),
+        "model_type": "volume",
+    }
+    monkeypatch.setitem(models.charge_weights, model_name, model_entry)
+    monkeypatch.setitem(models.volume_weights, model_name, model_entry)
+    return model_name
@@ -0,0 +1,118 @@
+import numpy as np
+import pytest
+from rdkit import Chem
+
+from naglmbis.charges import (
+    apply_bond_charge_corrections,
+    equilibrate_charges,
+    fix_net_charge,
+    fix_net_charges,
+    get_formal_charges,
+    get_molecule_offsets,
+    get_symmetry_classes,
+    symmetrise,
+)
+
+
+def test_apply_bccs():
+    """Make sure charge is moved between the correct pair of atoms and is conserved."""
+    charges = np.array([0.1, -0.5, 0.4])
+    corrected = apply_bond_charge_corrections(
+        charges, atom_indices=[[0, 1], [2, 1]], corrections=[0.05, -0.1]
+    )
+    assert np.allclose(corrected, [0.15, -0.45, 0.3])
+    assert corrected.sum() == pytest.approx(charges.sum())
+    # make sure the input is not changed
+    assert np.allclose(charges, [0.1, -0.5, 0.4])
+
+
+def test_symmetrise(methanol):
+    """Make sure the methyl hydrogens are averaged and the other atoms are untouched."""
+    classes = get_symmetry_classes(methanol)
+    values = np.array([0.1, -0.6, 0.04, 0.05, 0.06, 0.35])
+    sym_values = symmetrise(values, classes)
+    assert np.allclose(sym_values, [0.1, -0.6, 0.05, 0.05, 0.05, 0.35])
+
+
+def test_fix_net_charge():
+    """Make sure the charges are rounded and the residual is placed on the last atom."""
+    charges = np.array([0.1234567, -0.6, 0.4765431])
+    fixed = fix_net_charge(charges, total_charge=0)
+    assert np.allclose(fixed[:2], [0.123457, -0.6])
+    assert fixed.sum() == pytest.approx(0, abs=1e-12)
+
+
+def test_fix_net_charges_batch():
+    """Make sure the residual of each molecule in a batch is spread equally over its atoms."""
+    molecules = [
+        Chem.AddHs(Chem.MolFromSmiles("CO")),
+        Chem.AddHs(Chem.MolFromSmiles("CC(=O)[O-]")),
+    ]
+    offsets = get_molecule_offsets([molecule.GetNumAtoms() for molecule in molecules])
+    assert offsets.tolist() == [0, 6, 13]
+    total_charges = get_formal_charges(molecules)
+    assert total_charges.tolist() == [0, -1]
+
+    charges = np.zeros(13)
+    fixed = fix_net_charges(charges, offsets, total_charges)
+    assert np.allclose(fixed[:6], 0)
+    assert np.allclose(fixed[6:], -1 / 7)
+
+
+def test_fix_net_charges_weights():
+    """Make sure the residual is split in proportion to the weights."""
+    charges = np.array([0.1, 0.1, 0.2, -0.1])
+    offsets = np.array([0, 2, 4])
+    weights = np.array([1.0, 3.0, 1.0, 0.0])
+    fixed = fix_net_charges(charges, offsets, [0, 1], weights=weights)
+    assert np.allclose(fixed, [0.05, -0.05, 1.1, -0.1])
+
+    with pytest.raises(ValueError, match="positive"):
+        fix_net_charges(charges, offsets, [0, 1], weights=np.zeros(4))
+
+
+def test_equilibrate_charges():
+    """Make sure the batched charge equilibration matches a single molecule loop and the total charges."""
+    rng = np.random.default_rng(0)
+    electronegativity = rng.normal(size=7)
+    hardness = rng.uniform(0.5, 2.0, size=7)
+    offsets = np.array([0, 3, 7])
+    charges = equilibrate_charges(electronegativity, hardness, offsets, [0, -1])
+
+    for (start, end), total_charge in zip([(0, 3), (3, 7)], [0, -1]):
+        inverse_hardness = 1 / hardness[start:end]
+        e_over_s = electronegativity[start:end] * inverse_hardness
+        ref = -e_over_s + inverse_hardness / inverse_hardness.sum() * (
+            total_charge + e_over_s.sum()
+        )
+        assert np.allclose(charges[start:end], ref)
+        assert charges[start:end].sum() == pytest.approx(total_charge)
+
+
+def test_match_qubekit(methanol):
+    """Make sure the native symmetrisation and net charge fix reproduce the QUBEKit reference."""
+    pytest.importorskip("qubekit")
+    from qubekit.charges import MBISCharges
+    from qubekit.molecules import Ligand
+
+    charges = np.array([0.0835, -0.6821, 0.0491, 0.0493, 0.0489, 0.4515])
+    volumes = np.array([29.7, 25.3, 3.0, 3.1, 2.9, 1.0])
+    qb_mol = Ligand.from_rdkit(methanol)
+    for i in range(qb_mol.n_atoms):
+        qb_mol.atoms[i].aim.charge = charges[i]
+        qb_mol.atoms[i].aim.volume = volumes[i]
+    MBISCharges.apply_symmetrisation(qb_mol)
+    for i in range(qb_mol.n_atoms):
+        qb_mol.NonbondedForce.create_parameter(
+            atoms=(i,), charge=qb_mol.atoms[i].aim.charge, sigma=0, epsilon=0
+        )
+    qb_mol.fix_net_charge()
+
+    classes = get_symmetry_classes(Chem.Mol(methanol))
+    native_charges = fix_net_charge(
+        symmetrise(charges, classes), total_charge=Chem.GetFormalCharge(methanol)
+    )
+    native_volumes = symmetrise(volumes, classes)
+    for i in range(qb_mol.n_atoms):
+        assert native_charges[i] == pytest.approx(qb_mol.NonbondedForce[(i,)].charge)
+        assert native_volumes[i] == pytest.approx(qb_mol.atoms[i].aim.volume)
@@ -0,0 +1,305 @@
+import h5py
+import numpy as np
+import pyarrow.parquet
+import pytest
+
+from naglmbis.datasets import (
+    DATASET_SCHEMA,
+    build_parquet_dataset,
+    read_key_list,
+    write_key_list,
+)
+from naglmbis.datasets.builder import (
+    ANGSTROM_TO_BOHR,
+    GROUPED_DATASET_SCHEMA,
+    build_key_index,
+    get_read_plan,
+    iter_grouped_molecules,
+)
+from naglmbis.datasets.report import build_report, report_to_markdown
+
+# the smiles, number of conformations and number of atoms of each molecule in the reference files
+REFERENCE_MOLECULES = {
+    "mol-0": ("[H]O[H]", 2, 3),
+    "mol-1": ("[H]C([H])([H])O[H]", 3, 6),
+    "mol-2": ("[H]C([H])([H])[H]", 1, 5),
+    "mol-3": ("[H][N+]([H])([H])[H]", 2, 5),
+}
+
+
+def _write_reference_file(file_name: str, keys: list[str]):
+    """Write a reference HDF5 file with random data for each molecule."""
+    random = np.random.default_rng(len(keys))
+    with h5py.File(file_name, "w") as reference:
+        for key in keys:
+            smiles, n_conformations, n_atoms = REFERENCE_MOLECULES[key]
+            group = reference.create_group(key)
+            group.create_dataset("smiles", data=[smiles], dtype=h5py.string_dtype())
+            group.create_dataset(
+                "conformations", data=random.random((n_conformations, n_atoms, 3))
+            )
+            group.create_dataset("dipole", data=random.random((n_conformations, 3)))
+            for name in ["mbis-charges", "mbis-volumes"]:
+                group.create_dataset(
+                    name, data=random.random((n_conformations, n_atoms, 1))
+                )
+
+
+@pytest.fixture()
+def reference_files(tmpdir):
+    file_names = [
+        str(tmpdir.join("reference-0.hdf5")),
+        str(tmpdir.join("reference-1.hdf5")),
+    ]
+    _write_reference_file(file_names[0], ["mol-0", "mol-2"])
+    _write_reference_file(file_names[1], ["mol-1", "mol-3"])
+    return file_names
+
+
+def test_key_list_round_trip(tmpdir):
+    key_file = str(tmpdir.join("keys.txt"))
+    write_key_list(key_file, ["mol-1", "mol-0"])
+    assert read_key_list(key_file) == ["mol-1", "mol-0"]
+
+
+@pytest.mark.parametrize("row_group_size", [1, 3, 100])
+def test_build_parquet_dataset(reference_files, tmpdir, row_group_size):
+    """Make sure each conformation becomes a typed row whatever the row group size."""
+    parquet_name = str(tmpdir.join("dataset.parquet"))
+    keys = ["mol-1", "mol-0", "mol-3"]
+    n_records = build_parquet_dataset(
+        parquet_name, keys, reference_files, row_group_size=row_group_size
+    )
+    assert n_records == 7
+
+    parquet_file = pyarrow.parquet.ParquetFile(parquet_name)
+    assert parquet_file.schema_arrow == DATASET_SCHEMA
+    if row_group_size == 1:
+        assert parquet_file.num_row_groups == 3
+    table = parquet_file.read()
+    # the rows follow the on-disk order of the reference files not the key order
+    assert (
+        table.column("smiles").to_pylist()
+        == ["[H]O[H]"] * 2 + ["[H]C([H])([H])O[H]"] * 3 + ["[H][N+]([H])([H])[H]"] * 2
+    )
+
+    with h5py.File(reference_files[1], "r") as reference:
+        group = reference["mol-1"]
+        conformations = group["conformations"][()]
+        charges = group["mbis-charges"][()]
+        dipoles = group["dipole"][()]
+    for i in range(3):
+        row = i + 2
+        assert np.allclose(
+            table.column("conformation")[row].values.to_numpy(),
+            conformations[i].flatten() * ANGSTROM_TO_BOHR,
+        )
+        assert np.allclose(
+            table.column("mbis-charges")[row].values.to_numpy(), charges[i].flatten()
+        )
+        assert np.allclose(table.column("dipole")[row].values.to_numpy(), dipoles[i])
+
+
+def test_read_plan(reference_files):
+    """Make sure the keys are grouped by file, sorted by address and chunked."""
+    key_index = build_key_index(reference_files)
+    assert sorted(key_index) == ["mol-0", "mol-1", "mol-2", "mol-3"]
+    assert key_index["mol-1"][0] == 1
+    read_plan = get_read_plan(["mol-3", "mol-2", "mol-1", "mol-0"], key_index, 1)
+    assert read_plan == [(0, ["mol-0"]), (0, ["mol-2"]), (1, ["mol-1"]), (1, ["mol-3"])]
+
+
+def test_build_parquet_dataset_workers(reference_files, tmpdir):
+    """Make sure the reader pool writes the same dataset as a single reader."""
+    tables = []
+    for n_workers in [1, 2]:
+        parquet_name = str(tmpdir.join(f"dataset-{n_workers}.parquet"))
+        build_parquet_dataset(
+            parquet_name,
+            list(REFERENCE_MOLECULES),
+            reference_files,
+            n_workers=n_workers,
+        )
+        tables.append(pyarrow.parquet.read_table(parquet_name))
+    assert tables[0].equals(tables[1])
+
+
+def test_build_parquet_dataset_missing_key(reference_files, tmpdir):
+    with pytest.raises(KeyError, match="mol-4"):
+        build_parquet_dataset(
+            str(tmpdir.join("dataset.parquet")), ["mol-0", "mol-4"], reference_files
+        )
+
+
+def test_grouped_round_trip(reference_files, tmpdir):
+    """Make sure the grouped layout holds the same values as one row per conformation."""
+    keys = list(REFERENCE_MOLECULES)
+    paths = [str(tmpdir.join("dataset.parquet")), str(tmpdir.join("grouped.parquet"))]
+    build_parquet_dataset(paths[0], keys, reference_files)
+    n_records = build_parquet_dataset(
+        paths[1], keys, reference_files, row_group_size=3, grouped=True
+    )
+    assert n_records == 8
+
+    grouped = pyarrow.parquet.read_table(paths[1])
+    assert grouped.schema == GROUPED_DATASET_SCHEMA
+    assert grouped.num_rows == 4
+
+    table = pyarrow.parquet.read_table(paths[0])
+    columns = ["conformation", "dipole", "mbis-charges"]
+    row = 0
+    for smiles, values in iter_grouped_molecules([paths[1]], columns):
+        n_conformations = len(values["dipole"])
+        for i in range(n_conformations):
+            assert table.column("smiles")[row + i].as_py() == smiles
+            for name in columns:
+                assert np.allclose(
+                    values[name][i], table.column(name)[row + i].values.to_numpy()
+                )
+        row += n_conformations
+    assert row == table.num_rows
+
+
+def test_grouped_targets(reference_files, tmpdir):
+    """Make sure the grouped losses match the losses over one row per conformation."""
+    import torch
+    from nagl.config.data import DipoleTarget, ReadoutTarget
+    from nagl.features import AtomicElement
+
+    from naglmbis.datasets.data_module import (
+        GroupedMoleculeDataset,
+        collate_grouped,
+        evaluate_grouped_targets,
+    )
+
+    grouped_path = str(tmpdir.join("grouped.parquet"))
+    build_parquet_dataset(
+        grouped_path, list(REFERENCE_MOLECULES), reference_files, grouped=True
+    )
+    targets = [
+        ReadoutTarget(
+            column="mbis-charges", readout="mbis-charges", metric="mse", denominator=1.0
+        ),
+        DipoleTarget(
+            metric="mse",
+            dipole_column="dipole",
+            conformation_column="conformation",
+            charge_label="mbis-charges",
+            denominator=1.0,
+        ),
+    ]
+    dataset = GroupedMoleculeDataset.from_grouped(
+        [grouped_path],
+        targets,
+        atom_features=[AtomicElement(values=["H", "C", "N", "O"])],
+        bond_features=[],
+    )
+    # each molecule is featurized once
+    assert len(dataset) == 4
+
+    _, labels = collate_grouped(dataset.entries)
+    n_atoms = sum(molecule.graph.num_nodes() for molecule, _ in dataset.entries)
+    charges = torch.rand((n_atoms, 1))
+    losses = evaluate_grouped_targets(targets, {"mbis-charges": charges}, labels)
+
+    charge_errors, dipole_errors = [], []
+    atom_offset = 0
+    for molecule, molecule_labels in dataset.entries:
+        molecule_charges = charges[
+            atom_offset : atom_offset + molecule.graph.num_nodes()
+        ]
+        atom_offset += molecule.graph.num_nodes()
+        for i in range(len(molecule_labels["dipole"])):
+            charge_errors.append(molecule_labels["mbis-charges"][i] - molecule_charges)
+            dipole = (molecule_labels["conformation"][i] * molecule_charges).sum(dim=0)
+            dipole_errors.append(molecule_labels["dipole"][i] - dipole)
+    assert torch.isclose(losses["mbis-charges"], torch.cat(charge_errors).pow(2).mean())
+    assert torch.isclose(losses["dipole"], torch.stack(dipole_errors).pow(2).mean())
+
+
+def test_bond_features_in_memory(reference_files, tmpdir):
+    """Make sure models with bond features fall back to in memory featurization as the stores hold atom features."""
+    from nagl.config import Config, DataConfig, ModelConfig, OptimizerConfig
+    from nagl.config.data import Dataset, ReadoutTarget
+    from nagl.config.model import GCNConvolutionModule, ReadoutModule, Sequential
+    from nagl.features import AtomicElement, BondIsInRing
+
+    from naglmbis.datasets import GroupedDataModule
+    from naglmbis.datasets.data_module import GroupedMoleculeDataset
+
+    grouped_path = str(tmpdir.join("grouped.parquet"))
+    build_parquet_dataset(
+        grouped_path, list(REFERENCE_MOLECULES), reference_files, grouped=True
+    )
+    config = Config(
+        model=ModelConfig(
+            atom_features=[AtomicElement(values=["H", "C", "N", "O"])],
+            bond_features=[BondIsInRing()],
+            convolution=GCNConvolutionModule(
+                type="SAGEConv", hidden_feats=[4], activation=["ReLU"]
+            ),
+            readouts={
+                "mbis-charges": ReadoutModule(
+                    pooling="atom",
+                    forward=Sequential(hidden_feats=[2], activation=["Identity"]),
+                    postprocess="charges",
+                )
+            },
+        ),
+        data=DataConfig(
+            training=Dataset(
+                sources=[grouped_path],
+                targets=[
+                    ReadoutTarget(
+                        column="mbis-charges",
+                        readout="mbis-charges",
+                        metric="rmse",
+                        denominator=1.0,
+                    )
+                ],
+            )
+        ),
+        optimizer=OptimizerConfig(type="Adam", lr=0.001),
+    )
+    cache_dir = tmpdir.join("cache")
+    data = GroupedDataModule(config, cache_dir=str(cache_dir))
+    data.prepare_data()
+    data.setup("fit")
+    assert isinstance(data._datasets["train"], GroupedMoleculeDataset)
+    assert len(data._datasets["train"]) == 4
+    assert not cache_dir.exists() or cache_dir.listdir() == []
+
+
+def test_dataset_report(reference_files, tmpdir):
+    """Make sure both layouts give the same report and the element charge ranges are lined up."""
+    keys = list(REFERENCE_MOLECULES)
+    paths = [str(tmpdir.join("dataset.parquet")), str(tmpdir.join("grouped.parquet"))]
+    build_parquet_dataset(paths[0], keys, reference_files)
+    build_parquet_dataset(paths[1], keys, reference_files, grouped=True)
+    descriptor_cache = str(tmpdir.join("descriptors.parquet"))
+    report = build_report(paths, descriptor_cache=descriptor_cache)
+    assert report[paths[0]] == report[paths[1]]
+
+    summary = report[paths[0]]
+    assert summary["n_molecules"] == 4
+    assert summary["n_conformations"] == 8
+    assert summary["elements"] == {"H": 14, "C": 2, "N": 1, "O": 2}
+    assert summary["total_charges"] == {0: 3, 1: 1}
+    assert summary["heavy_atom_count"]["max"] == 2
+
+    with h5py.File(reference_files[1], "r") as reference:
+        nitrogen_charges = reference["mol-3"]["mbis-charges"][()][:, 1, 0]
+    assert np.isclose(
+        summary["charges_by_element"]["N"]["min"], nitrogen_charges.min(), atol=1e-6
+    )
+    assert np.isclose(
+        summary["charges_by_element"]["N"]["max"], nitrogen_charges.max(), atol=1e-6
+    )
+
+    # the cached descriptors are reused
+    assert pyarrow.parquet.read_table(descriptor_cache).num_rows == 4
+    assert build_report(paths[:1], descriptor_cache=descriptor_cache) == {
+        paths[0]: summary
+    }
+    markdown = report_to_markdown(report)
+    assert "| N | 1 |" in markdown
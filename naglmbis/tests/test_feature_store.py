@@ -0,0 +1,264 @@
+import dataclasses
+import os
+import pathlib
+import pickle
+import shutil
+
+import numpy as np
+import pyarrow
+import pyarrow.parquet
+import pytest
+
+from naglmbis.datasets.builder import GROUPED_DATASET_SCHEMA
+from naglmbis.training import cache as feature_cache
+from naglmbis.training.cache import FILE_HASHES, FeatureCache, hash_features
+from naglmbis.training.feature_store import (
+    METADATA_FILE,
+    FeatureStore,
+    FeatureStoreWriter,
+    build_feature_store,
+)
+
+BINARY_COLUMNS = [True, False, False, True]
+
+# smiles and the number of conformations of each molecule
+MOLECULES = [("[O:1]([H:2])[H:3]", 2), ("[C:1]([H:2])([H:3])([H:4])[H:5]", 1)]
+
+
+@dataclasses.dataclass
+class RingFeature:
+    type: str = "ringofsize"
+    ring_sizes: list = dataclasses.field(default_factory=lambda: [3, 4, 5, 6])
+
+    def __call__(self, molecule):
+        ring_info = molecule.GetRingInfo()
+        return [
+            [
+                int(ring_info.IsAtomInRingOfSize(atom.GetIdx(), size))
+                for size in self.ring_sizes
+            ]
+            for atom in molecule.GetAtoms()
+        ]
+
+
+def _make_molecule(n_atoms: int, n_conformations: int, seed: int) -> dict:
+    random = np.random.default_rng(seed)
+    return {
+        # two binary columns either side of two float columns
+        "atom_features": np.hstack(
+            [
+                random.integers(0, 2, (n_atoms, 1)),
+                random.random((n_atoms, 2)),
+                random.integers(0, 2, (n_atoms, 1)),
+            ]
+        ),
+        "bonds": np.array([[0, i] for i in range(1, n_atoms)]),
+        "formal_charges": random.integers(-1, 2, n_atoms),
+        "labels": {
+            "mbis-charges": random.random((n_conformations, n_atoms)),
+            "dipole": random.random((n_conformations, 3)),
+        },
+    }
+
+
+def _write_grouped_dataset(file_name: str, n_conformations: int = 0) -> str:
+    """Write the test molecules to a grouped dataset, optionally overriding the number of conformations."""
+    rows = []
+    for smiles, n_molecule_conformations in MOLECULES:
+        n_atoms = smiles.count(":")
+        n_molecule_conformations = n_conformations or n_molecule_conformations
+        rows.append(
+            {
+                "smiles": smiles,
+                "conformation": [[0.0] * n_atoms * 3] * n_molecule_conformations,
+                "dipole": [[1.0, 2.0, 3.0]] * n_molecule_conformations,
+                "mbis-charges": [[0.1] * n_atoms] * n_molecule_conformations,
+                "mbis-volumes": [[1.0] * n_atoms] * n_molecule_conformations,
+            }
+        )
+    pyarrow.parquet.write_table(
+        pyarrow.Table.from_pylist(rows, schema=GROUPED_DATASET_SCHEMA), file_name
+    )
+    return file_name
+
+
+@pytest.mark.parametrize("shard_size", [1, 2, 10])
+def test_feature_store_round_trip(tmpdir, shard_size):
+    """Make sure molecules are read back from any shard with the per atom labels split by conformation."""
+    molecules = [
+        _make_molecule(n_atoms, n_conformations, seed)
+        for seed, (n_atoms, n_conformations) in enumerate([(3, 2), (5, 1), (2, 3)])
+    ]
+    directory = str(tmpdir.join("store"))
+    with FeatureStoreWriter(
+        directory,
+        {"mbis-charges": True, "dipole": False},
+        binary_columns=BINARY_COLUMNS,
+        shard_size=shard_size,
+    ) as writer:
+        for molecule in molecules:
+            writer.add_molecule(**molecule)
+
+    store = FeatureStore(directory)
+    assert len(store) == 3
+    assert store.binary_columns.tolist() == BINARY_COLUMNS
+    n_atoms, n_bonds = store.get_molecule_sizes()
+    assert n_atoms.tolist() == [3, 5, 2]
+    assert n_bonds.tolist() == [2, 4, 1]
+    for index in [2, 0, 1, -1]:
+        expected = molecules[index]
+        molecule = store.get_molecule(index)
+        n_atoms = len(expected["formal_charges"])
+        assert isinstance(molecule["atom-dense"], np.memmap)
+        assert molecule["atom-bits"].dtype == np.uint8
+        assert molecule["atom-bits"].shape == (n_atoms, 1)
+        binary = np.unpackbits(molecule["atom-bits"], axis=1)[:, :2]
+        assert np.array_equal(binary, expected["atom_features"][:, [0, 3]])
+        assert np.allclose(molecule["atom-dense"], expected["atom_features"][:, 1:3])
+        assert np.array_equal(molecule["formal-charges"], expected["formal_charges"])
+        assert np.array_equal(molecule["bonds"], expected["bonds"])
+        assert molecule["label-mbis-charges"].shape == (
+            len(expected["labels"]["mbis-charges"]),
+            n_atoms,
+            1,
+        )
+        assert np.allclose(
+            molecule["label-mbis-charges"][..., 0], expected["labels"]["mbis-charges"]
+        )
+        assert np.allclose(molecule["label-dipole"], expected["labels"]["dipole"])
+
+    with pytest.raises(IndexError):
+        store.get_molecule(3)
+    with pytest.raises(FileExistsError):
+        FeatureStoreWriter(directory, {}, BINARY_COLUMNS)
+    writer = FeatureStoreWriter(str(tmpdir.join("other")), {}, BINARY_COLUMNS)
+    with pytest.raises(ValueError, match="other than 0 or 1"):
+        writer.add_molecule(np.full((2, 4), 0.5), np.zeros((0, 2)), [0, 0], {})
+    with pytest.raises(ValueError, match="expects 4"):
+        writer.add_molecule(np.zeros((2, 3)), np.zeros((0, 2)), [0, 0], {})
+
+    # the memory maps are not pickled and are reopened when needed
+    unpickled = pickle.loads(pickle.dumps(store))
+    assert unpickled._shards == {}
+    assert np.array_equal(
+        unpickled.get_molecule(1)["bonds"], store.get_molecule(1)["bonds"]
+    )
+
+
+def test_failed_build_is_incomplete(tmpdir):
+    """Make sure a store whose build fails part way is not marked as complete."""
+    directory = tmpdir.join("store")
+    with pytest.raises(RuntimeError):
+        with FeatureStoreWriter(
+            str(directory), {"mbis-charges": True}, BINARY_COLUMNS, shard_size=1
+        ) as writer:
+            molecule = _make_molecule(3, 2, 0)
+            writer.add_molecule(
+                molecule["atom_features"],
+                molecule["bonds"],
+                molecule["formal_charges"],
+                {"mbis-charges": molecule["labels"]["mbis-charges"]},
+            )
+            raise RuntimeError("the build failed")
+    assert directory.exists()
+    assert not directory.join(METADATA_FILE).exists()
+
+
+def test_build_feature_store(tmpdir):
+    """Make sure a grouped dataset is featurized into a store with molecule local bonds."""
+    dataset = _write_grouped_dataset(str(tmpdir.join("grouped.parquet")))
+
+    def atomic_number(molecule):
+        return [atom.GetAtomicNum() for atom in molecule.GetAtoms()]
+
+    def is_hydrogen(molecule):
+        return [atom.GetAtomicNum() == 1 for atom in molecule.GetAtoms()]
+
+    is_hydrogen.type = "element"
+
+    store = build_feature_store(
+        str(tmpdir.join("store")),
+        paths=[dataset],
+        atom_columns=["mbis-charges", "conformation"],
+        conformation_columns=["dipole"],
+        atom_features=[atomic_number, RingFeature(), is_hydrogen],
+        shard_size=1,
+    )
+    assert len(store) == 2
+    assert store.binary_columns.tolist() == [False] + [True] * 5
+    water = store.get_molecule(0)
+    assert water["atom-dense"][:, 0].tolist() == [8, 1, 1]
+    assert np.unpackbits(water["atom-bits"], axis=1)[:, :5].tolist() == [
+        [0, 0, 0, 0, 0],
+        [0, 0, 0, 0, 1],
+        [0, 0, 0, 0, 1],
+    ]
+    assert sorted(map(sorted, water["bonds"].tolist())) == [[0, 1], [0, 2]]
+    assert water["label-conformation"].shape == (2, 3, 3)
+    methane = store.get_molecule(1)
+    assert methane["atom-dense"][:, 0].tolist() == [6, 1, 1, 1, 1]
+    assert methane["label-mbis-charges"].shape == (1, 5, 1)
+    assert methane["label-dipole"].tolist() == [[1.0, 2.0, 3.0]]
+
+
+def test_hash_features():
+    """Make sure the feature hash depends on the feature parameters and not how the features are given."""
+    assert hash_features([RingFeature()]) == hash_features(
+        [{"ring_sizes": [3, 4, 5, 6], "type": "ringofsize"}]
+    )
+    assert hash_features([RingFeature()]) != hash_features(
+        [RingFeature(ring_sizes=[5, 6])]
+    )
+    with pytest.raises(TypeError, match="dataclass or a dictionary"):
+        hash_features([len])
+
+
+def test_feature_cache(tmpdir):
+    """Make sure entries are shared by any copy of a dataset and stale entries are collected."""
+    dataset = _write_grouped_dataset(str(tmpdir.join("grouped.parquet")))
+    copy = str(tmpdir.join("copy.parquet"))
+    shutil.copy(dataset, copy)
+    cache = FeatureCache(str(tmpdir.join("cache")))
+    columns = (["mbis-charges"], ["dipole"])
+
+    store = cache.get_store([dataset], *columns, [RingFeature()])
+    assert len(store) == 2
+    assert cache.get_entry_dir([copy], *columns, [RingFeature()]) == pathlib.Path(
+        store.directory
+    )
+    assert cache.get_entry_dir(
+        [dataset], *columns, [RingFeature(ring_sizes=[6])]
+    ) != pathlib.Path(store.directory)
+    assert cache.collect_garbage() == []
+
+    # changing the dataset makes the entry stale
+    other = cache.get_store([copy], ["mbis-charges"], [], [RingFeature()])
+    _write_grouped_dataset(copy, n_conformations=3)
+    assert cache.collect_garbage(dry_run=True) == [pathlib.Path(other.directory)]
+    assert cache.collect_garbage() == [pathlib.Path(other.directory)]
+    assert not os.path.exists(other.directory)
+    assert cache.collect_garbage(max_age_days=0) == [pathlib.Path(store.directory)]
+
+
+def test_feature_cache_concurrent_build(tmpdir, monkeypatch):
+    """Make sure a run which finishes building an entry after another run uses the finished store."""
+    dataset = _write_grouped_dataset(str(tmpdir.join("grouped.parquet")))
+    cache_dir = tmpdir.join("cache")
+    cache = FeatureCache(str(cache_dir))
+    columns = (["mbis-charges"], ["dipole"])
+    entry_dir = cache.get_entry_dir([dataset], *columns, [RingFeature()])
+
+    def build_during_other_run(directory, **kwargs):
+        store = build_feature_store(directory=directory, **kwargs)
+        # the other run moves its store into place first
+        build_feature_store(directory=str(entry_dir), **kwargs)
+        return store
+
+    monkeypatch.setattr(feature_cache, "build_feature_store", build_during_other_run)
+    store = cache.get_store([dataset], *columns, [RingFeature()])
+    assert pathlib.Path(store.directory) == entry_dir
+    assert len(store) == 2
+    # the build directory is removed
+    assert sorted(path.basename for path in cache_dir.listdir()) == sorted(
+        [entry_dir.name, FILE_HASHES]
+    )
@@ -0,0 +1,64 @@
+import pytest
+from rdkit import Chem
+
+from naglmbis.models.graph import (
+    get_bond_indices,
+    get_breadth_first_order,
+    get_environment_hashes,
+    get_k_hop_atoms,
+    get_neighbour_lists,
+)
+
+
+def test_k_hop_atoms():
+    """Make sure the neighbourhood grows one bond at a time."""
+    neighbours = get_neighbour_lists(Chem.MolFromSmiles("CCCCC"))
+    assert get_k_hop_atoms(neighbours, [0], 0).tolist() == [0]
+    assert get_k_hop_atoms(neighbours, [0], 2).tolist() == [0, 1, 2]
+    assert get_k_hop_atoms(neighbours, [0, 4], 1).tolist() == [0, 1, 3, 4]
+
+
+def test_environment_hashes():
+    """Make sure atoms only share a hash when their environments match within the number of hops."""
+    molecule = Chem.MolFromSmiles("CCCCCCCCCO")
+    neighbours = get_neighbour_lists(molecule)
+    features = [[atom.GetAtomicNum(), atom.GetDegree()] for atom in molecule.GetAtoms()]
+    hashes = get_environment_hashes(features, neighbours, n_hops=1)
+    # the inner carbons all look the same one bond away
+    assert len(set(hashes[2:8])) == 1
+    assert hashes[1] != hashes[2]
+    assert hashes[0] != hashes[8]
+    hashes = get_environment_hashes(features, neighbours, n_hops=2)
+    assert len(set(hashes[3:7])) == 1
+    assert hashes[2] != hashes[3]
+    assert hashes[6] != hashes[7]
+    # the same environments in another atom ordering share the hash
+    other = Chem.MolFromSmiles("OCCCCCCCCC")
+    other_hashes = get_environment_hashes(
+        [[atom.GetAtomicNum(), atom.GetDegree()] for atom in other.GetAtoms()],
+        get_neighbour_lists(other),
+        n_hops=2,
+    )
+    assert other_hashes == hashes[::-1]
+
+
+def test_breadth_first_order():
+    """Make sure every atom is visited once including disconnected components."""
+    neighbours = get_neighbour_lists(Chem.MolFromSmiles("CC(C)CO.O"))
+    assert get_breadth_first_order(neighbours).tolist() == [0, 1, 2, 3, 4, 5]
+    # the oxygen is one bond from the first atom so comes before the end of the chain
+    neighbours = get_neighbour_lists(Chem.MolFromSmiles("C(CCC)O"))
+    assert get_breadth_first_order(neighbours).tolist() == [0, 1, 4, 2, 3]
+
+
+@pytest.mark.parametrize(
+    "smiles", ["C", "CCO", "c1ccccc1O", "C1CC12CC2.[Na+].[Cl-]", "C" * 400, "[Na+]"]
+)
+def test_bond_indices(smiles):
+    """Make sure every bond is found once in bond order, including rings, disconnected and large molecules."""
+    molecule = Chem.AddHs(Chem.MolFromSmiles(smiles))
+    bonds = get_bond_indices(molecule)
+    assert bonds.shape == (molecule.GetNumBonds(), 2)
+    assert bonds.tolist() == [
+        [bond.GetBeginAtomIdx(), bond.GetEndAtomIdx()] for bond in molecule.GetBonds()
+    ]
@@ -0,0 +1,118 @@
+import numpy as np
+import pytest
+
+from naglmbis.lennard_jones import (
+    LJ_MODELS,
+    MissingRfreeError,
+    find_polar_hydrogens,
+    get_atomic_numbers,
+)
+
+# MBIS volumes for methanol which reproduce the reference nagl-v1 plugin parameters
+METHANOL_VOLUMES = [
+    29.69847679138185,
+    25.33354759216309,
+    3.0224146842956547,
+    3.0224146842956547,
+    3.0224146842956547,
+    1.0341161489486697,
+]
+
+
+def test_polar_hydrogens(methanol):
+    """Make sure only the hydroxyl hydrogen is tagged as polar and linked to the oxygen."""
+    partners = find_polar_hydrogens(methanol)
+    assert partners.tolist() == [-1, -1, -1, -1, -1, 1]
+
+
+def test_model_v1_methanol(methanol):
+    """Make sure the native model reproduces the QUBEKit parameters for methanol."""
+    sigma, epsilon = LJ_MODELS[1].compute_parameters(
+        atomic_numbers=get_atomic_numbers(methanol),
+        volumes=np.array(METHANOL_VOLUMES),
+        polar_h_partners=find_polar_hydrogens(methanol),
+    )
+    ref_sigma = [
+        0.3506905398376649,
+        0.30824716826324094,
+        0.23126852234757847,
+        0.23126852234757847,
+        0.23126852234757847,
+        0.11098246898497655,
+    ]
+    ref_epsilon = [
+        0.29246740950730743,
+        0.42874612945325397,
+        0.07259909774155628,
+        0.07259909774155628,
+        0.07259909774155628,
+        0.41631660852994784,
+    ]
+    assert np.allclose(sigma, ref_sigma)
+    assert np.allclose(epsilon, ref_epsilon)
+
+
+def test_no_polar_h_batch(methanol, water):
+    """Make sure polar hydrogens have no LJ terms and batches of molecules match single molecule runs."""
+    model = LJ_MODELS[3]
+    methanol_params = model.compute_parameters(
+        get_atomic_numbers(methanol),
+        METHANOL_VOLUMES,
+        find_polar_hydrogens(methanol),
+    )
+    water_volumes = [26.1, 1.2, 1.2]
+    water_params = model.compute_parameters(
+        get_atomic_numbers(water), water_volumes, find_polar_hydrogens(water)
+    )
+    # offset the partner indices of water into the flat batch
+    water_partners = find_polar_hydrogens(water)
+    water_partners[water_partners >= 0] += methanol.GetNumAtoms()
+    batch_sigma, batch_epsilon = model.compute_parameters(
+        np.concatenate([get_atomic_numbers(methanol), get_atomic_numbers(water)]),
+        METHANOL_VOLUMES + water_volumes,
+        np.concatenate([find_polar_hydrogens(methanol), water_partners]),
+    )
+    assert np.allclose(
+        batch_sigma, np.concatenate([methanol_params[0], water_params[0]])
+    )
+    assert np.allclose(
+        batch_epsilon, np.concatenate([methanol_params[1], water_params[1]])
+    )
+    assert batch_epsilon[5] == 0
+    assert np.all(batch_epsilon[-2:] == 0)
+
+
+def test_missing_element(iodobezene):
+    """Make sure an error is raised for elements the model has no parameters for."""
+    with pytest.raises(MissingRfreeError, match="I"):
+        LJ_MODELS[1].compute_parameters(
+            get_atomic_numbers(iodobezene),
+            np.ones(iodobezene.GetNumAtoms()),
+            find_polar_hydrogens(iodobezene),
+        )
+
+
+@pytest.mark.parametrize("model_name", list(LJ_MODELS.keys()))
+def test_match_qubekit(model_name, methanol):
+    """Make sure the native models reproduce the QUBEKit reference models."""
+    pytest.importorskip("qubekit")
+    from qubekit.molecules import Ligand
+
+    from naglmbis.plugins.trained_models import trained_models
+
+    volumes = np.array(METHANOL_VOLUMES) * np.linspace(0.9, 1.1, 6)
+    qb_mol = Ligand.from_rdkit(methanol)
+    for i in range(qb_mol.n_atoms):
+        qb_mol.atoms[i].aim.volume = volumes[i]
+        qb_mol.NonbondedForce.create_parameter(atoms=(i,), charge=0, sigma=0, epsilon=0)
+    trained_models[model_name].run(qb_mol)
+
+    sigma, epsilon = LJ_MODELS[model_name].compute_parameters(
+        get_atomic_numbers(methanol), volumes, find_polar_hydrogens(methanol)
+    )
+    for i in range(qb_mol.n_atoms):
+        parameter = qb_mol.NonbondedForce[(i,)]
+        assert epsilon[i] == pytest.approx(parameter.epsilon)
+        # sigma has no meaning for atoms without LJ terms
+        if parameter.epsilon != 0:
+            assert sigma[i] == pytest.approx(parameter.sigma)
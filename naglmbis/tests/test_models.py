@@ -1,6 +1,26 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pytest
 import torch
+from nagl.molecules import DGLMolecule
+from rdkit import Chem
 
-from naglmbis.models import load_charge_model
+from naglmbis.models import (
+    EnvironmentCache,
+    FragmentPredictor,
+    load_charge_model,
+    load_volume_model,
+)
+from naglmbis.models.featurize import (
+    PACKED_BITS,
+    PACKED_DENSE,
+    expand_packed_features,
+    molecule_to_dgl,
+)
+from naglmbis.models.graph import get_neighbour_lists
+from naglmbis.models.models import _drop_unused_readouts
+from naglmbis.training.feature_store import get_binary_columns
 
 
 def test_charge_model_v1_dipoles(methanol):
@@ -23,3 +43,242 @@ def test_charge_model_v1_mbis(methanol):
     ].detach()
     ref = torch.Tensor([[0.0835], [-0.6821], [0.0491], [0.0491], [0.0491], [0.4515]])
     assert torch.allclose(charges, ref, atol=1e-4)
+
+
+def test_batch_properties(methanol):
+    """Make sure a batched prediction matches single molecule predictions and sums to the formal charges."""
+    charge_model = load_charge_model(charge_model="nagl-v1-mbis")
+    acetate = Chem.AddHs(Chem.MolFromSmiles("CC(=O)[O-]"))
+    predictions = charge_model.compute_batch_properties(
+        molecules=[methanol, acetate], molecule_ids=["methanol", "acetate"]
+    )
+    charges = predictions["mbis-charges"]
+    assert charges.shape == (13, 1)
+    assert predictions.molecule_offsets.tolist() == [0, 6, 13]
+    assert predictions.molecule_ids == ["methanol", "acetate"]
+    ref_methanol = charge_model.compute_properties(molecule=methanol)["mbis-charges"]
+    assert np.allclose(charges[:6], ref_methanol.numpy(), atol=1e-5)
+    assert charges[:6].sum() == pytest.approx(0, abs=1e-5)
+    assert predictions.get_molecule(1)["mbis-charges"].sum() == pytest.approx(
+        -1, abs=1e-5
+    )
+
+
+def test_volume_model(charge_volume_model, methanol):
+    """Make sure a registered volume model predicts a volume for every atom alongside the charges."""
+    model = load_volume_model(volume_model=charge_volume_model)
+    properties = model.compute_properties(molecule=methanol)
+    assert properties["mbis-volumes"].shape == (methanol.GetNumAtoms(), 1)
+    assert torch.all(properties["mbis-volumes"] > 0)
+    assert properties["mbis-charges"].sum() == pytest.approx(0, abs=1e-5)
+    # the multi-readout model is registered as a charge model as well
+    charges = load_charge_model(
+        charge_model=charge_volume_model, readouts=["mbis-charges"]
+    ).compute_properties(molecule=methanol)
+    assert torch.allclose(charges["mbis-charges"], properties["mbis-charges"])
+
+
+def test_missing_volume_model():
+    with pytest.raises(ValueError, match="is not available"):
+        load_volume_model(volume_model="nagl-v1-mbis")
+
+
+def test_readout_selection(methanol):
+    """Make sure a subset of readouts can be computed and unused readouts can be dropped when loading."""
+    charge_model = load_charge_model(charge_model="nagl-v1-mbis")
+    all_readouts = charge_model.compute_properties(molecule=methanol)
+    selected = charge_model.compute_properties(
+        molecule=methanol, readouts=["mbis-charges"]
+    )
+    assert list(selected.keys()) == ["mbis-charges"]
+    assert torch.allclose(selected["mbis-charges"], all_readouts["mbis-charges"])
+    assert charge_model.compute_properties(molecule=methanol, readouts=[]) == {}
+    with pytest.raises(ValueError, match="mbis-volumes"):
+        charge_model.compute_properties(molecule=methanol, readouts=["mbis-volumes"])
+
+    with pytest.raises(ValueError, match="mbis-volumes"):
+        load_charge_model(charge_model="nagl-v1-mbis", readouts=["mbis-volumes"])
+
+
+def test_drop_unused_readouts():
+    """Make sure the settings and weights of unused readouts are removed from the checkpoint data."""
+    model_data = {
+        "hyper_parameters": {
+            "config": {"model": {"readouts": {"mbis-charges": {}, "mbis-volumes": {}}}}
+        },
+        "state_dict": {
+            "convolution_module.0.fc_neigh.weight": 0,
+            "readout_modules.mbis-charges.forward_layers.0.weight": 1,
+            "readout_modules.mbis-volumes.forward_layers.0.weight": 2,
+        },
+    }
+    _drop_unused_readouts(model_data=model_data, readouts=["mbis-charges"])
+    assert list(model_data["hyper_parameters"]["config"]["model"]["readouts"]) == [
+        "mbis-charges"
+    ]
+    assert list(model_data["state_dict"]) == [
+        "convolution_module.0.fc_neigh.weight",
+        "readout_modules.mbis-charges.forward_layers.0.weight",
+    ]
+
+
+def test_environment_cache(methanol):
+    """Make sure cached environments reproduce the full model and are reused between molecules."""
+    charge_model = load_charge_model(charge_model="nagl-v1-mbis")
+    cache = EnvironmentCache(model=charge_model)
+    molecules = [
+        Chem.AddHs(Chem.MolFromSmiles(smiles))
+        for smiles in ["CCCCCCO", "CCCCCCCO", "CCCCCCC(=O)[O-]"]
+    ]
+    for molecule in molecules:
+        cached_charges = cache.compute_properties(molecule=molecule)["mbis-charges"]
+        ref_charges = charge_model.compute_properties(molecule=molecule)["mbis-charges"]
+        assert torch.allclose(cached_charges, ref_charges.detach(), atol=1e-5)
+    # the alkyl chains share most environments
+    assert cache.hit_rate > 0.3
+
+    n_lookups = cache.n_lookups
+    batch_charges = cache.compute_batch_properties(molecules=[methanol] + molecules)[
+        "mbis-charges"
+    ]
+    ref_charges = charge_model.compute_batch_properties(
+        molecules=[methanol] + molecules, fix_net_charge=False
+    )["mbis-charges"]
+    assert np.allclose(batch_charges.numpy(), ref_charges, atol=1e-5)
+    assert cache.n_lookups == n_lookups + batch_charges.shape[0]
+    assert cache.get_statistics()["n_environments"] == len(cache)
+
+
+def test_edited_properties():
+    """Make sure recomputing only the receptive field of an edit matches a full recomputation."""
+    charge_model = load_charge_model(charge_model="nagl-v1-mbis")
+    parent = Chem.AddHs(Chem.MolFromSmiles("CCCCCCCCCO"))
+    child = Chem.AddHs(Chem.MolFromSmiles("CCCCCCCCCN"))
+    # the hydrogens are added in heavy atom order so all parent atoms keep their index
+    atom_map = {i: i for i in range(parent.GetNumAtoms())}
+    parent_states = charge_model.compute_hidden_states(parent)
+
+    properties, child_states = charge_model.compute_edited_properties(
+        parent_states=parent_states, molecule=child, atom_map=atom_map
+    )
+    ref_states = charge_model.compute_hidden_states(child)
+    for layer_states, ref_layer_states in zip(
+        child_states.layer_states, ref_states.layer_states
+    ):
+        assert torch.allclose(layer_states, ref_layer_states, atol=1e-5)
+    ref_charges = charge_model.compute_properties(child)["mbis-charges"]
+    assert torch.allclose(properties["mbis-charges"], ref_charges.detach(), atol=1e-5)
+    # the methyl end of the chain is outside the receptive field of the edit
+    n_layers = charge_model.receptive_field
+    assert child_states.n_recomputed < n_layers * child.GetNumAtoms()
+
+
+@pytest.mark.parametrize("n_workers", [1, 2])
+def test_fragment_predictor(n_workers):
+    """Make sure fragment predictions of a peptide match the whole molecule prediction."""
+    charge_model = load_charge_model(charge_model="nagl-v1-mbis")
+    peptide = Chem.AddHs(Chem.MolFromSequence("ACDEFGHIKLMNPQRSTVWY"))
+    predictor = FragmentPredictor(
+        model=charge_model, core_size=40, max_batch_atoms=400, n_workers=n_workers
+    )
+    assert len(predictor.get_fragments(get_neighbour_lists(peptide))) > 1
+    charges = predictor.compute_properties(peptide)["mbis-charges"]
+    ref_charges = charge_model.compute_properties(peptide)["mbis-charges"]
+    assert torch.allclose(charges, ref_charges.detach(), atol=1e-4)
+    assert charges.sum().item() == pytest.approx(
+        Chem.GetFormalCharge(peptide), abs=1e-4
+    )
+
+    with pytest.raises(ValueError, match="memory ceiling"):
+        FragmentPredictor(model=charge_model, max_batch_atoms=10).compute_properties(
+            peptide
+        )
+
+
+def test_threaded_inference():
+    """Make sure many threads can share one model and get the same results as serial calls."""
+    charge_model = load_charge_model(charge_model="nagl-v1-mbis")
+    molecules = [
+        Chem.AddHs(Chem.MolFromSmiles(smiles))
+        for smiles in ["CO", "CCO", "c1ccccc1O", "CC(=O)[O-]", "C[NH3+]", "CCN(CC)CC"]
+    ] * 20
+    ref_charges = [
+        charge_model.compute_properties(molecule)["mbis-charges"]
+        for molecule in molecules
+    ]
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        charges = list(
+            pool.map(
+                lambda molecule: charge_model.compute_properties(molecule)[
+                    "mbis-charges"
+                ],
+                molecules,
+            )
+        )
+    for charge, ref_charge in zip(charges, ref_charges):
+        assert not charge.requires_grad
+        assert torch.allclose(charge, ref_charge, atol=1e-6)
+
+
+@pytest.mark.parametrize("smiles", ["C", "CCO", "c1ccccc1O", "CC(=O)[O-].[Na+]"])
+def test_molecule_to_dgl(smiles):
+    """Make sure the fast graph builder matches the nagl graph and predictions."""
+    charge_model = load_charge_model(charge_model="nagl-v1-mbis")
+    molecule = Chem.AddHs(Chem.MolFromSmiles(smiles))
+    model_config = charge_model.config.model
+    graph = molecule_to_dgl(
+        molecule, model_config.atom_features, model_config.bond_features
+    ).graph
+    ref_graph = DGLMolecule.from_rdkit(
+        molecule, model_config.atom_features, model_config.bond_features
+    ).graph
+
+    assert graph.num_nodes() == ref_graph.num_nodes()
+    for key in ["feat", "formal_charge"]:
+        assert torch.equal(graph.ndata[key], ref_graph.ndata[key])
+    for edge_type in ["forward", "reverse"]:
+        edges = {
+            tuple(pair)
+            for pair in torch.stack(graph.edges(etype=edge_type), 1).tolist()
+        }
+        ref_edges = {
+            tuple(pair)
+            for pair in torch.stack(ref_graph.edges(etype=edge_type), 1).tolist()
+        }
+        # the forward direction of a bond may differ but the undirected graph must match
+        assert edges | {pair[::-1] for pair in edges} == ref_edges | {
+            pair[::-1] for pair in ref_edges
+        }
+
+    charges = charge_model.compute_properties(molecule)["mbis-charges"]
+    ref_charges = charge_model.forward(
+        DGLMolecule.from_rdkit(
+            molecule, model_config.atom_features, model_config.bond_features
+        )
+    )["mbis-charges"]
+    assert torch.allclose(charges, ref_charges.detach(), atol=1e-6)
+
+
+@pytest.mark.parametrize("smiles", ["CCO", "c1ccccc1O", "C[NH3+]"])
+def test_expand_packed_features(smiles):
+    """Make sure the binary feature columns of a model can be packed as bits and expanded back."""
+    charge_model = load_charge_model(charge_model="nagl-v1-mbis")
+    atom_features = charge_model.config.model.atom_features
+    binary_columns = torch.from_numpy(
+        get_binary_columns(atom_features, [len(feature) for feature in atom_features])
+    )
+    molecule = molecule_to_dgl(
+        Chem.AddHs(Chem.MolFromSmiles(smiles)), atom_features, []
+    )
+    features = molecule.graph.ndata.pop("feat")
+    assert torch.all(
+        (features[:, binary_columns] == 0) | (features[:, binary_columns] == 1)
+    )
+
+    molecule.graph.ndata[PACKED_BITS] = torch.from_numpy(
+        np.packbits(features[:, binary_columns].numpy().astype(bool), axis=1)
+    )
+    molecule.graph.ndata[PACKED_DENSE] = features[:, ~binary_columns]
+    expand_packed_features(molecule, binary_columns)
+    assert PACKED_BITS not in molecule.graph.ndata
+    assert torch.equal(molecule.graph.ndata["feat"], features.float())
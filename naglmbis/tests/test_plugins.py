@@ -1,7 +1,336 @@
+import numpy as np
+import openmm
+import pytest
+import torch
+from click.testing import CliRunner
+from openff.toolkit.topology import Molecule, Topology
+from rdkit import Chem
+
+from naglmbis.charges import (
+    fix_net_charge,
+    get_canonical_order,
+    get_symmetry_classes,
+    symmetrise,
+)
+from naglmbis.cli import cli
+from naglmbis.lennard_jones import LJ_MODELS
+from naglmbis.models import MBISGraphModel
+from naglmbis.plugins import NAGLMBISHandler, modify_force_field, plugins
+from naglmbis.plugins.library import NonbondedLibrary, load_parameter_library
+from naglmbis.plugins.pipeline import (
+    NonbondedParameters,
+    compute_nonbonded_parameters,
+)
+
 # import pytest
 # from openmm import unit
-#
-# from naglmbis.plugins import modify_force_field
+
+
+def test_canonical_order_round_trip(methanol):
+    """Make sure parameters can be moved between different atom orders of the same molecule."""
+    # the canonical ranks break ties between symmetry equivalent atoms arbitrarily so only symmetric values can be
+    # expected to survive the round trip
+    values = get_symmetry_classes(methanol).astype(np.float64)
+    parameters = NonbondedParameters(charges=values, sigmas=values, epsilons=values)
+    smiles, ranks = get_canonical_order(methanol)
+    canonical = parameters.to_canonical_order(ranks)
+    # renumber the atoms and check each atom keeps its parameters
+    new_order = [5, 3, 1, 0, 2, 4]
+    renumbered = Chem.RenumberAtoms(methanol, new_order)
+    new_smiles, new_ranks = get_canonical_order(renumbered)
+    assert new_smiles == smiles
+    assert np.array_equal(
+        canonical.from_canonical_order(new_ranks).charges, values[new_order]
+    )
+
+
+def test_parameter_cache(methanol, monkeypatch):
+    """Make sure each molecule is only parameterised once per model setting and the memo follows the atom order."""
+    calls = []
+
+    def compute_nonbonded_parameters(molecule, **kwargs):
+        calls.append(molecule)
+        values = get_symmetry_classes(molecule.to_rdkit()).astype(np.float64)
+        return NonbondedParameters(charges=values, sigmas=values, epsilons=values)
+
+    # the pipeline is replaced so only the memo is tested
+    monkeypatch.setattr(
+        plugins, "compute_nonbonded_parameters", compute_nonbonded_parameters
+    )
+    monkeypatch.setattr(NAGLMBISHandler, "_load_models", lambda self: {})
+    nagl_sage = modify_force_field(force_field="openff_unconstrained-2.0.0.offxml")
+    nagl_handler = nagl_sage.get_parameter_handler("NAGLMBIS")
+
+    first = nagl_handler.get_molecule_parameters(Molecule.from_rdkit(methanol))
+    new_order = [5, 3, 1, 0, 2, 4]
+    renumbered = nagl_handler.get_molecule_parameters(
+        Molecule.from_rdkit(Chem.RenumberAtoms(methanol, new_order))
+    )
+    assert len(calls) == 1
+    assert np.array_equal(renumbered.charges, first.charges[new_order])
+
+    # changing a model setting invalidates the memo
+    nagl_handler.rfree_model = 2
+    assert len(nagl_handler._parameter_cache) == 0
+    nagl_handler.get_molecule_parameters(Molecule.from_rdkit(methanol))
+    assert len(calls) == 2
+
+
+def test_parameter_cache_settings(methanol, charge_volume_model, monkeypatch):
+    """Make sure every model setting keys the memo and the memo can not be changed through returned parameters."""
+
+    def compute_nonbonded_parameters(molecule, **kwargs):
+        values = get_symmetry_classes(molecule.to_rdkit()).astype(np.float64)
+        return NonbondedParameters(charges=values, sigmas=values, epsilons=values)
+
+    monkeypatch.setattr(
+        plugins, "compute_nonbonded_parameters", compute_nonbonded_parameters
+    )
+    monkeypatch.setattr(NAGLMBISHandler, "_load_models", lambda self: {})
+    nagl_sage = modify_force_field(force_field="openff_unconstrained-2.0.0.offxml")
+    nagl_handler = nagl_sage.get_parameter_handler("NAGLMBIS")
+    molecule = Molecule.from_rdkit(methanol)
+
+    first = nagl_handler.get_molecule_parameters(molecule)
+    expected = first.charges.copy()
+    first.charges[:] = 100
+    assert np.array_equal(
+        nagl_handler.get_molecule_parameters(molecule).charges, expected
+    )
+
+    for attribute, value in [
+        ("charge_model", "nagl-v1-mbis-dipole"),
+        ("volume_model", charge_volume_model),
+        ("rfree_model", 2),
+        ("bcc_model", "nagl-v1"),
+        ("net_charge_method", "equal"),
+    ]:
+        nagl_handler.get_molecule_parameters(molecule)
+        assert len(nagl_handler._parameter_cache) == 1
+        setattr(nagl_handler, attribute, value)
+        assert len(nagl_handler._parameter_cache) == 0, attribute
+
+
+def test_parameter_library(methanol, tmpdir):
+    """Make sure library parameters are used by the handler and survive a round trip to file."""
+    nagl_sage = modify_force_field(force_field="openff_unconstrained-2.0.0.offxml")
+    nagl_handler = nagl_sage.get_parameter_handler("NAGLMBIS")
+    # symmetry equivalent atoms must share parameters to survive the canonical reordering
+    symmetry_classes = get_symmetry_classes(methanol)
+    parameters = NonbondedParameters(
+        charges=np.array([0.1, -0.6, 0.0, 0.0, 0.0, 0.5]),
+        sigmas=symmetrise(np.linspace(0.1, 0.3, 6), symmetry_classes),
+        epsilons=symmetrise(np.linspace(0.0, 0.5, 6), symmetry_classes),
+    )
+    library = NonbondedLibrary(settings=nagl_handler.get_model_settings())
+    library.add_molecule(Molecule.from_rdkit(methanol), parameters)
+
+    with tmpdir.as_cwd():
+        library.to_file("library.npz")
+        library.to_offxml("library.offxml")
+        assert "LibraryCharge" in open("library.offxml").read()
+        nagl_handler.parameter_library = "library.npz"
+        # the library should be used without running any models
+        renumbered = Molecule.from_rdkit(
+            Chem.RenumberAtoms(methanol, [5, 3, 1, 0, 2, 4])
+        )
+        library_parameters = nagl_handler.get_molecule_parameters(renumbered)
+
+        # the library was made with different model settings so it can not be used
+        nagl_handler.rfree_model = 2
+        with pytest.raises(ValueError, match="do not match"):
+            nagl_handler.get_molecule_parameters(renumbered)
+
+    assert np.allclose(
+        library_parameters.charges, parameters.charges[[5, 3, 1, 0, 2, 4]]
+    )
+    assert np.allclose(library_parameters.sigmas, parameters.sigmas[[5, 3, 1, 0, 2, 4]])
+    assert np.allclose(
+        library_parameters.epsilons, parameters.epsilons[[5, 3, 1, 0, 2, 4]]
+    )
+
+
+def test_rebuilt_library_is_reloaded(methanol, water, tmpdir):
+    """Make sure a library which is rebuilt in place is not served from the cache."""
+    parameters = {
+        molecule: NonbondedParameters(
+            charges=np.zeros(n_atoms),
+            sigmas=np.ones(n_atoms),
+            epsilons=np.ones(n_atoms),
+        )
+        for molecule, n_atoms in [
+            (Molecule.from_rdkit(methanol), 6),
+            (Molecule.from_rdkit(water), 3),
+        ]
+    }
+    library = NonbondedLibrary(settings={})
+    with tmpdir.as_cwd():
+        for molecule, molecule_parameters in parameters.items():
+            library.add_molecule(molecule, molecule_parameters)
+            library.to_file("library.npz")
+            assert len(load_parameter_library("library.npz")) == len(library)
+
+
+def test_build_library_cli(charge_volume_model, tmpdir):
+    """Make sure the command line tool builds a library which the handler can use."""
+    with tmpdir.as_cwd():
+        with open("molecules.smi", "w") as smiles_file:
+            smiles_file.write("CO\nCCO\n")
+        result = CliRunner().invoke(
+            cli,
+            [
+                "build-library",
+                "--molecules",
+                "molecules.smi",
+                "--output",
+                "library.npz",
+                "--offxml",
+                "library.offxml",
+                "--charge-model",
+                charge_volume_model,
+                "--volume-model",
+                charge_volume_model,
+            ],
+        )
+        assert result.exit_code == 0, result.output
+        library = load_parameter_library("library.npz")
+        assert len(library) == 2
+        assert library.settings["volume_model"] == charge_volume_model
+        assert "LibraryCharge" in open("library.offxml").read()
+
+
+def _get_nonbonded_parameters(system: openmm.System) -> tuple[list, dict]:
+    """Get the particle parameters and the exceptions keyed by the sorted particle pair of a system."""
+    force = [
+        force
+        for force in system.getForces()
+        if isinstance(force, openmm.NonbondedForce)
+    ][0]
+    particles = [
+        [
+            parameter.value_in_unit(parameter.unit)
+            for parameter in force.getParticleParameters(i)
+        ]
+        for i in range(force.getNumParticles())
+    ]
+    exceptions = {}
+    for i in range(force.getNumExceptions()):
+        particle_1, particle_2, *parameters = force.getExceptionParameters(i)
+        exceptions[tuple(sorted((particle_1, particle_2)))] = [
+            parameter.value_in_unit(parameter.unit) for parameter in parameters
+        ]
+    return particles, exceptions
+
+
+def test_extend_force(methanol, monkeypatch):
+    """Make sure growing a parameterised topology gives the same force as parameterising the full topology."""
+    calls = []
+
+    def compute_nonbonded_parameters(molecule, **kwargs):
+        calls.append(molecule.to_smiles())
+        values = get_symmetry_classes(molecule.to_rdkit()).astype(np.float64)
+        return NonbondedParameters(
+            charges=values - values.mean(), sigmas=0.1 + values / 10, epsilons=values
+        )
+
+    monkeypatch.setattr(
+        plugins, "compute_nonbonded_parameters", compute_nonbonded_parameters
+    )
+    monkeypatch.setattr(NAGLMBISHandler, "_load_models", lambda self: {})
+    nagl_sage = modify_force_field(force_field="openff_unconstrained-2.0.0.offxml")
+    nagl_handler = nagl_sage.get_parameter_handler("NAGLMBIS")
+
+    water = Molecule.from_smiles("O")
+    alcohol = Molecule.from_rdkit(methanol)
+    existing = Topology.from_molecules([water, alcohol, water])
+    system = nagl_sage.create_openmm_system(topology=existing)
+    force = [
+        force
+        for force in system.getForces()
+        if isinstance(force, openmm.NonbondedForce)
+    ][0]
+    # a new copy of an existing molecule, a new species and a library charged ion
+    grown = Topology.from_molecules(
+        [water, alcohol, water]
+        + [alcohol, Molecule.from_smiles("CCO"), Molecule.from_smiles("[Na+]")]
+    )
+    with pytest.raises(ValueError, match="existing particles were given"):
+        nagl_handler.extend_force(
+            force=force,
+            topology=grown,
+            n_existing_particles=existing.n_topology_particles - 1,
+            force_field=nagl_sage,
+        )
+    with pytest.raises(ValueError, match="fewer than"):
+        nagl_handler.extend_force(
+            force=force,
+            topology=Topology.from_molecules([water]),
+            n_existing_particles=existing.n_topology_particles,
+            force_field=nagl_sage,
+        )
+    nagl_handler.extend_force(
+        force=force,
+        topology=grown,
+        n_existing_particles=existing.n_topology_particles,
+        force_field=nagl_sage,
+    )
+    # only the new species is predicted, the ion has library charges
+    assert len(calls) == 2
+
+    expected_particles, expected_exceptions = _get_nonbonded_parameters(
+        nagl_sage.create_openmm_system(topology=grown)
+    )
+    particles, exceptions = _get_nonbonded_parameters(system)
+    assert np.allclose(particles, expected_particles)
+    assert exceptions.keys() == expected_exceptions.keys()
+    for pair, parameters in exceptions.items():
+        assert np.allclose(parameters, expected_exceptions[pair])
+
+    other_force_field = modify_force_field(
+        force_field="openff_unconstrained-2.0.0.offxml"
+    )
+    with pytest.raises(ValueError, match="must use this handler"):
+        nagl_handler.extend_force(
+            force=force,
+            topology=grown,
+            n_existing_particles=grown.n_topology_particles,
+            force_field=other_force_field,
+        )
+
+
+class _UnitVolumes:
+    """A stand in volume model which gives every atom a volume of 1."""
+
+    def compute_properties(self, molecule, readouts):
+        return {"mbis-volumes": torch.ones((molecule.GetNumAtoms(), 1))}
+
+
+def test_net_charge_method(methanol):
+    """Make sure the qubekit net charge correction is the default and the charges can be spread equally instead."""
+    charges = np.array([0.0835, -0.6821, 0.0491, 0.0491, 0.0491, 0.4515])
+    models = dict(
+        charge_model=lambda molecule: charges,
+        volume_model=_UnitVolumes(),
+        lj_model=LJ_MODELS[1],
+    )
+    molecule = Molecule.from_rdkit(methanol)
+
+    qubekit = compute_nonbonded_parameters(molecule=molecule, **models)
+    assert np.allclose(qubekit.charges, fix_net_charge(charges, total_charge=0))
+    # only the last atom takes up the difference
+    assert np.allclose(qubekit.charges[:-1], charges[:-1])
+    assert qubekit.charges.sum() == pytest.approx(0)
+
+    equal = compute_nonbonded_parameters(
+        molecule=molecule, net_charge_method="equal", **models
+    )
+    assert np.allclose(equal.charges, charges - charges.sum() / len(charges))
+    assert np.allclose(equal.sigmas, qubekit.sigmas)
+
+    with pytest.raises(ValueError, match="net charge method"):
+        compute_nonbonded_parameters(
+            molecule=molecule, net_charge_method="last-atom", **models
+        )
 
 
 # def test_modify_force_field():
@@ -14,6 +343,33 @@
 #     assert "ToolkitAM1BCC" not in handlers
 
 
+def test_single_pass_charge_volume_model(charge_volume_model, methanol, monkeypatch):
+    """Make sure a model registered for charges and volumes is loaded once and run once per molecule."""
+    forward_passes = []
+    forward_readouts = MBISGraphModel.forward_readouts
+
+    def count_forward_readouts(self, molecule, readouts=None):
+        forward_passes.append(readouts)
+        return forward_readouts(self, molecule, readouts=readouts)
+
+    monkeypatch.setattr(MBISGraphModel, "forward_readouts", count_forward_readouts)
+    nagl_sage = modify_force_field(force_field="openff_unconstrained-2.0.0.offxml")
+    nagl_handler = nagl_sage.get_parameter_handler("NAGLMBIS")
+    nagl_handler.charge_model = charge_volume_model
+    nagl_handler.volume_model = charge_volume_model
+    models = nagl_handler._load_models()
+    assert models["volume_model"] is models["charge_model"]
+
+    system = nagl_sage.create_openmm_system(
+        topology=Molecule.from_rdkit(methanol).to_topology()
+    )
+    assert forward_passes == [["mbis-charges", "mbis-volumes"]]
+    particles, _ = _get_nonbonded_parameters(system)
+    charges = np.array(particles)[:, 0]
+    assert charges.sum() == pytest.approx(0, abs=1e-6)
+    assert np.all(np.array(particles)[:, 1] > 0)
+
+
 # def test_plugin_water(water):
 #     """Make sure that the default TIP3P parameters are applied to water when using a NAGLMBIS force field."""
 #
@@ -68,7 +424,7 @@
 
 # def test_plugin_missing_element(iodobezene):
 #     """Make sure an error is raised when we try to parameterize a molecule with an element not covered by model 1."""
-#     from qubekit.utils.exceptions import MissingRfreeError
+#     from naglmbis.lennard_jones import MissingRfreeError
 #
 #     nagl_sage = modify_force_field(force_field="openff_unconstrained-2.0.0.offxml")
 #     with pytest.raises(MissingRfreeError):
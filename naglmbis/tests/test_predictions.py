@@ -0,0 +1,55 @@
+import numpy as np
+import pytest
+
+from naglmbis.predictions import BatchPredictions
+
+
+@pytest.fixture()
+def predictions():
+    return BatchPredictions(
+        properties={
+            "mbis-charges": np.arange(13, dtype=np.float32).reshape(-1, 1),
+            "mbis-volumes": np.arange(26, dtype=np.float32).reshape(13, 2),
+        },
+        molecule_offsets=[0, 6, 13],
+        molecule_ids=["methanol", "acetate"],
+    )
+
+
+def test_molecule_views(predictions):
+    """Make sure molecule properties are views of the flat arrays."""
+    assert predictions.n_molecules == 2
+    assert predictions.n_atoms == 13
+    charges = predictions.get_molecule(1)["mbis-charges"]
+    assert charges.ravel().tolist() == list(range(6, 13))
+    assert np.shares_memory(charges, predictions["mbis-charges"])
+
+
+def test_bad_shapes():
+    """Make sure the properties and ids must match the offsets."""
+    with pytest.raises(ValueError, match="ids"):
+        BatchPredictions({}, molecule_offsets=[0, 6], molecule_ids=["a", "b"])
+    with pytest.raises(ValueError, match="5 values"):
+        BatchPredictions(
+            {"mbis-charges": np.zeros(5)}, molecule_offsets=[0, 6], molecule_ids=["a"]
+        )
+
+
+def test_arrow_round_trip(predictions, tmpdir):
+    """Make sure the arrow export shares memory and survives a round trip to parquet."""
+    table = predictions.to_arrow()
+    assert table.num_rows == 2
+    charges = table.column("mbis-charges").chunk(0)
+    assert np.shares_memory(charges.flatten().to_numpy(), predictions["mbis-charges"])
+
+    with tmpdir.as_cwd():
+        predictions.to_parquet("predictions.parquet")
+        loaded = BatchPredictions.from_parquet("predictions.parquet")
+    assert loaded.molecule_ids == predictions.molecule_ids
+    assert loaded.molecule_offsets.tolist() == [0, 6, 13]
+    for name in predictions.keys():
+        assert np.allclose(loaded[name], predictions[name])
+
+    sliced = BatchPredictions.from_arrow(table.slice(1))
+    assert sliced.molecule_offsets.tolist() == [0, 7]
+    assert np.allclose(sliced["mbis-volumes"], predictions["mbis-volumes"][6:])
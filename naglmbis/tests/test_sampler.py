@@ -0,0 +1,93 @@
+import numpy as np
+import pytest
+
+from naglmbis.training.sampler import SizeBucketBatchSampler, pack_batches
+
+
+def test_pack_batches():
+    """Make sure batches are capped by atoms and edges and large molecules get their own batch."""
+    n_atoms = np.array([3, 4, 5, 12, 2])
+    n_edges = np.array([4, 6, 8, 22, 2])
+    order = np.arange(5)
+    assert pack_batches(order, n_atoms, n_edges, max_atoms=10) == [
+        [0, 1],
+        [2],
+        [3],
+        [4],
+    ]
+    assert pack_batches(order, n_atoms, n_edges, max_atoms=10, max_edges=9) == [
+        [0],
+        [1],
+        [2],
+        [3],
+        [4],
+    ]
+    assert pack_batches(order[::-1], n_atoms, n_edges, max_atoms=100) == [
+        [4, 3, 2, 1, 0]
+    ]
+
+
+@pytest.mark.parametrize("bucket_size", [None, 50])
+def test_size_bucket_batch_sampler(bucket_size):
+    """Make sure every molecule is sampled once per epoch under the budget with a new order each epoch."""
+    random = np.random.default_rng(0)
+    n_atoms = random.integers(3, 40, 200)
+    n_edges = 2 * (n_atoms - 1)
+    sampler = SizeBucketBatchSampler(
+        n_atoms, n_edges, max_atoms=100, max_edges=150, bucket_size=bucket_size
+    )
+
+    epochs = []
+    for _ in range(2):
+        n_batches = len(sampler)
+        batches = list(sampler)
+        assert len(batches) == n_batches
+        assert sorted(index for batch in batches for index in batch) == list(range(200))
+        for batch in batches:
+            assert n_atoms[batch].sum() <= 100
+            assert n_edges[batch].sum() <= 150
+        epochs.append(batches)
+    assert epochs[0] != epochs[1]
+
+    # molecules of similar size are batched together
+    if bucket_size is None:
+        spreads = [np.ptp(n_atoms[batch]) for batch in epochs[0]]
+        assert np.mean(spreads) < 2
+
+    # the same epoch gives the same batches
+    sampler.set_epoch(0)
+    assert list(sampler) == epochs[0]
+
+
+def test_size_bucket_batch_sampler_no_shuffle():
+    n_atoms = np.array([5, 1, 3, 1])
+    sampler = SizeBucketBatchSampler(n_atoms, n_atoms, max_atoms=5, shuffle=False)
+    assert list(sampler) == list(sampler) == [[1, 3, 2], [0]]
+    with pytest.raises(ValueError, match="every molecule"):
+        SizeBucketBatchSampler(n_atoms, n_atoms[:2], max_atoms=5)
+
+
+def test_size_bucket_batch_sampler_distributed():
+    """Make sure the batches are shared between processes with the same number of batches in each."""
+    random = np.random.default_rng(1)
+    n_atoms = random.integers(3, 40, 101)
+    samplers = [
+        SizeBucketBatchSampler(
+            n_atoms, n_atoms, max_atoms=60, bucket_size=20, num_replicas=3, rank=rank
+        )
+        for rank in range(3)
+    ]
+    single = SizeBucketBatchSampler(n_atoms, n_atoms, max_atoms=60, bucket_size=20)
+    for epoch in range(2):
+        for sampler in samplers + [single]:
+            sampler.set_epoch(epoch)
+        shares = [list(sampler) for sampler in samplers]
+        assert len({len(share) for share in shares}) == 1
+        batches = list(single)
+        # the shares cover every batch and only repeat batches to even out the counts
+        shared = [batch for share in shares for batch in share]
+        assert {tuple(batch) for batch in shared} == {tuple(batch) for batch in batches}
+        assert len(shared) - len(batches) < 3
+
+    with pytest.raises(ValueError, match="rank 3"):
+        SizeBucketBatchSampler(n_atoms, n_atoms, max_atoms=60, num_replicas=3, rank=3)
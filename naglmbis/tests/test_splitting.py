@@ -0,0 +1,179 @@
+import numpy as np
+import pytest
+from rdkit import DataStructs
+
+from naglmbis.datasets import read_key_list
+from naglmbis.datasets.splitting import (
+    butina_clusters,
+    butina_split,
+    compute_fingerprints,
+    compute_minhash_signatures,
+    compute_scaffolds,
+    find_similar_molecules,
+    get_split_sizes,
+    load_fingerprints,
+    maxmin_split,
+    scaffold_split,
+    split_groups,
+    write_split_key_lists,
+)
+
+SMILES = {
+    f"mol-{i}": smiles
+    for i, smiles in enumerate(
+        [
+            "C",
+            "CC",
+            "CCC",
+            "CCCC",
+            "CO",
+            "CCO",
+            "CCCO",
+            "CN",
+            "CCN",
+            "c1ccccc1",
+            "c1ccccc1O",
+            "c1ccncc1",
+            "CC(=O)O",
+            "CC(=O)[O-]",
+            "C[NH3+]",
+            "ClCCl",
+            "FC(F)F",
+            "C1CCCCC1",
+            "C1CCOC1",
+            "CS(C)=O",
+        ]
+    )
+}
+
+
+def test_parallel_fingerprints():
+    """Make sure the worker pool gives the same fingerprints in the same order."""
+    smiles = list(SMILES.values())
+    serial = compute_fingerprints(smiles, chunk_size=3)
+    parallel = compute_fingerprints(smiles, n_workers=2, chunk_size=3)
+    assert serial == parallel
+
+
+def test_fingerprint_cache(tmpdir):
+    """Make sure cached fingerprints are reused and missing molecules are added."""
+    cache_file = str(tmpdir.join("fingerprints.parquet"))
+    first = dict(list(SMILES.items())[:10])
+    fingerprints = load_fingerprints(first, cache_file=cache_file)
+    assert fingerprints == compute_fingerprints(list(first.values()))
+
+    # a key which now holds a different molecule is recomputed
+    load_fingerprints({"mol-10": "CCCCCC"}, cache_file=cache_file)
+    all_fingerprints = load_fingerprints(SMILES, cache_file=cache_file)
+    assert all_fingerprints == compute_fingerprints(list(SMILES.values()))
+    assert all_fingerprints[10] != compute_fingerprints(["CCCCCC"])[0]
+
+    # the fingerprints only use the heavy atoms like the DeepChem splitter
+    assert compute_fingerprints(["[H]OC([H])([H])[H]"]) == compute_fingerprints(["CO"])
+
+    # a different fingerprint length does not use the cache
+    short = load_fingerprints(first, cache_file=cache_file, n_bits=64)
+    assert all(fingerprint.GetNumBits() == 64 for fingerprint in short)
+
+
+def test_split_sizes():
+    assert get_split_sizes(105, (0.8, 0.1, 0.1)) == (85, 10, 10)
+    with pytest.raises(ValueError, match="sum to 1"):
+        get_split_sizes(10, (0.8, 0.1, 0.2))
+
+
+def test_maxmin_split(tmpdir):
+    """Make sure the splits cover every molecule once and are reproducible."""
+    fingerprints = compute_fingerprints(list(SMILES.values()))
+    train, valid, test = maxmin_split(fingerprints, fractions=(0.6, 0.2, 0.2), seed=1)
+    assert (len(train), len(valid), len(test)) == (12, 4, 4)
+    assert sorted(np.concatenate([train, valid, test]).tolist()) == list(range(20))
+    for split, repeat in zip(
+        (train, valid, test), maxmin_split(fingerprints, (0.6, 0.2, 0.2), seed=1)
+    ):
+        assert np.array_equal(split, repeat)
+
+    # the test set should be more diverse than a block of similar molecules
+    test_similarity = np.mean(
+        [
+            DataStructs.BulkTanimotoSimilarity(fingerprints[i], [fingerprints[j]])[0]
+            for i in test
+            for j in test
+            if i != j
+        ]
+    )
+    assert test_similarity < 0.2
+
+    keys = list(SMILES)
+    key_files = write_split_key_lists(str(tmpdir), keys, (train, valid, test))
+    assert read_key_list(key_files["test"]) == [keys[i] for i in test]
+
+
+def test_split_groups():
+    """Make sure groups are never split and the largest fill the training set."""
+    groups = [np.arange(0, 6), np.arange(6, 8), np.arange(8, 9), np.arange(9, 10)]
+    train, valid, test = split_groups(groups, fractions=(0.6, 0.2, 0.2))
+    assert train.tolist() == list(range(6))
+    assert valid.tolist() == [6, 7]
+    assert test.tolist() == [8, 9]
+
+    train, valid, test = split_groups(groups, fractions=(0.4, 0.3, 0.3))
+    assert train.tolist() == list(range(6))
+
+
+def test_scaffold_split():
+    smiles = list(SMILES.values())
+    scaffolds = compute_scaffolds(smiles)
+    assert scaffolds[smiles.index("c1ccccc1O")] == "c1ccccc1"
+    assert scaffolds[smiles.index("CCO")] == ""
+    assert compute_scaffolds(smiles, n_workers=2, chunk_size=3) == scaffolds
+
+    splits = scaffold_split(scaffolds, fractions=(0.6, 0.2, 0.2))
+    assert sorted(np.concatenate(splits).tolist()) == list(range(20))
+    for split in splits:
+        others = set(range(20)) - set(split.tolist())
+        split_scaffolds = {scaffolds[i] for i in split}
+        assert not split_scaffolds & {scaffolds[i] for i in others}
+
+
+def test_minhash_signatures():
+    """Make sure matching signature values estimate the Tanimoto similarity."""
+    fingerprints = compute_fingerprints(["CCCCCCCCO", "CCCCCCCCN", "c1ccccc1"])
+    signatures = compute_minhash_signatures(fingerprints, n_hashes=512, seed=1)
+    for i, j in [(0, 1), (0, 2)]:
+        similarity = DataStructs.TanimotoSimilarity(fingerprints[i], fingerprints[j])
+        estimate = np.mean(signatures[i] == signatures[j])
+        assert abs(similarity - estimate) < 0.1
+
+
+def test_find_similar_molecules():
+    """Make sure the hashed neighbours only hold true neighbours and find the very similar pairs."""
+    smiles = ["C" * n + "O" for n in range(5, 15)] + list(SMILES.values())
+    fingerprints = compute_fingerprints(smiles)
+    exact = find_similar_molecules(fingerprints, 0.5, approximate=False, chunk_size=7)
+    approximate = find_similar_molecules(fingerprints, 0.5, n_bands=32, rows_per_band=2)
+    n_exact, n_found = 0, 0
+    for i, (exact_neighbours, neighbours) in enumerate(zip(exact, approximate)):
+        assert set(neighbours.tolist()) <= set(exact_neighbours.tolist())
+        assert i not in exact_neighbours
+        n_exact += len(exact_neighbours)
+        n_found += len(neighbours)
+    assert n_exact > 0
+    assert n_found / n_exact > 0.9
+
+
+def test_butina_split():
+    neighbours = [
+        np.array([1, 2]),
+        np.array([0]),
+        np.array([0]),
+        np.array([4]),
+        np.array([3]),
+        np.array([], dtype=np.int64),
+    ]
+    clusters = butina_clusters(neighbours)
+    assert [cluster.tolist() for cluster in clusters] == [[0, 1, 2], [3, 4], [5]]
+
+    fingerprints = compute_fingerprints(list(SMILES.values()))
+    splits = butina_split(fingerprints, fractions=(0.6, 0.2, 0.2), threshold=0.3)
+    assert sorted(np.concatenate(splits).tolist()) == list(range(20))
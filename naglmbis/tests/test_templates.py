@@ -0,0 +1,94 @@
+import numpy as np
+import pytest
+from rdkit import Chem
+
+from naglmbis.models import load_charge_model
+from naglmbis.models.templates import (
+    ResidueTemplateCharges,
+    TemplateLibrary,
+    build_capped_template,
+    get_residues,
+)
+
+
+@pytest.fixture()
+def peptide():
+    # keep the PDB residue information on the hydrogens so the residues come from it
+    return Chem.AddHs(Chem.MolFromSequence("AAAGA"), addResidueInfo=True)
+
+
+def test_get_residues(peptide):
+    """Make sure the residues are the same from the PDB information and the peptide bond patterns."""
+    assert all(atom.GetPDBResidueInfo() is not None for atom in peptide.GetAtoms())
+    residues = get_residues(peptide)
+    assert [len(atoms) for atoms in residues] == [11, 10, 10, 7, 12]
+    # the smiles round trip reorders the atoms so compare the residue atom sets in the peptide atom order
+    no_pdb_info = Chem.AddHs(Chem.MolFromSmiles(Chem.MolToSmiles(peptide)))
+    peptide_indices = peptide.GetSubstructMatch(no_pdb_info)
+    assert len(peptide_indices) == peptide.GetNumAtoms()
+    no_pdb_residues = {
+        frozenset(peptide_indices[atom] for atom in atoms)
+        for atoms in get_residues(no_pdb_info)
+    }
+    assert no_pdb_residues == {
+        frozenset(int(atom) for atom in atoms) for atoms in residues
+    }
+
+
+def test_get_pdb_residues():
+    """Make sure the PDB residue information is used in place of the bond patterns when every atom has it."""
+    molecule = Chem.AddHs(Chem.MolFromSmiles("CCO"))
+    for atom in molecule.GetAtoms():
+        # the oxygen and its hydrogen make the second residue
+        in_first = atom.GetIdx() in {0, 1, 3, 4, 5, 6, 7}
+        info = Chem.AtomPDBResidueInfo()
+        info.SetResidueName("UNK")
+        info.SetResidueNumber(1 if in_first else 2)
+        atom.SetMonomerInfo(info)
+    assert [atoms.tolist() for atoms in get_residues(molecule)] == [
+        [0, 1, 3, 4, 5, 6, 7],
+        [2, 8],
+    ]
+    # without information on every atom the molecule has no peptide bonds to cut
+    molecule.GetAtomWithIdx(8).SetMonomerInfo(None)
+    assert [atoms.tolist() for atoms in get_residues(molecule)] == [list(range(9))]
+
+
+def test_capped_templates(peptide):
+    """Make sure repeated residues give the same capped template."""
+    templates = [
+        build_capped_template(peptide, atoms) for atoms in get_residues(peptide)
+    ]
+    assert [len(caps) for _, caps in templates] == [1, 2, 2, 2, 1]
+    # the n-terminal and inner alanines match once capped
+    assert len({Chem.MolToSmiles(template) for template, _ in templates}) == 3
+
+
+def test_template_charges(peptide, tmpdir):
+    """Make sure template charges are close to the whole molecule and templates are only predicted once."""
+    charge_model = load_charge_model(charge_model="nagl-v1-mbis")
+    template_charges = ResidueTemplateCharges(
+        model=charge_model,
+        model_name="nagl-v1-mbis",
+        library=TemplateLibrary(model_name="nagl-v1-mbis"),
+    )
+    charges = template_charges.compute_charges(peptide)
+    assert template_charges.n_predicted == 3
+    assert charges.sum() == pytest.approx(0, abs=1e-6)
+    ref_charges = charge_model.compute_properties(peptide)["mbis-charges"]
+    assert np.abs(charges - ref_charges.detach().numpy().reshape(-1)).mean() < 0.05
+
+    with tmpdir.as_cwd():
+        template_charges.library.to_file("templates.json")
+        library = TemplateLibrary.from_file("templates.json")
+    with pytest.raises(ValueError, match="nagl-v1-mbis-dipole"):
+        ResidueTemplateCharges(
+            model=load_charge_model(charge_model="nagl-v1-mbis-dipole"),
+            model_name="nagl-v1-mbis-dipole",
+            library=library,
+        )
+    reloaded = ResidueTemplateCharges(
+        model=charge_model, model_name="nagl-v1-mbis", library=library
+    )
+    assert np.allclose(reloaded.compute_charges(peptide), charges)
+    assert reloaded.n_predicted == 0
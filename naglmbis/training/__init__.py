@@ -0,0 +1,18 @@
+from naglmbis.training.cache import FeatureCache
+from naglmbis.training.dataset import FeatureStoreDataset
+from naglmbis.training.feature_store import (
+    FeatureStore,
+    FeatureStoreWriter,
+    build_feature_store,
+)
+from naglmbis.training.sampler import SizeBucketBatchSampler, ThroughputLogger
+
+__all__ = [
+    FeatureCache,
+    FeatureStore,
+    FeatureStoreDataset,
+    FeatureStoreWriter,
+    SizeBucketBatchSampler,
+    ThroughputLogger,
+    build_feature_store,
+]
@@ -0,0 +1,248 @@
+"""
+A content addressed cache of feature stores keyed by the atom feature configuration and the dataset contents.
+"""
+
+import dataclasses
+import hashlib
+import json
+import os
+import pathlib
+import shutil
+import tempfile
+import time
+from typing import Iterable, Optional, Union
+
+from naglmbis.training.feature_store import (
+    METADATA_FILE,
+    FeatureStore,
+    build_feature_store,
+)
+
+# bump when the layout of the feature stores changes so old entries are not reused
+CACHE_VERSION = 2
+ENTRY_FILE = "cache-entry.json"
+FILE_HASHES = "file-hashes.json"
+# build directories modified more recently than this may still be in use
+_BUILD_TIMEOUT = 24 * 60 * 60
+
+
+def _feature_state(feature) -> dict:
+    """Get the type and every parameter of an atom feature as a json compatible dictionary."""
+    if dataclasses.is_dataclass(feature) and not isinstance(feature, type):
+        state = dataclasses.asdict(feature)
+    elif isinstance(feature, dict):
+        state = dict(feature)
+    else:
+        raise TypeError(
+            f"The atom feature {feature!r} must be a dataclass or a dictionary to be hashed."
+        )
+    state.setdefault("type", f"{type(feature).__module__}.{type(feature).__qualname__}")
+    return state
+
+
+def hash_features(atom_features: Iterable) -> str:
+    """
+    Hash the atom features, two feature lists have the same hash only if they have the same features in the same
+    order with the same parameters such as the one hot values, ring sizes or electronegativity tables.
+    """
+    states = [_feature_state(feature) for feature in atom_features]
+    # enums such as the rdkit hybridization types are encoded by name
+    encoded = json.dumps(states, sort_keys=True, default=str)
+    return hashlib.sha256(encoded.encode()).hexdigest()
+
+
+def hash_file(file_name: Union[str, pathlib.Path], chunk_size: int = 1 << 20) -> str:
+    """Hash the contents of a file."""
+    file_hash = hashlib.sha256()
+    with open(file_name, "rb") as file:
+        for chunk in iter(lambda: file.read(chunk_size), b""):
+            file_hash.update(chunk)
+    return file_hash.hexdigest()
+
+
+def _write_json(data, file_name: pathlib.Path):
+    """Write json through a temporary file so readers never see a partial file."""
+    temporary = file_name.with_name(f"{file_name.name}.{os.getpid()}.tmp")
+    with open(temporary, "w") as output:
+        json.dump(data, output, indent=2)
+    os.replace(temporary, file_name)
+
+
+def _read_json(file_name: pathlib.Path) -> Optional[dict]:
+    try:
+        with open(file_name) as input_file:
+            return json.load(input_file)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+
+class FeatureCache:
+    """
+    A directory of feature stores where each entry is keyed by a hash of the atom features, the label columns and
+    the contents of the source datasets.
+
+    Experiments which only change the model or training settings share the same entry however the config or the
+    dataset paths are written, while changing any feature parameter or dataset gives a new entry. The content
+    hash of each dataset is remembered against its size and modification time so files are only hashed again when
+    they change.
+    """
+
+    def __init__(self, cache_dir: Union[str, pathlib.Path]):
+        self.cache_dir = pathlib.Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+
+    def _hash_sources(self, paths: Iterable[str], file_hashes: dict) -> list[str]:
+        source_hashes = []
+        for path in paths:
+            path = os.path.abspath(path)
+            stat = os.stat(path)
+            known = file_hashes.get(path)
+            if (
+                known is None
+                or known["size"] != stat.st_size
+                or known["mtime_ns"] != stat.st_mtime_ns
+            ):
+                known = {
+                    "size": stat.st_size,
+                    "mtime_ns": stat.st_mtime_ns,
+                    "sha256": hash_file(path),
+                }
+                file_hashes[path] = known
+            source_hashes.append(known["sha256"])
+        return source_hashes
+
+    def hash_sources(self, paths: Iterable[str]) -> list[str]:
+        """Get the content hash of each dataset, only files which changed since they were last hashed are read."""
+        file_hashes = _read_json(self.cache_dir / FILE_HASHES) or {}
+        source_hashes = self._hash_sources(paths, file_hashes)
+        _write_json(file_hashes, self.cache_dir / FILE_HASHES)
+        return source_hashes
+
+    def get_entry_dir(
+        self,
+        paths: list[str],
+        atom_columns: list[str],
+        conformation_columns: list[str],
+        atom_features: list,
+    ) -> pathlib.Path:
+        """Get the directory of the feature store of a dataset, it may not have been built yet."""
+        entry_key = json.dumps(
+            {
+                "version": CACHE_VERSION,
+                "atom_features": hash_features(atom_features),
+                "sources": self.hash_sources(paths),
+                "atom_columns": list(atom_columns),
+                "conformation_columns": list(conformation_columns),
+            },
+            sort_keys=True,
+        )
+        return (
+            self.cache_dir
+            / f"features-{hashlib.sha256(entry_key.encode()).hexdigest()}"
+        )
+
+    def get_store(
+        self,
+        paths: list[str],
+        atom_columns: list[str],
+        conformation_columns: list[str],
+        atom_features: list,
+        shard_size: int = 50000,
+    ) -> FeatureStore:
+        """
+        Get the feature store of a dataset, building it if it is not in the cache.
+
+        Args:
+            paths: The grouped parquet datasets.
+            atom_columns: The label columns with values for every atom.
+            conformation_columns: The label columns with values for each conformation.
+            atom_features: The atom features of the model.
+            shard_size: The number of molecules in each shard of a new store.
+        """
+        entry_dir = self.get_entry_dir(
+            paths, atom_columns, conformation_columns, atom_features
+        )
+        if not (entry_dir / METADATA_FILE).exists():
+            # build in a private directory and move it into place in one step, so runs of a sweep which build
+            # the same entry at once never write to or read from a partial store
+            build_dir = pathlib.Path(
+                tempfile.mkdtemp(
+                    prefix=f"{entry_dir.name}.", suffix=".tmp", dir=self.cache_dir
+                )
+            )
+            try:
+                build_feature_store(
+                    directory=str(build_dir / "store"),
+                    paths=paths,
+                    atom_columns=atom_columns,
+                    conformation_columns=conformation_columns,
+                    atom_features=atom_features,
+                    shard_size=shard_size,
+                )
+                try:
+                    os.rename(build_dir / "store", entry_dir)
+                except OSError:
+                    # another run finished the entry first and its store is the same
+                    if not (entry_dir / METADATA_FILE).exists():
+                        raise
+            finally:
+                shutil.rmtree(build_dir)
+        store = FeatureStore(str(entry_dir))
+        entry = _read_json(entry_dir / ENTRY_FILE) or {
+            "sources": [os.path.abspath(path) for path in paths],
+            "source_hashes": self.hash_sources(paths),
+            "atom_features": [_feature_state(feature) for feature in atom_features],
+            "created": time.time(),
+        }
+        entry["last_used"] = time.time()
+        _write_json(json.loads(json.dumps(entry, default=str)), entry_dir / ENTRY_FILE)
+        return store
+
+    def collect_garbage(
+        self, max_age_days: Optional[float] = None, dry_run: bool = False
+    ) -> list[pathlib.Path]:
+        """
+        Remove the stale entries of the cache, these are entries whose source datasets have been deleted or
+        changed, entries not used within `max_age_days` and the build directories of interrupted builds which
+        have not been written to for a day.
+
+        Args:
+            max_age_days: Remove entries not used for this many days, by default entries are kept however old.
+            dry_run: Only find the stale entries.
+
+        Returns:
+            The stale entry directories.
+        """
+        now = time.time()
+        file_hashes = _read_json(self.cache_dir / FILE_HASHES) or {}
+        stale = []
+        for entry_dir in sorted(self.cache_dir.glob("features-*")):
+            entry = _read_json(entry_dir / ENTRY_FILE)
+            if entry is None or not (entry_dir / METADATA_FILE).exists():
+                # the store being built is one level down so its writes are seen too
+                modified = max(
+                    path.stat().st_mtime for path in [entry_dir, *entry_dir.glob("*")]
+                )
+                if now - modified > _BUILD_TIMEOUT:
+                    stale.append(entry_dir)
+                continue
+            if max_age_days is not None and now - entry["last_used"] > (
+                max_age_days * 24 * 60 * 60
+            ):
+                stale.append(entry_dir)
+                continue
+            sources = entry["sources"]
+            if not all(os.path.exists(path) for path in sources) or (
+                self._hash_sources(sources, file_hashes) != entry["source_hashes"]
+            ):
+                stale.append(entry_dir)
+
+        # forget the hashes of deleted datasets
+        file_hashes = {
+            path: known for path, known in file_hashes.items() if os.path.exists(path)
+        }
+        if not dry_run:
+            for entry_dir in stale:
+                shutil.rmtree(entry_dir)
+            _write_json(file_hashes, self.cache_dir / FILE_HASHES)
+        return stale
@@ -0,0 +1,53 @@
+"""
+Torch datasets which read featurized molecules from a feature store.
+"""
+
+import numpy as np
+import torch
+from nagl.molecules import DGLMolecule
+
+from naglmbis.models.featurize import PACKED_BITS, PACKED_DENSE, graph_from_arrays
+from naglmbis.training.feature_store import FeatureStore
+
+
+class FeatureStoreDataset(torch.utils.data.Dataset):
+    """
+    A dataset of the molecules in a feature store, each entry is built from slices of the memory-mapped arrays in
+    the same layout as `GroupedMoleculeDataset` so the batches can be made with `collate_grouped`.
+
+    The atom features are left packed, with the binary columns as bits, and are only expanded to floats once a
+    batch reaches the model, see `expand_packed_features`.
+    """
+
+    def __init__(self, store: FeatureStore):
+        self.store = store
+
+    def __len__(self):
+        return len(self.store)
+
+    def get_molecule_sizes(self) -> tuple[np.ndarray, np.ndarray]:
+        """Get the number of atoms and graph edges, two per bond, of every molecule."""
+        n_atoms, n_bonds = self.store.get_molecule_sizes()
+        return n_atoms, 2 * n_bonds
+
+    def __getitem__(self, index: int) -> tuple[DGLMolecule, dict[str, torch.Tensor]]:
+        molecule = self.store.get_molecule(index)
+        dgl_molecule = graph_from_arrays(
+            bonds=torch.from_numpy(np.array(molecule["bonds"])),
+            n_atoms=len(molecule["formal-charges"]),
+            atom_features=None,
+            formal_charges=torch.from_numpy(
+                np.array(molecule["formal-charges"], dtype=np.int64)
+            ),
+        )
+        dgl_molecule.graph.ndata[PACKED_BITS] = torch.from_numpy(
+            np.array(molecule["atom-bits"])
+        )
+        dgl_molecule.graph.ndata[PACKED_DENSE] = torch.from_numpy(
+            np.array(molecule["atom-dense"])
+        )
+        labels = {
+            label: torch.from_numpy(np.array(molecule[f"label-{label}"]))
+            for label in self.store.labels
+        }
+        return dgl_molecule, labels
@@ -0,0 +1,330 @@
+"""
+A sharded on-disk store of featurized molecules held in contiguous arrays which are memory-mapped when read.
+"""
+
+import json
+import os
+from typing import Iterable
+
+import numpy as np
+
+from naglmbis.datasets.builder import iter_grouped_molecules, molecule_from_smiles
+from naglmbis.models.graph import get_bond_indices
+
+METADATA_FILE = "metadata.json"
+
+# the types of the atom features which only have 0 or 1 values, the one hot and membership features
+BINARY_FEATURE_TYPES = {
+    "element",
+    "connectivity",
+    "is_aromatic",
+    "is_in_ring",
+    "formal_charge",
+    "hydrogenatoms",
+    "ringofsize",
+    "lipinskidonor",
+    "lipinskiacceptor",
+    "hybridization",
+}
+
+
+def get_binary_columns(atom_features: list, widths: list[int]) -> np.ndarray:
+    """
+    Find the atom feature columns which only hold 0 or 1 values.
+
+    Args:
+        atom_features: The atom features as feature objects or dictionaries.
+        widths: The number of columns of each feature.
+
+    Returns:
+        A boolean mask over the feature columns.
+    """
+    is_binary = [
+        (
+            feature.get("type")
+            if isinstance(feature, dict)
+            else getattr(feature, "type", None)
+        )
+        in BINARY_FEATURE_TYPES
+        for feature in atom_features
+    ]
+    return np.repeat(np.array(is_binary, dtype=bool), widths)
+
+
+def _shard_dir(directory: str, shard: int) -> str:
+    return os.path.join(directory, f"shard-{shard:05d}")
+
+
+def _get_offsets(lengths: list[int]) -> np.ndarray:
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    return offsets
+
+
+class FeatureStoreWriter:
+    """
+    Write featurized molecules into shards of contiguous arrays, each array is concatenated over the molecules of
+    the shard with an offsets array giving the rows of each molecule.
+
+    Each shard holds the binary atom feature columns packed into uint8 bits, the other atom feature columns as
+    float32, the int8 formal charges, the int32 molecule local bond indices and one array per label where per atom
+    labels have one row per atom of each conformation and the other labels one row per conformation.
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        label_columns: dict[str, bool],
+        binary_columns: np.ndarray,
+        shard_size: int = 50000,
+    ):
+        """
+        Args:
+            directory: The directory the store is written to, it must not already hold a store.
+            label_columns: If each label column has values for every atom keyed by the column name.
+            binary_columns: The mask of the atom feature columns which only hold 0 or 1 values, see
+                `get_binary_columns`.
+            shard_size: The number of molecules in each shard.
+
+        Raises:
+            FileExistsError: If the directory already holds a feature store.
+        """
+        if os.path.exists(os.path.join(directory, METADATA_FILE)):
+            raise FileExistsError(f"A feature store already exists in {directory}.")
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.label_columns = label_columns
+        self.binary_columns = np.asarray(binary_columns, dtype=bool)
+        self.shard_size = shard_size
+        self.label_widths: dict[str, int] = {}
+        self.shard_sizes: list[int] = []
+        self._buffer: list[dict[str, np.ndarray]] = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *args):
+        # a failed build is left without metadata so it is never read as a complete store
+        if exc_type is None:
+            self.close()
+
+    def add_molecule(
+        self,
+        atom_features: np.ndarray,
+        bonds: np.ndarray,
+        formal_charges: np.ndarray,
+        labels: dict[str, np.ndarray],
+    ):
+        """
+        Add a featurized molecule.
+
+        Args:
+            atom_features: The (n_atoms, n_features) atom features.
+            bonds: The (n_bonds, 2) atom indices of each bond.
+            formal_charges: The formal charge of each atom.
+            labels: The (n_conformations, n_values) values of each label column, where the values of per atom
+                labels are the flattened (n_atoms, n_values_per_atom) values of each conformation.
+
+        Raises:
+            ValueError: If the atom features do not match the binary column mask.
+        """
+        n_atoms = len(formal_charges)
+        atom_features = np.asarray(atom_features).reshape(n_atoms, -1)
+        if atom_features.shape[1] != len(self.binary_columns):
+            raise ValueError(
+                f"The molecule has {atom_features.shape[1]} atom feature columns but the store expects "
+                f"{len(self.binary_columns)}."
+            )
+        binary_features = atom_features[:, self.binary_columns]
+        if not np.all((binary_features == 0) | (binary_features == 1)):
+            raise ValueError(
+                "The binary atom feature columns hold values other than 0 or 1."
+            )
+        molecule = {
+            # one row of bytes per atom with the binary columns in the high to low bits of each byte
+            "atom-bits": np.packbits(binary_features.astype(bool), axis=1),
+            "atom-dense": atom_features[:, ~self.binary_columns].astype(np.float32),
+            "formal-charges": np.asarray(formal_charges, dtype=np.int8),
+            "bonds": np.asarray(bonds, dtype=np.int32).reshape(-1, 2),
+        }
+        for name, is_per_atom in self.label_columns.items():
+            values = np.asarray(labels[name], dtype=np.float32)
+            width = values.shape[1] // n_atoms if is_per_atom else values.shape[1]
+            molecule[f"label-{name}"] = values.reshape(-1, width)
+            self.label_widths.setdefault(name, width)
+        self._buffer.append(molecule)
+        if len(self._buffer) >= self.shard_size:
+            self.flush()
+
+    def flush(self):
+        """Write the buffered molecules as a shard."""
+        if not self._buffer:
+            return
+        shard_dir = _shard_dir(self.directory, len(self.shard_sizes))
+        os.makedirs(shard_dir, exist_ok=True)
+        for name in self._buffer[0]:
+            arrays = [molecule[name] for molecule in self._buffer]
+            np.save(os.path.join(shard_dir, f"{name}.npy"), np.concatenate(arrays))
+            np.save(
+                os.path.join(shard_dir, f"{name}-offsets.npy"),
+                _get_offsets([len(array) for array in arrays]),
+            )
+        self.shard_sizes.append(len(self._buffer))
+        self._buffer = []
+
+    def close(self):
+        """Write the last shard and the metadata which marks the store as complete."""
+        self.flush()
+        with open(os.path.join(self.directory, METADATA_FILE), "w") as metadata_file:
+            json.dump(
+                {
+                    "binary_columns": self.binary_columns.tolist(),
+                    "labels": {
+                        name: {
+                            "per_atom": is_per_atom,
+                            "n_values": self.label_widths.get(name),
+                        }
+                        for name, is_per_atom in self.label_columns.items()
+                    },
+                    "shard_sizes": self.shard_sizes,
+                },
+                metadata_file,
+                indent=2,
+            )
+
+
+class FeatureStore:
+    """
+    Read molecules from a feature store by slicing memory-mapped arrays, nothing is deserialized and only the
+    pages which are touched are read so several processes can share the page cache.
+
+    The arrays are opened lazily in each process so the store can be sent to data loader workers cheaply.
+    """
+
+    def __init__(self, directory: str):
+        """
+        Raises:
+            FileNotFoundError: If the directory does not hold a complete feature store.
+        """
+        with open(os.path.join(directory, METADATA_FILE)) as metadata_file:
+            metadata = json.load(metadata_file)
+        self.directory = directory
+        self.binary_columns = np.array(metadata["binary_columns"], dtype=bool)
+        self.labels = metadata["labels"]
+        self.shard_offsets = _get_offsets(metadata["shard_sizes"])
+        self._shards: dict[int, dict[str, np.ndarray]] = {}
+
+    def __len__(self):
+        return int(self.shard_offsets[-1])
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_shards"] = {}
+        return state
+
+    def _get_shard(self, shard: int) -> dict[str, np.ndarray]:
+        if shard not in self._shards:
+            shard_dir = _shard_dir(self.directory, shard)
+            self._shards[shard] = {
+                file_name[:-4]: np.load(
+                    os.path.join(shard_dir, file_name), mmap_mode="r"
+                )
+                for file_name in os.listdir(shard_dir)
+                if file_name.endswith(".npy")
+            }
+        return self._shards[shard]
+
+    def get_molecule_sizes(self) -> tuple[np.ndarray, np.ndarray]:
+        """Get the number of atoms and bonds of every molecule from the offsets of each shard."""
+        n_atoms, n_bonds = [np.zeros(0, dtype=np.int64)], [np.zeros(0, dtype=np.int64)]
+        for shard in range(len(self.shard_offsets) - 1):
+            arrays = self._get_shard(shard)
+            n_atoms.append(np.diff(arrays["formal-charges-offsets"]))
+            n_bonds.append(np.diff(arrays["bonds-offsets"]))
+        return np.concatenate(n_atoms), np.concatenate(n_bonds)
+
+    def get_molecule(self, index: int) -> dict[str, np.ndarray]:
+        """
+        Get read only views of the arrays of a molecule.
+
+        Returns:
+            The packed binary and the float atom features, formal charges, bonds and the (n_conformations,
+            n_atoms, n_values) per atom labels and (n_conformations, n_values) other labels keyed by
+            `label-{name}`.
+        """
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(f"The feature store has {len(self)} molecules.")
+        shard = int(np.searchsorted(self.shard_offsets, index, side="right")) - 1
+        arrays = self._get_shard(shard)
+        local_index = index - self.shard_offsets[shard]
+        molecule = {}
+        for name in ["atom-bits", "atom-dense", "formal-charges", "bonds"] + [
+            f"label-{label}" for label in self.labels
+        ]:
+            offsets = arrays[f"{name}-offsets"]
+            molecule[name] = arrays[name][
+                offsets[local_index] : offsets[local_index + 1]
+            ]
+        n_atoms = len(molecule["formal-charges"])
+        for label, label_info in self.labels.items():
+            if label_info["per_atom"]:
+                values = molecule[f"label-{label}"]
+                molecule[f"label-{label}"] = values.reshape(
+                    -1, n_atoms, values.shape[1]
+                )
+        return molecule
+
+
+def build_feature_store(
+    directory: str,
+    paths: list[str],
+    atom_columns: Iterable[str],
+    conformation_columns: Iterable[str],
+    atom_features: list,
+    shard_size: int = 50000,
+) -> FeatureStore:
+    """
+    Featurize each molecule of grouped parquet datasets once into a feature store.
+
+    Args:
+        directory: The directory the store is written to.
+        paths: The grouped parquet datasets.
+        atom_columns: The label columns with values for every atom.
+        conformation_columns: The label columns with values for each conformation.
+        atom_features: The atom features of the model.
+        shard_size: The number of molecules in each shard.
+    """
+    atom_columns, conformation_columns = list(atom_columns), list(conformation_columns)
+    label_columns = {name: True for name in atom_columns}
+    label_columns.update({name: False for name in conformation_columns})
+    writer = None
+    for smiles, values in iter_grouped_molecules(paths, list(label_columns)):
+        molecule = molecule_from_smiles(smiles)
+        n_atoms = molecule.GetNumAtoms()
+        features = [
+            np.asarray(feature(molecule)).reshape(n_atoms, -1)
+            for feature in atom_features
+        ]
+        if writer is None:
+            binary_columns = get_binary_columns(
+                atom_features, [feature.shape[1] for feature in features]
+            )
+            writer = FeatureStoreWriter(
+                directory, label_columns, binary_columns, shard_size
+            )
+        writer.add_molecule(
+            atom_features=np.hstack(features) if features else np.zeros((n_atoms, 0)),
+            bonds=get_bond_indices(molecule),
+            formal_charges=np.array(
+                [atom.GetFormalCharge() for atom in molecule.GetAtoms()]
+            ),
+            labels=values,
+        )
+    if writer is None:
+        writer = FeatureStoreWriter(
+            directory, label_columns, np.zeros(0, dtype=bool), shard_size
+        )
+    writer.close()
+    return FeatureStore(directory)
@@ -0,0 +1,201 @@
+"""
+Batch molecules of similar size together under a budget of atoms and edges.
+"""
+
+import time
+from typing import Iterator, Optional
+
+import numpy as np
+import pytorch_lightning as pl
+import torch
+
+
+def pack_batches(
+    order: np.ndarray,
+    n_atoms: np.ndarray,
+    n_edges: np.ndarray,
+    max_atoms: int,
+    max_edges: Optional[int] = None,
+) -> list[list[int]]:
+    """
+    Greedily pack molecules into batches in the given order, a new batch is started when adding a molecule would
+    exceed the atom or edge budget and molecules larger than the budget are given a batch of their own.
+
+    Args:
+        order: The indices of the molecules in the order they are packed.
+        n_atoms: The number of atoms of each molecule.
+        n_edges: The number of graph edges of each molecule.
+        max_atoms: The most atoms in a batch.
+        max_edges: The most edges in a batch, by default only the atoms are limited.
+    """
+    max_edges = np.inf if max_edges is None else max_edges
+    batches, batch = [], []
+    batch_atoms, batch_edges = 0, 0
+    for index, molecule_atoms, molecule_edges in zip(
+        order.tolist(), n_atoms[order].tolist(), n_edges[order].tolist()
+    ):
+        if batch and (
+            batch_atoms + molecule_atoms > max_atoms
+            or batch_edges + molecule_edges > max_edges
+        ):
+            batches.append(batch)
+            batch, batch_atoms, batch_edges = [], 0, 0
+        batch.append(index)
+        batch_atoms += molecule_atoms
+        batch_edges += molecule_edges
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+class SizeBucketBatchSampler(torch.utils.data.Sampler):
+    """
+    A batch sampler which sorts the molecules of each bucket by size and packs them into batches capped by the
+    total number of atoms and edges, so every batch has a similar cost whatever the size of its molecules.
+
+    When shuffled the molecules are dealt into new buckets, molecules of the same size are reordered and the
+    batches are yielded in a random order each epoch.
+
+    For distributed training each process yields its own share of the batches, padded with repeated batches so
+    every process has the same number. Lightning can not inject a distributed sampler into this batch sampler so
+    the trainer must be made with `use_distributed_sampler=False`.
+
+    Note:
+        When a `bucket_size` is set the molecules are packed differently each epoch so the number of batches can
+        change between epochs, while Lightning only reads it when the dataloaders are loaded. Leave `bucket_size`
+        unset for a fixed number of batches.
+    """
+
+    def __init__(
+        self,
+        n_atoms: np.ndarray,
+        n_edges: np.ndarray,
+        max_atoms: int,
+        max_edges: Optional[int] = None,
+        bucket_size: Optional[int] = None,
+        shuffle: bool = True,
+        seed: int = 0,
+        num_replicas: Optional[int] = None,
+        rank: Optional[int] = None,
+    ):
+        """
+        Args:
+            n_atoms: The number of atoms of each molecule.
+            n_edges: The number of graph edges of each molecule.
+            max_atoms: The most atoms in a batch.
+            max_edges: The most edges in a batch, by default only the atoms are limited.
+            bucket_size: The number of molecules sorted together, by default the whole dataset is one bucket.
+            shuffle: If the buckets and batches are shuffled each epoch.
+            seed: The seed of the shuffles, each epoch uses a different stream from it, it must be the same in
+                every process.
+            num_replicas: The number of processes the batches are shared between, by default the world size of the
+                default process group or 1 when not distributed.
+            rank: The rank of this process, by default the rank in the default process group.
+        """
+        self.n_atoms = np.asarray(n_atoms, dtype=np.int64)
+        self.n_edges = np.asarray(n_edges, dtype=np.int64)
+        if len(self.n_atoms) != len(self.n_edges):
+            raise ValueError(
+                "The number of atoms and edges must be given for every molecule."
+            )
+        distributed = torch.distributed.is_available() and (
+            torch.distributed.is_initialized()
+        )
+        if num_replicas is None:
+            num_replicas = torch.distributed.get_world_size() if distributed else 1
+        if rank is None:
+            rank = torch.distributed.get_rank() if distributed else 0
+        if not 0 <= rank < num_replicas:
+            raise ValueError(
+                f"The rank {rank} must be between 0 and the number of replicas {num_replicas}."
+            )
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.max_atoms = max_atoms
+        self.max_edges = max_edges
+        self.bucket_size = bucket_size
+        self.shuffle = shuffle
+        self.seed = seed
+        self.epoch = 0
+        self._batches: Optional[list[list[int]]] = None
+
+    def set_epoch(self, epoch: int):
+        """Set the epoch which seeds the next shuffle."""
+        self.epoch = epoch
+        self._batches = None
+
+    def _get_batches(self) -> list[list[int]]:
+        if self._batches is not None:
+            return self._batches
+        random = np.random.default_rng((self.seed, self.epoch))
+        n_molecules = len(self.n_atoms)
+        order = (
+            random.permutation(n_molecules) if self.shuffle else np.arange(n_molecules)
+        )
+        bucket_size = n_molecules if self.bucket_size is None else self.bucket_size
+        batches = []
+        for start in range(0, n_molecules, max(bucket_size, 1)):
+            bucket = order[start : start + bucket_size]
+            # a stable sort keeps the shuffled order of molecules with the same size
+            bucket = bucket[np.argsort(self.n_atoms[bucket], kind="stable")]
+            batches.extend(
+                pack_batches(
+                    bucket, self.n_atoms, self.n_edges, self.max_atoms, self.max_edges
+                )
+            )
+        if self.shuffle:
+            batches = [batches[i] for i in random.permutation(len(batches))]
+        if self.num_replicas > 1:
+            # every process makes the same batches so each takes every num_replicas-th batch, the first batches are
+            # repeated so every process gets the same number
+            n_batches = -(-len(batches) // self.num_replicas) * self.num_replicas
+            batches = [batches[i % len(batches)] for i in range(n_batches)]
+            batches = batches[self.rank :: self.num_replicas]
+        self._batches = batches
+        return batches
+
+    def __len__(self):
+        return len(self._get_batches())
+
+    def __iter__(self) -> Iterator[list[int]]:
+        batches = self._get_batches()
+        # the next epoch is shuffled differently unless the epoch is set explicitly
+        self.set_epoch(self.epoch + 1)
+        yield from batches
+
+
+class ThroughputLogger(pl.Callback):
+    """
+    Log the number of molecules and atoms trained on per second in each epoch, the time runs from the start of
+    the epoch to the end of its last training batch so validation is not counted.
+    """
+
+    def on_train_epoch_start(self, trainer: pl.Trainer, pl_module: pl.LightningModule):
+        self._start_time = time.perf_counter()
+        self._end_time = self._start_time
+        self._n_molecules, self._n_atoms = 0, 0
+
+    def on_train_batch_end(
+        self,
+        trainer: pl.Trainer,
+        pl_module: pl.LightningModule,
+        outputs,
+        batch,
+        batch_idx,
+    ):
+        molecules, _ = batch
+        self._n_molecules += molecules.graph.batch_size
+        self._n_atoms += molecules.graph.num_nodes()
+        self._end_time = time.perf_counter()
+
+    def on_train_epoch_end(self, trainer: pl.Trainer, pl_module: pl.LightningModule):
+        elapsed = self._end_time - self._start_time
+        if elapsed <= 0:
+            return
+        pl_module.log_dict(
+            {
+                "train/molecules_per_second": self._n_molecules / elapsed,
+                "train/atoms_per_second": self._n_atoms / elapsed,
+                "train/epoch_time": elapsed,
+            }
+        )
@@ -0,0 +1,72 @@
+# Compare assembling a dataset split from several reference HDF5 files by checking every file for each key in split
+# order against reading through the key index in on-disk order with a pool of readers
+import os
+import tempfile
+import time
+
+import h5py
+import numpy as np
+
+from naglmbis.datasets.builder import iter_molecule_groups, read_molecule_group
+
+N_FILES = 4
+N_MOLECULES_PER_FILE = 5000
+N_CONFORMATIONS = 5
+N_ATOMS = 30
+
+random = np.random.default_rng(0)
+
+with tempfile.TemporaryDirectory() as temp_dir:
+    reference_files = []
+    all_keys = []
+    for file_index in range(N_FILES):
+        file_name = os.path.join(temp_dir, f"reference-{file_index}.hdf5")
+        with h5py.File(file_name, "w") as reference:
+            for molecule_index in range(N_MOLECULES_PER_FILE):
+                key = f"mol-{file_index}-{molecule_index}"
+                group = reference.create_group(key)
+                group.create_dataset(
+                    "smiles", data=["C" * 10], dtype=h5py.string_dtype()
+                )
+                group.create_dataset(
+                    "conformations", data=random.random((N_CONFORMATIONS, N_ATOMS, 3))
+                )
+                group.create_dataset("dipole", data=random.random((N_CONFORMATIONS, 3)))
+                for name in ["mbis-charges", "mbis-volumes"]:
+                    group.create_dataset(
+                        name, data=random.random((N_CONFORMATIONS, N_ATOMS, 1))
+                    )
+                all_keys.append(key)
+        reference_files.append(file_name)
+
+    # a random split of half of the molecules
+    split_keys = list(random.choice(all_keys, len(all_keys) // 2, replace=False))
+
+    start = time.perf_counter()
+    reference_datasets = [h5py.File(file_name, "r") for file_name in reference_files]
+    n_molecules = 0
+    for key in split_keys:
+        for dataset in reference_datasets:
+            if key in dataset:
+                read_molecule_group(dataset[key])
+                n_molecules += 1
+    for dataset in reference_datasets:
+        dataset.close()
+    print(
+        f"split order lookup: {time.perf_counter() - start:.2f} s for {n_molecules} molecules"
+    )
+
+    # the pool only helps with more than one core and the sequential reads matter most when the files are not
+    # already in the page cache
+    print(f"running with {os.cpu_count()} cores")
+    for n_workers in [1, 4]:
+        start = time.perf_counter()
+        n_molecules = sum(
+            1
+            for _ in iter_molecule_groups(
+                split_keys, reference_files, n_workers=n_workers
+            )
+        )
+        print(
+            f"indexed reads with {n_workers} workers: {time.perf_counter() - start:.2f} s for {n_molecules} molecules"
+        )
@@ -0,0 +1,31 @@
+# Compare building the featurized graph of 10, 100 and 1000 atom molecules with nagl and the vectorised builder
+import time
+
+from nagl.molecules import DGLMolecule
+from rdkit import Chem
+
+from naglmbis.models import load_charge_model
+from naglmbis.models.featurize import molecule_to_dgl
+
+N_REPEATS = 50
+# alkanes with 11, 101 and 1001 atoms
+MOLECULES = {
+    n_atoms: Chem.AddHs(Chem.MolFromSmiles("C" * n_carbons))
+    for n_atoms, n_carbons in [(10, 3), (100, 33), (1000, 333)]
+}
+
+model_config = load_charge_model(charge_model="nagl-v1-mbis").config.model
+
+for n_atoms, molecule in MOLECULES.items():
+    timings = {}
+    for name, builder in [
+        ("nagl", DGLMolecule.from_rdkit),
+        ("vectorised", molecule_to_dgl),
+    ]:
+        start = time.perf_counter()
+        for _ in range(N_REPEATS):
+            builder(molecule, model_config.atom_features, model_config.bond_features)
+        timings[name] = (time.perf_counter() - start) / N_REPEATS * 1000
+    print(
+        f"~{n_atoms:>4} atoms: nagl {timings['nagl']:.2f} ms, vectorised {timings['vectorised']:.2f} ms"
+    )
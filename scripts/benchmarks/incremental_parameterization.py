@@ -0,0 +1,73 @@
+# Benchmark adding new species to an already parameterised ~50k particle water box using the incremental
+# NAGLMBIS mode compared with rebuilding the nonbonded force from scratch
+import time
+
+import openmm
+from openff.toolkit.topology import Molecule, Topology
+
+from naglmbis.plugins import modify_force_field
+
+N_WATERS = 16667
+N_NEW_SPECIES = [1, 10, 100]
+# a set of distinct small molecules to add to the box
+NEW_SPECIES = [
+    f"{'C' * n_carbons}{group}"
+    for group in ["O", "N", "F", "Cl"]
+    for n_carbons in range(1, 26)
+]
+
+force_field = modify_force_field(force_field="openff_unconstrained-2.0.0.offxml")
+handler = force_field.get_parameter_handler("NAGLMBIS")
+
+# load the models and run them once so the first timing does not include the start up cost
+handler.get_molecule_parameters(molecule=Molecule.from_smiles("CC"))
+
+water = Molecule.from_smiles("O")
+box = Topology.from_molecules([water] * N_WATERS)
+start = time.perf_counter()
+base_system = force_field.create_openmm_system(topology=box)
+print(
+    f"Parameterised the box of {box.n_topology_particles} particles in {time.perf_counter() - start:.2f} s"
+)
+
+
+def get_nonbonded_force(system: openmm.System) -> openmm.NonbondedForce:
+    return [
+        force
+        for force in system.getForces()
+        if isinstance(force, openmm.NonbondedForce)
+    ][0]
+
+
+for n_species in N_NEW_SPECIES:
+    new_molecules = [Molecule.from_smiles(smiles) for smiles in NEW_SPECIES[:n_species]]
+    grown_box = Topology.from_molecules([water] * N_WATERS + new_molecules)
+
+    # make sure no molecule is cached before each timing
+    handler.clear_parameter_cache()
+    force = openmm.NonbondedForce(get_nonbonded_force(base_system))
+    start = time.perf_counter()
+    handler.extend_force(
+        force=force,
+        topology=grown_box,
+        n_existing_particles=box.n_topology_particles,
+        force_field=force_field,
+    )
+    incremental_time = time.perf_counter() - start
+
+    handler.clear_parameter_cache()
+    start = time.perf_counter()
+    force_field.create_openmm_system(topology=grown_box)
+    full_time = time.perf_counter() - start
+
+    # check the incremental force matches the full rebuild
+    full_force = get_nonbonded_force(
+        force_field.create_openmm_system(topology=grown_box)
+    )
+    for i in range(full_force.getNumParticles()):
+        assert force.getParticleParameters(i) == full_force.getParticleParameters(i)
+    assert force.getNumExceptions() == full_force.getNumExceptions()
+
+    print(
+        f"{n_species:>4} new species: incremental {incremental_time:.2f} s, full rebuild {full_time:.2f} s"
+    )
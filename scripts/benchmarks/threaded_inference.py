@@ -0,0 +1,46 @@
+# Compare the throughput of many threads sharing one model lock free with a global lock baseline
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from rdkit import Chem
+
+from naglmbis.models import load_charge_model
+
+N_THREADS = [1, 2, 4, 8]
+N_CALLS = 2000
+SMILES = [
+    "CO",
+    "CCO",
+    "c1ccccc1O",
+    "CC(=O)[O-]",
+    "C[NH3+]",
+    "CCN(CC)CC",
+    "CC(=O)Nc1ccc(O)cc1",
+]
+
+charge_model = load_charge_model(charge_model="nagl-v1-mbis")
+molecules = [
+    Chem.AddHs(Chem.MolFromSmiles(SMILES[i % len(SMILES)])) for i in range(N_CALLS)
+]
+global_lock = threading.Lock()
+
+
+def lock_free(molecule: Chem.Mol):
+    return charge_model.compute_properties(molecule, readouts=["mbis-charges"])
+
+
+def locked(molecule: Chem.Mol):
+    with global_lock:
+        return charge_model.compute_properties(molecule, readouts=["mbis-charges"])
+
+
+for n_threads in N_THREADS:
+    for name, function in [("global lock", locked), ("lock free", lock_free)]:
+        with ThreadPoolExecutor(max_workers=n_threads) as pool:
+            start = time.perf_counter()
+            list(pool.map(function, molecules))
+            run_time = time.perf_counter() - start
+        print(
+            f"{n_threads:>2} threads {name:>12}: {N_CALLS / run_time:8.1f} molecules / s"
+        )
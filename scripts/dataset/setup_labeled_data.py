@@ -1,72 +1,21 @@
-import h5py
-import pyarrow
-import pyarrow.parquet
-from openff.units import unit
-from collections import defaultdict
-import deepchem as dc
-import typing
+from naglmbis.datasets.builder import build_parquet_dataset, read_key_list
 
-# setup the parquet datasets using the splits generated by deepchem
+# setup the parquet datasets using the key lists written by split_by_maxmin.py, the molecules are streamed into the
+# parquet files one row group at a time so the memory use does not grow with the size of the dataset
 
+reference_files = ["TrainingSet-v1.hdf5", "ValSet-v1.hdf5"]
 
-# load up both files
-training_db = h5py.File("TrainingSet-v1.hdf5", "r")
-valid_test_db = h5py.File("ValSet-v1.hdf5", "r")
-
-
-def create_parquet_dataset(
-    parquet_name: str,
-    deep_chem_dataset: dc.data.DiskDataset,
-    reference_datasets: typing.List[h5py.File],
-):
-    dataset_keys = deep_chem_dataset.X
-    dataset_smiles = deep_chem_dataset.ids
-    coloumn_names = ["smiles", "conformation", "dipole", "mbis-charges"]
-    results = defaultdict(list)
-    # keep track of the number of total entries, this is each conformation expanded as a unique training point
-    total_records = 0
-    for key, smiles in zip(dataset_keys, dataset_smiles):
-        for dataset in reference_datasets:
-            if key in dataset:
-                data_group = dataset[key]
-                group_smiles = data_group["smiles"].asstr()[0]
-                assert group_smiles == smiles
-                charges = data_group["mbis-charges"][()]
-                dipoles = data_group["dipole"][()]
-                conformations = data_group["conformations"][()] * unit.angstrom
-                # workout how many entries we have
-                n_records = charges.shape[0]
-                total_records += n_records
-                for i in range(n_records):
-
-                    results["smiles"].append(smiles)
-                    results["mbis-charges"].append(charges[i])
-                    results["dipole"].append(dipoles[i])
-                    # make to store in bohr
-                    results["conformation"].append(
-                        conformations[i].m_as(unit.bohr).flatten()
-                    )
-
-    for key, values in results.items():
-        assert len(values) == total_records, print(key)
-    columns = [results[label] for label in coloumn_names]
-
-    table = pyarrow.table(columns, coloumn_names)
-    pyarrow.parquet.write_table(table, parquet_name)
-
-
-for file_name, dataset_name in [
-    ("training.parquet", "maxmin-train"),
-    ("validation.parquet", "maxmin-valid"),
-    ("testing.parquet", "maxmin-test"),
+# the grouped layout has one row per molecule so each molecule is only featurized once during training
+for file_name, key_file in [
+    ("training-grouped.parquet", "maxmin/train.txt"),
+    ("validation-grouped.parquet", "maxmin/valid.txt"),
+    ("testing-grouped.parquet", "maxmin/test.txt"),
 ]:
-    print("creating parquet for ", dataset_name)
-    dc_dataset = dc.data.DiskDataset(dataset_name)
-    create_parquet_dataset(
+    print("creating parquet for ", key_file)
+    n_records = build_parquet_dataset(
         parquet_name=file_name,
-        deep_chem_dataset=dc_dataset,
-        reference_datasets=[training_db, valid_test_db],
+        keys=read_key_list(key_file),
+        reference_files=reference_files,
+        grouped=True,
     )
-
-training_db.close()
-valid_test_db.close()
+    print(f"wrote {n_records} conformations to {file_name}")
@@ -0,0 +1,25 @@
+# split the entire collection of data so similar molecules stay in the same set, for generalization studies
+from naglmbis.datasets.splitting import (
+    butina_split,
+    compute_scaffolds,
+    load_fingerprints,
+    read_reference_smiles,
+    scaffold_split,
+    write_split_key_lists,
+)
+
+reference_smiles = read_reference_smiles(["TrainingSet-v1.hdf5"])
+keys = list(reference_smiles)
+print(f"The total number of unique molecules {len(reference_smiles)}")
+
+print("Running scaffold splitter ...")
+scaffolds = compute_scaffolds(list(reference_smiles.values()), n_workers=8)
+write_split_key_lists("scaffold", keys, scaffold_split(scaffolds))
+
+# the neighbours of each molecule are found with locality sensitive hashing so no all pairs similarity matrix
+# is needed
+print("Running Butina splitter ...")
+fingerprints = load_fingerprints(
+    reference_smiles, cache_file="fingerprints.parquet", n_workers=8
+)
+write_split_key_lists("butina", keys, butina_split(fingerprints, threshold=0.6))
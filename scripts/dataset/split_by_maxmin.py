@@ -0,0 +1,18 @@
+# split the entire collection of data with MaxMin diversity picking and write a key list for each split
+from naglmbis.datasets.splitting import (
+    load_fingerprints,
+    maxmin_split,
+    read_reference_smiles,
+    write_split_key_lists,
+)
+
+reference_smiles = read_reference_smiles(["TrainingSet-v1.hdf5"])
+print(f"The total number of unique molecules {len(reference_smiles)}")
+
+# the fingerprints are cached so the split can be repeated with other fractions or seeds
+fingerprints = load_fingerprints(
+    reference_smiles, cache_file="fingerprints.parquet", n_workers=8
+)
+print("Running MaxMin Splitter ...")
+splits = maxmin_split(fingerprints, fractions=(0.8, 0.1, 0.1), seed=42)
+write_split_key_lists("maxmin", list(reference_smiles), splits)
@@ -0,0 +1,76 @@
+# Make the small untrained charge and volume model used by the tests to check the single pass charge and volume
+# route, it uses the atom features of the shipped charge models with a much smaller convolution and readouts
+import copy
+
+import torch
+
+from naglmbis.utils import get_model_weights
+
+N_HIDDEN = 8
+N_LAYERS = 2
+
+base_model = torch.load(
+    get_model_weights(model_type="charge", model_name="nagl-v1-mbis.ckpt"),
+    weights_only=False,
+)
+hyper_parameters = copy.deepcopy(base_model["hyper_parameters"])
+model_config = hyper_parameters["config"]["model"]
+model_config["convolution"].update(
+    hidden_feats=[N_HIDDEN] * N_LAYERS, activation=["ReLU"] * N_LAYERS
+)
+model_config["readouts"] = {
+    "mbis-charges": {
+        "forward": {
+            "activation": ["ReLU", "Identity"],
+            "dropout": None,
+            "hidden_feats": [N_HIDDEN, 2],
+        },
+        "pooling": "atom",
+        "postprocess": "charges",
+    },
+    "mbis-volumes": {
+        "forward": {
+            "activation": ["ReLU", "Identity"],
+            "dropout": None,
+            "hidden_feats": [N_HIDDEN, 1],
+        },
+        "pooling": "atom",
+        "postprocess": None,
+    },
+}
+
+generator = torch.Generator().manual_seed(0)
+
+
+def random_weights(*shape: int) -> torch.Tensor:
+    return 0.1 * torch.randn(*shape, generator=generator)
+
+
+n_atom_features = base_model["state_dict"]["convolution_module.0.fc_self.weight"].shape[
+    1
+]
+state_dict = {}
+n_in = n_atom_features
+for layer in range(N_LAYERS):
+    prefix = f"convolution_module.{layer}"
+    state_dict[f"{prefix}.fc_neigh.weight"] = random_weights(N_HIDDEN, n_in)
+    state_dict[f"{prefix}.fc_self.weight"] = random_weights(N_HIDDEN, n_in)
+    state_dict[f"{prefix}.fc_self.bias"] = random_weights(N_HIDDEN)
+    n_in = N_HIDDEN
+
+# each forward layer is a linear, activation and dropout module, the final biases keep the hardness and volumes
+# positive
+for readout_name, n_out, final_bias in [
+    ("mbis-charges", 2, torch.tensor([0.0, 1.0])),
+    ("mbis-volumes", 1, torch.tensor([10.0])),
+]:
+    prefix = f"readout_modules.{readout_name}.forward_layers"
+    state_dict[f"{prefix}.0.weight"] = random_weights(N_HIDDEN, N_HIDDEN)
+    state_dict[f"{prefix}.0.bias"] = random_weights(N_HIDDEN)
+    state_dict[f"{prefix}.3.weight"] = random_weights(n_out, N_HIDDEN)
+    state_dict[f"{prefix}.3.bias"] = final_bias
+
+torch.save(
+    {"hyper_parameters": hyper_parameters, "state_dict": state_dict},
+    "nagl-test-charge-volume.ckpt",
+)
@@ -16,7 +16,8 @@ from nagl.features import (
     register_atom_feature,
     _CUSTOM_ATOM_FEATURES,
 )
-from nagl.training import DGLMoleculeDataModule, DGLMoleculeLightningModel
+from naglmbis.datasets import GroupedDataModule, GroupedMBISGraphModel
+from naglmbis.training import ThroughputLogger
 import typing
 import logging
 import pathlib
@@ -79,72 +80,69 @@ def configure_model(
                     activation=["ReLU"] * n_am1_layers + ["Identity"],
                 ),
                 postprocess="charges",
-            )
+            ),
+            # share the convolution trunk with the charges so both come from one pass
+            "mbis-volumes": ReadoutModule(
+                pooling="atom",
+                forward=Sequential(
+                    hidden_feats=[n_am1_hidden_features] * n_am1_layers + [1],
+                    activation=["ReLU"] * n_am1_layers + ["Identity"],
+                ),
+            ),
         },
     )
 
 
+def configure_targets() -> list:
+    # denom for charge in e, dipole in e*bohr 0.1D~ and volumes in bohr^3
+    return [
+        ReadoutTarget(
+            column="mbis-charges",
+            readout="mbis-charges",
+            metric="rmse",
+            denominator=0.02,
+        ),
+        DipoleTarget(
+            metric="rmse",
+            dipole_column="dipole",
+            conformation_column="conformation",
+            charge_label="mbis-charges",
+            denominator=0.04,
+        ),
+        ReadoutTarget(
+            column="mbis-volumes",
+            readout="mbis-volumes",
+            metric="rmse",
+            denominator=0.5,
+        ),
+    ]
+
+
 def configure_data() -> DataConfig:
     return DataConfig(
         training=Dataset(
-            sources=["../datasets/training.parquet"],
+            # the grouped datasets have one row per molecule with all of its conformations
+            sources=["../datasets/training-grouped.parquet"],
             # The 'column' must match one of the label columns in the parquet
             # table that was create during stage 000.
             # The 'readout' column should correspond to one our or model readout
             # keys.
             # denom for charge in e and dipole in e*bohr 0.1D~
-            targets=[
-                ReadoutTarget(
-                    column="mbis-charges",
-                    readout="mbis-charges",
-                    metric="rmse",
-                    denominator=0.02,
-                ),
-                DipoleTarget(
-                    metric="rmse",
-                    dipole_column="dipole",
-                    conformation_column="conformation",
-                    charge_label="mbis-charges",
-                    denominator=0.04,
-                ),
-            ],
+            targets=configure_targets(),
+            # with the grouped layout the batch size counts molecules with all of their
+            # conformations, not single conformations, so each step sees about
+            # n_conformations times more data than the per conformation layout did with
+            # the same value, lower it to keep the old step size. It is only used when
+            # the data module is not given an atom budget.
             batch_size=250,
         ),
         validation=Dataset(
-            sources=["../datasets/validation.parquet"],
-            targets=[
-                ReadoutTarget(
-                    column="mbis-charges",
-                    readout="mbis-charges",
-                    metric="rmse",
-                    denominator=0.02,
-                ),
-                DipoleTarget(
-                    metric="rmse",
-                    dipole_column="dipole",
-                    conformation_column="conformation",
-                    charge_label="mbis-charges",
-                    denominator=0.04,
-                ),
-            ],
+            sources=["../datasets/validation-grouped.parquet"],
+            targets=configure_targets(),
         ),
         test=Dataset(
-            sources=["../datasets/testing.parquet"],
-            targets=[
-                ReadoutTarget(
-                    column="mbis-charges",
-                    readout="mbis-charges",
-                    metric="rmse",
-                    denominator=0.02,
-                ),
-                DipoleTarget(
-                    metric="rmse",
-                    dipole_column="dipole",
-                    conformation_column="conformation",
-                    charge_label="mbis-charges",
-                    denominator=0.04,
-                ),
-            ],
+            sources=["../datasets/testing-grouped.parquet"],
+            targets=configure_targets(),
         ),
     )
 
@@ -180,19 +178,31 @@ def main():
     # and test dataloaders if specified in ``data_config``.
     config = Config(model=model_config, data=data_config, optimizer=optimizer_config)
 
-    model = DGLMoleculeLightningModel(config)
-    model.to_yaml("charge-dipole-v1.yaml")
+    model = GroupedMBISGraphModel(config)
+    model.to_yaml("charge-volume-v1.yaml")
     print("Model", model)
 
-    # The 'cache_dir' will store the fully featurized molecules so we don't need to
-    # re-compute these each to we adjust a hyperparameter for example.
-    data = DGLMoleculeDataModule(config, cache_dir=output_dir / "feature-cache")
+    # The 'cache_dir' is a feature cache keyed by the atom features and the dataset
+    # contents, so every run of a sweep over the model settings reuses the same
+    # memory-mapped feature stores, keep it outside of the run directory so it is
+    # shared. Stale entries can be removed with `naglmbis clean-feature-cache`.
+    # Batches are made from molecules of similar size and capped by the total number
+    # of atoms and edges, replacing the fixed batch size of the training config, so
+    # every step has a similar cost. Tune the budget with the throughput logged by
+    # 'ThroughputLogger'. The batch sampler shares the batches between processes
+    # itself, so a distributed trainer must set 'use_distributed_sampler=False'.
+    data = GroupedDataModule(
+        config,
+        cache_dir=pathlib.Path("feature-cache"),
+        max_atoms=5000,
+        max_edges=10000,
+    )
 
     # Define an MLFlow experiment to store the outputs of training this model. This
     # Will include the usual statistics as well as useful artifacts highlighting
     # the models weak spots.
     logger = MLFlowLogger(
-        experiment_name="mbis-charge-dipole-model-small-mols-1000",
+        experiment_name="mbis-charge-volume-model-small-mols-1000",
         save_dir=str(output_dir / "mlruns"),
         log_model="all",
     )
@@ -219,7 +229,8 @@ def main():
         max_epochs=n_epochs,
         logger=logger,
         log_every_n_steps=50,
-        callbacks=[model_checkpoint],
+        use_distributed_sampler=False,
+        callbacks=[model_checkpoint, ThroughputLogger()],
     )
 
     trainer.fit(model, datamodule=data)